@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+
+Measures the lookups of references in a repository, by forking git for each of them,
+through the long-lived worker, and by reading the repository files.
+
+Usage: python extra/benchmark_git.py [path] [count]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.git import Git, GitReader
+
+
+def measure(label, func, count):
+    start = time.time()
+    for i in range(count):
+        func()
+    elapsed = time.time() - start
+    print '{0:<10} {1:>10.0f} calls/s'.format(label, count / elapsed)
+
+
+def main():
+    path = os.path.abspath(sys.argv[1] if len(sys.argv) > 1 else '.')
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    repo = Git(path, 'git')
+    branch = repo.currentBranch()
+    if not branch:
+        raise Exception('The repository must be on a branch')
+    ref = 'refs/heads/%s' % branch
+
+    worker = repo.worker()
+    reader = GitReader.find(path, 'git')
+
+    measure('fork', lambda: repo.execute('show-ref --verify --quiet "%s"' % ref), count)
+    if worker:
+        measure('worker', lambda: worker.resolve(ref), count)
+    if reader:
+        measure('reader', lambda: reader.resolve(ref), count)
+
+
+if __name__ == "__main__":
+    main()
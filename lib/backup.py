@@ -30,6 +30,7 @@ from distutils.dir_util import copy_tree
 
 from tools import chmodRecursive
 from db import DB
+from metadata import Metadata
 from config import Conf
 from workplace import Workplace
 from exceptions import *
@@ -45,8 +46,11 @@ class BackupManager(object):
         self.path = os.path.expanduser(os.path.join(C.get('dirs.moodle'), 'backup'))
 
     def create(self, M):
-        """Creates a new backup of M"""
+        """Creates a new backup of M, the instance cannot be modified in the meantime"""
+        with M.lock(exclusive=False):
+            return self._create(M)
 
+    def _create(self, M):
         if M.isInstalled() and M.get('dbtype') != 'mysqli':
             raise BackupDBEngineNotSupported('Cannot backup database engine %s' % M.get('dbtype'))
 
@@ -185,31 +189,35 @@ class Backup(object):
         except Exception as e:
             raise Exception('Error while restoring directory\n%s\nto %s. Exception: %s' % (self.path, destination, e))
 
-        # Restoring database
-        if self.get('installed') and os.path.isfile(self.sqlfile):
-            logging.info('Restoring database')
-            content = ''
-            f = open(self.sqlfile, 'r')
-            for l in f:
-                content += l
-            queries = content.split(';\n')
-            content = None
-            logging.info("%d queries to execute" % (len(queries)))
-
-            dbo.createdb(dbname)
-            dbo.selectdb(dbname)
-            done = 0
-            for query in queries:
-                if len(query.strip()) == 0: continue
-                try:
-                    dbo.execute(query)
-                except:
-                    logging.error('Query failed! You will have to fix this mually. %s', query)
-                done += 1
-                if done % 500 == 0:
-                    logging.debug("%d queries done" % done)
-            logging.info('%d queries done' % done)
-            dbo.close()
+        # Restoring database, nothing should use the instance in the meantime
+        with M.lock():
+            if self.get('installed') and os.path.isfile(self.sqlfile):
+                logging.info('Restoring database')
+                content = ''
+                f = open(self.sqlfile, 'r')
+                for l in f:
+                    content += l
+                queries = content.split(';\n')
+                content = None
+                logging.info("%d queries to execute" % (len(queries)))
+
+                dbo.createdb(dbname)
+                dbo.selectdb(dbname)
+                done = 0
+                for query in queries:
+                    if len(query.strip()) == 0: continue
+                    try:
+                        dbo.execute(query)
+                    except:
+                        logging.error('Query failed! You will have to fix this mually. %s', query)
+                    done += 1
+                    if done % 500 == 0:
+                        logging.debug("%d queries done" % done)
+                logging.info('%d queries done' % done)
+                dbo.close()
+
+            # What was recorded about the database of the instance does not apply to the restored one.
+            Metadata().invalidate(M.path)
 
         # Restoring symbolic link
         linkDir = os.path.join(Wp.www, identifier)
@@ -221,4 +229,5 @@ class Backup(object):
         else:
             os.symlink(wwwDir, linkDir)
 
+        Wp.updateIndex(identifier)
         return M
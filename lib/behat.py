@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import logging
+import os
+import re
+import shutil
+import xml.etree.ElementTree as ET
+from command import getLogPath, InstanceExecutor
+from config import Conf
+from timings import Timings
+from tools import mkdir, parallel, process, ProcessSupervisor
+
+C = Conf()
+
+# Read from config.php to select the environment of a run, see Behat.
+_runVariable = 'MDK_BEHAT_RUN'
+
+# The ports of the PHP server and Selenium of the first run, the others use the following ones.
+_phpPort = 8000
+_seleniumPort = 4444
+
+
+class Behat(object):
+    """Runs the Behat features of an instance split in runs happening at the same time
+
+    Each run has its own Behat environment, its tables and data directory are the ones set by
+    Moodle.initBehat() suffixed with the number of the run. The environment variable
+    MDK_BEHAT_RUN selects the run from config.php, the first run uses the environment of the
+    instance. Each run has its PHP server and Selenium, on their own ports. The features are
+    distributed according to their recorded timings, which come from the JUnit formatter.
+    """
+
+    M = None
+    runs = 1
+
+    def __init__(self, M, runs=1):
+        self.M = M
+        self.runs = max(1, runs)
+
+    def getConfigPath(self, run):
+        return os.path.join(self.getRunDataroot(run), 'behat', 'behat.yml')
+
+    def getFeatureFiles(self):
+        """Return the feature files of the instance, relative to its root"""
+        files = []
+        root = self.M.get('path')
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d not in ['.git', 'node_modules', 'vendor']]
+            if not dirpath.endswith(os.path.join('tests', 'behat')):
+                continue
+            for filename in filenames:
+                if filename.endswith('.feature'):
+                    files.append(os.path.relpath(os.path.join(dirpath, filename), root))
+        return sorted(files)
+
+    def getFormatArgs(self, directory):
+        """The arguments to get the pretty output, and the JUnit reports in directory"""
+        return ['--format=pretty,junit', '--out=,%s' % directory]
+
+    def getServerLogPath(self, server, run=0):
+        """The log file of a server started for a run, php or selenium"""
+        return getLogPath('behat', '%s-run%d-%s' % (self.M.get('identifier'), run, server))
+
+    def getRunDataroot(self, run):
+        return self.M.get('behat_dataroot') + (str(run) if run > 0 else '')
+
+    def getRunEnv(self, run):
+        return {_runVariable: str(run)} if run > 0 else None
+
+    def getRunPrefix(self, run):
+        prefix = self.M.get('behat_prefix')
+        return prefix.rstrip('_') + str(run) + '_' if run > 0 else prefix
+
+    def init(self, switchcompletely=False):
+        """Initialise the Behat environment of each run"""
+        M = self.M
+        with M.lock():
+            M.initBehat(switchcompletely=switchcompletely)
+
+            code = None
+            if self.runs > 1:
+                if M.get('behat_switchcompletely'):
+                    raise Exception('The Behat runs cannot happen at the same time when switching completely')
+
+                # The PHP server of a run serves the root of its wwwroot, the cookies must be sent there.
+                code = '\n'.join([
+                    "if ($mdkrun = (int) getenv('%s')) {" % _runVariable,
+                    "    $CFG->behat_prefix = rtrim($CFG->behat_prefix, '_') . $mdkrun . '_';",
+                    "    $CFG->behat_dataroot .= $mdkrun;",
+                    "    $CFG->behat_wwwroot = 'http://localhost:' . (%d + $mdkrun);" % _phpPort,
+                    "    unset($CFG->sessioncookiepath);",
+                    "}"
+                ])
+            with M.editConfig() as config:
+                config.setBlock('Behat runs', code)
+
+            if self.runs < 2:
+                return
+
+            def initRun(run):
+                dataroot = self.getRunDataroot(run)
+                if not os.path.isdir(dataroot):
+                    mkdir(dataroot, 0777)
+                result = M.cli('admin/tool/behat/cli/init.php', env=self.getRunEnv(run))
+                if result[0] != 0:
+                    logging.debug(result[1])
+                    raise Exception('Error while initialising the Behat environment of run %d' % run)
+
+            logging.info('Initialising %d other Behat environments...' % (self.runs - 1))
+            results = parallel(initRun, range(1, self.runs), self.runs)
+            failed = False
+            for (run, result, exception) in results:
+                if exception != None:
+                    logging.error('Run %d: %s' % (run, exception))
+                    failed = True
+            if failed:
+                raise Exception('Could not initialise the Behat environments')
+
+    def _parseJUnit(self, directory, features):
+        """Parse the JUnit reports of the features, returns the timings of the features and scenarios
+
+        The reports are named after the file of their feature, the features sharing the same
+        file name cannot be told apart and are ignored."""
+        names = {}
+        for feature in features:
+            name = os.path.basename(feature)[:-len('.feature')]
+            names[name] = feature if name not in names else None
+
+        timings = []
+        if not os.path.isdir(directory):
+            return timings
+        for filename in os.listdir(directory):
+            feature = names.get(filename[len('TEST-'):-len('.xml')])
+            if not filename.startswith('TEST-') or not feature:
+                continue
+            total = 0.0
+            anyFailed = False
+            for case in ET.parse(os.path.join(directory, filename)).getroot().iter('testcase'):
+                duration = float(case.get('time', 0))
+                failed = case.find('failure') != None or case.find('error') != None
+                timings.append((feature, case.get('name'), duration, failed))
+                total += duration
+                anyFailed = anyFailed or failed
+            timings.append((feature, '', total, anyFailed))
+        return timings
+
+    def record(self, directory):
+        """Record the timings of the features from the JUnit reports in directory"""
+        Timings().record('behat', self.M, self._parseJUnit(directory, self.getFeatureFiles()))
+
+    def run(self, args, java=None, selenium=None, junit=True, features=None):
+        """Run the features, returns whether they passed
+
+        The arguments are passed to Behat, each run is given its features in one Behat process.
+        Selenium is started when the path to its jar file is given. Without the JUnit formatter,
+        the failures cannot be told apart and the features are not timed. The features default
+        to all the ones of the instance."""
+        M = self.M
+        if features == None:
+            features = self.getFeatureFiles()
+        timings = Timings()
+        runs = timings.schedule('behat', M.get('branch'), features, self.runs)
+        logging.info('Running %d features in %d runs...' % (sum([len(assigned) for assigned in runs]), len(runs)))
+
+        failures = {}
+        featureTimings = []
+
+        def runFeatures(run):
+            env = self.getRunEnv(run)
+            config = self._writeConfig(run, runs[run], _seleniumPort + run if selenium else None)
+            try:
+                with ProcessSupervisor() as supervisor:
+                    # From 2.7 the first run is served by the web server.
+                    if run > 0 or M.branch_compare(27, '<'):
+                        logging.info('Starting the PHP server on port %d' % (_phpPort + run))
+                        supervisor.start('%s -S localhost:%d' % (C.get('php'), _phpPort + run), cwd=M.get('path'), env=env,
+                            log=self.getServerLogPath('php', run), port=_phpPort + run)
+                    if selenium:
+                        logging.info('Starting Selenium on port %d' % (_seleniumPort + run))
+                        supervisor.start('%s -jar %s -port %d' % (java, selenium, _seleniumPort + run),
+                            log=self.getServerLogPath('selenium', run), port=_seleniumPort + run, timeout=60)
+
+                    directory = os.path.join(self.getRunDataroot(run), 'junit')
+                    if os.path.isdir(directory):
+                        shutil.rmtree(directory)
+                    cmd = ['vendor/bin/behat'] + args + (self.getFormatArgs(directory) if junit else [])
+                    cmd += ['--config=%s' % config]
+                    result = process(' '.join(cmd), cwd=M.get('path'), stdout=None, stderr=None, env=env, limited=False)
+            finally:
+                os.remove(config)
+
+            found = self._parseJUnit(directory, runs[run]) if junit else []
+            featureTimings.extend(found)
+            failed = [feature for (feature, name, duration, anyFailed) in found if name == '' and anyFailed]
+            if result[0] != 0 and not failed:
+                # The reports do not tell which features failed.
+                failed = runs[run]
+
+            if failed:
+                failures[run] = failed
+                raise Exception('%d features did not pass' % len(failed))
+
+        InstanceExecutor('behat', jobs=len(runs)).run(runFeatures, range(len(runs)), summary=False,
+            identifier=lambda run: '%s-run%d' % (M.get('identifier'), run))
+
+        timings.record('behat', M, featureTimings)
+        failed = sorted(sum(failures.values(), []))
+        logging.info('Features: %d, Failed: %d' % (sum([len(assigned) for assigned in runs]), len(failed)))
+        for feature in failed:
+            logging.info('  %s' % feature)
+        return len(failed) == 0
+
+    def _writeConfig(self, run, features, seleniumPort=None):
+        """Write the Behat configuration of a run, based on the one of its environment, returns its path
+
+        The list of features of the configuration is replaced with the ones of the run, and
+        Selenium is expected on seleniumPort when given."""
+        path = self.getConfigPath(run)
+        with open(path, 'r') as f:
+            lines = f.read().split('\n')
+
+        # The features are listed one per line, the first list is replaced and the others removed.
+        content = []
+        replaced = False
+        for line in lines:
+            match = re.match(r'^(\s*)-\s+([\'"]?)(.+\.feature)\2\s*$', line)
+            if not match:
+                content.append(line)
+            elif not replaced:
+                content.extend(["%s- '%s'" % (match.group(1), os.path.join(self.M.get('path'), feature).replace("'", "''"))
+                    for feature in features])
+                replaced = True
+        if not replaced:
+            raise Exception('Could not find the list of features in %s' % path)
+        content = '\n'.join(content)
+
+        if seleniumPort != None:
+            content = re.sub(r'(wd_host:\s*[\'"]?https?://[^:/\'"\s]+):\d+', r'\g<1>:%d' % seleniumPort, content)
+
+        path = os.path.join(os.path.dirname(path), 'behat.mdk.yml')
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
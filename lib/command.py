@@ -23,8 +23,24 @@ http://github.com/FMCorz/mdk
 """
 
 import argparse
+import logging
+import os
 import sys
+import threading
+import time
 import workplace
+from config import Conf
+from tools import captureOutput, parallel, ThreadOutput
+
+C = Conf()
+
+
+def getLogPath(name, identifier):
+    """The path to the log file of identifier for the command name, in dirs.moodle/logs"""
+    logs = os.path.join(os.path.expanduser(C.get('dirs.moodle')), 'logs')
+    if not os.path.isdir(logs):
+        os.makedirs(logs)
+    return os.path.join(logs, '%s-%s.log' % (name, identifier))
 
 
 class Command(object):
@@ -144,5 +160,140 @@ class CommandRunner(object):
             parser.error(e.message)
 
 
+class InstanceExecutor(object):
+    """Executes a function on several instances, on several of them at the same time with jobs
+
+    When several jobs run at the same time, all the output of an instance, log messages and
+    processes included, is written to its log file in dirs.moodle/logs. It is printed at once
+    when the instance is done, or as it comes prefixed with the name of the instance when stream
+    is set. With one job, the output is left untouched and the processes keep their terminal.
+    """
+
+    jobs = 1
+    name = None
+    stream = False
+
+    def __init__(self, name, jobs=1, stream=False):
+        self.name = name
+        self.jobs = max(1, jobs or 1)
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def getLogPath(self, identifier):
+        return getLogPath(self.name, identifier)
+
+    def run(self, func, Mlist, summary=True, identifier=None):
+        """Call func(M) on each instance, an instance fails when func raises an exception
+
+        The instances are named after their identifier, unless identifier is a function
+        returning the name of an item. Returns the list of the instances which failed.
+        """
+        start = time.time()
+        if identifier == None:
+            identifier = lambda M: M.get('identifier')
+
+        # Route the output of the threads to their instance.
+        stdout = sys.stdout
+        streams = []
+        if self.jobs > 1:
+            sys.stdout = ThreadOutput(stdout)
+            for handler in logging.getLogger().handlers:
+                if isinstance(handler, logging.StreamHandler) and not isinstance(handler.stream, ThreadOutput):
+                    streams.append((handler, handler.stream))
+                    handler.stream = ThreadOutput(handler.stream)
+
+        try:
+            results = parallel(lambda M: self._execute(func, M, identifier(M), stdout), Mlist, self.jobs)
+        finally:
+            sys.stdout = stdout
+            for (handler, stream) in streams:
+                handler.stream = stream
+
+        failed = []
+        for (M, result, exception) in results:
+            if exception != None or not result['success']:
+                failed.append(M)
+
+        if summary:
+            logging.info('')
+            for (M, result, exception) in results:
+                status = 'ok' if M not in failed else 'failed'
+                elapsed = '%6.1fs' % result['time'] if result else ''
+                logging.info('  {0:<25} {1:<7} {2}'.format(identifier(M), status, elapsed))
+            logging.info('%d of %d instances succeeded in %.1fs' % (len(Mlist) - len(failed), len(Mlist), time.time() - start))
+
+        return failed
+
+    def _execute(self, func, M, identifier, stdout):
+        """Call func on an instance, capturing its output when several jobs run at the same time"""
+        output = None
+        if self.jobs > 1:
+            output = InstanceOutput(identifier, self.getLogPath(identifier), stdout, self._lock,
+                mode='stream' if self.stream else 'group')
+            captureOutput(output.write)
+
+        result = {'success': True, 'time': 0}
+        start = time.time()
+        try:
+            func(M)
+        except Exception as e:
+            result['success'] = False
+            logging.error('%s: %s' % (identifier, e))
+        finally:
+            result['time'] = time.time() - start
+            if output:
+                captureOutput(None)
+                output.close()
+        return result
+
+
+class InstanceOutput(object):
+    """The output of an instance, see InstanceExecutor
+
+    The modes are stream (written as it comes, each line prefixed with the identifier) and
+    group (written at once when the output is closed).
+    """
+
+    def __init__(self, identifier, logPath, stdout, lock, mode='group'):
+        self.identifier = identifier
+        self.mode = mode
+        self._buffer = []
+        self._lock = lock
+        self._log = open(logPath, 'w')
+        self._partial = {}
+        self._stdout = stdout
+
+    def close(self):
+        with self._lock:
+            for (stream, text) in self._partial.items():
+                stream.write('[%s] %s\n' % (self.identifier, text))
+            for (stream, text) in self._buffer:
+                stream.write(text)
+            for stream in set([stream for (stream, text) in self._buffer] + self._partial.keys()):
+                stream.flush()
+        self._buffer = []
+        self._partial = {}
+        self._log.close()
+
+    def write(self, text, stream=None):
+        """Write the text which was sent to stream, or to stdout"""
+        if stream == None:
+            stream = self._stdout
+        self._log.write(text)
+        self._log.flush()
+
+        if self.mode == 'group':
+            self._buffer.append((stream, text))
+        else:
+            # Only complete lines are written, to prefix them.
+            lines = (self._partial.pop(stream, '') + text).split('\n')
+            if lines[-1] != '':
+                self._partial[stream] = lines[-1]
+            with self._lock:
+                for line in lines[:-1]:
+                    stream.write('[%s] %s\n' % (self.identifier, line))
+                stream.flush()
+
+
 if __name__ == "__main__":
     CommandRunner(Command()).run()
@@ -33,6 +33,7 @@ commandsList = [
     'backport',
     'backup',
     'behat',
+    'cache',
     'check',
     'config',
     'create',
@@ -41,6 +42,7 @@ commandsList = [
     'info',
     'init',
     'install',
+    'maintain',
     'phpunit',
     'plugin',
     'pull',
@@ -49,6 +51,7 @@ commandsList = [
     'rebase',
     'remove',
     'run',
+    'stats',
     'tracker',
     'uninstall',
     'update',
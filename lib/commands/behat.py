@@ -28,14 +28,30 @@ import urllib
 import re
 import logging
 import gzip
-from time import sleep
+import shutil
+from lib.behat import Behat
 from lib.command import Command
-from lib.tools import process, ProcessInThread, downloadProcessHook
+from lib.tools import process, ProcessSupervisor, downloadProcessHook
 
 
 class BehatCommand(Command):
 
     _arguments = [
+        (
+            ['-a', '--affected'],
+            {
+                'action': 'store_true',
+                'help': 'only run the features of the components changed by the current branch. This sets --run.'
+            }
+        ),
+        (
+            ['--dry-run'],
+            {
+                'action': 'store_true',
+                'dest': 'dryrun',
+                'help': 'with --affected, list the features to run without running them'
+            }
+        ),
         (
             ['-r', '--run'],
             {
@@ -96,6 +112,16 @@ class BehatCommand(Command):
                 'help': 'Will stop behat on first failure.'
             }
         ),
+        (
+            ['--parallel'],
+            {
+                'default': 1,
+                'dest': 'parallel',
+                'help': 'number of Behat environments running the features at the same time. Cannot be combined with --feature.',
+                'metavar': 'N',
+                'type': int
+            }
+        ),
         (
             ['-p', '--profile'],
             {
@@ -156,6 +182,31 @@ class BehatCommand(Command):
         if not M.get('installed'):
             raise Exception('This instance needs to be installed first')
 
+        if args.parallel < 1:
+            self.argumentError('The number of parallel runs must be at least 1.')
+        elif args.parallel > 1 and args.feature:
+            self.argumentError('The --parallel option cannot be combined with --feature.')
+
+        if args.affected and args.feature:
+            self.argumentError('The --affected option cannot be combined with --feature.')
+        elif args.dryrun and not args.affected:
+            self.argumentError('The --dry-run option only works with --affected.')
+
+        runner = Behat(M, args.parallel)
+
+        # Select the features of the components changed by the branch.
+        features = None
+        if args.affected:
+            features = M.getAffectedTests(runner.getFeatureFiles(), always=self.C.get('affectedTests.behat'))
+            if args.dryrun:
+                for feature in features:
+                    print feature
+                return
+            elif not features:
+                logging.info('No features are affected by the changes of the branch')
+                return
+            args.run = True
+
         # Disable Behat
         if args.disable and not args.run:
             self.disable(M)
@@ -210,7 +261,7 @@ class BehatCommand(Command):
         # Run cli
         try:
             logging.info('Initialising Behat, please be patient!')
-            M.initBehat(switchcompletely=args.switchcompletely)
+            runner.init(switchcompletely=args.switchcompletely)
             logging.info('Behat ready!')
 
             # Preparing Behat command
@@ -230,6 +281,22 @@ class BehatCommand(Command):
             if (args.profile):
                 cmd.append('-p %s' % (args.profile))
 
+            if args.run and (args.parallel > 1 or features != None):
+                # Each run uses its own configuration listing its features.
+                selenium = seleniumPath if not nojavascript else None
+                passed = runner.run(cmd[1:], java=self.C.get('java'), selenium=selenium, junit=not args.profile, features=features)
+                if args.disable:
+                    self.disable(M)
+                if not passed:
+                    sys.exit(1)
+                return
+
+            # The JUnit reports are used to record the timings, the profile could define other formats.
+            junit = None
+            if args.run and not args.profile:
+                junit = os.path.join(M.get('behat_dataroot'), 'junit')
+                cmd.extend(runner.getFormatArgs(junit))
+
             cmd.append('--config=%s/behat/behat.yml' % (M.get('behat_dataroot')))
 
             # Checking feature argument
@@ -249,43 +316,32 @@ class BehatCommand(Command):
             if args.run:
                 logging.info('Preparing Behat testing')
 
-                # Preparing PHP Server
-                phpServer = None
-                if not M.get('behat_switchcompletely'):
-                    logging.info('Starting standalone PHP server')
-                    kwargs = {}
-                    kwargs['cwd'] = M.get('path')
-                    phpServer = ProcessInThread(phpCommand, **kwargs)
-                    phpServer.start()
-
-                # Launching Selenium
-                seleniumServer = None
-                if seleniumPath and not nojavascript:
-                    logging.info('Starting Selenium server')
-                    kwargs = {}
-                    if args.seleniumverbose:
-                        kwargs['stdout'] = None
-                        kwargs['stderr'] = None
-                    seleniumServer = ProcessInThread(seleniumCommand, **kwargs)
-                    seleniumServer.start()
-
-                logging.info('Running Behat tests')
-
-                # Sleep for a few seconds before starting Behat
-                if phpServer or seleniumServer:
-                    sleep(3)
-
-                # Running the tests
-                (returncode, none, none) = process(cmd, M.path, None, None)
+                with ProcessSupervisor() as supervisor:
+
+                    # Preparing PHP Server
+                    if not M.get('behat_switchcompletely'):
+                        logging.info('Starting standalone PHP server')
+                        supervisor.start(phpCommand, cwd=M.get('path'), log=runner.getServerLogPath('php'), port=8000)
+
+                    # Launching Selenium
+                    if seleniumPath and not nojavascript:
+                        logging.info('Starting Selenium server')
+                        log = None if args.seleniumverbose else runner.getServerLogPath('selenium')
+                        supervisor.start(seleniumCommand, log=log, port=4444, timeout=60)
+
+                    logging.info('Running Behat tests')
+
+                    # Running the tests
+                    if junit and os.path.isdir(junit):
+                        shutil.rmtree(junit)
+                    (returncode, none, none) = process(cmd, M.path, None, None, limited=False)
+                    if junit:
+                        runner.record(junit)
+
+                # The servers are stopped when leaving the supervisor.
                 if (args.stoponfailure):
                     sys.exit(returncode)
 
-                # Kill the remaining processes
-                if phpServer:
-                    phpServer.kill()
-                if seleniumServer:
-                    seleniumServer.kill()
-
                 # Disable Behat
                 if args.disable:
                     self.disable(M)
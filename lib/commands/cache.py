@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import logging
+import os
+from lib.command import Command
+
+
+class CacheCommand(Command):
+
+    _arguments = [
+        (
+            ['action'],
+            {
+                'help': 'the action to perform',
+                'metavar': 'action',
+                'sub-commands': {
+                    'export': (
+                        {
+                            'help': 'write the cached repositories to a bundle'
+                        },
+                        [
+                            (
+                                ['-s', '--since'],
+                                {
+                                    'action': 'append',
+                                    'help': 'previous bundle, only what is not in it is exported. Can be repeated.',
+                                    'metavar': 'bundle'
+                                }
+                            ),
+                            (
+                                ['--split'],
+                                {
+                                    'help': 'split the bundle in parts of that many megabytes',
+                                    'metavar': 'size',
+                                    'type': int
+                                }
+                            ),
+                            (
+                                ['bundle'],
+                                {
+                                    'help': 'path to the bundle to write',
+                                    'metavar': 'bundle'
+                                }
+                            )
+                        ]
+                    ),
+                    'import': (
+                        {
+                            'help': 'populate the cached repositories from bundles'
+                        },
+                        [
+                            (
+                                ['bundles'],
+                                {
+                                    'help': 'path to the bundles, the incremental ones come after the ones they are based on',
+                                    'metavar': 'bundle',
+                                    'nargs': '+'
+                                }
+                            )
+                        ]
+                    )
+                }
+            }
+        )
+    ]
+    _description = 'Export or import the cached repositories'
+
+    def run(self, args):
+        if args.action == 'export':
+            path = os.path.abspath(os.path.expanduser(args.bundle))
+            since = [os.path.abspath(os.path.expanduser(f)) for f in args.since or []]
+            split = args.split * 1024 * 1024 if args.split else None
+            files = self.Wp.exportCache(path, since=since, split=split)
+            for f in files:
+                logging.info('Wrote %s' % f)
+
+        elif args.action == 'import':
+            bundles = [os.path.abspath(os.path.expanduser(f)) for f in args.bundles]
+            self.Wp.importCache(bundles)
+            logging.info('The cached repositories can now be updated with: mdk update --cached')
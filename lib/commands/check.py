@@ -24,8 +24,9 @@ http://github.com/FMCorz/mdk
 
 import os
 import shutil
+import sys
 from lib import git
-from lib.command import Command
+from lib.command import Command, InstanceExecutor
 from lib.tools import mkdir
 
 
@@ -46,6 +47,14 @@ class CheckCommand(Command):
                 'help': 'Enable all the checks, this is the default'
             }
         ),
+        (
+            ['--alternates'],
+            {
+                'action': 'store_true',
+                'help': 'Check the objects shared with the cached repositories'
+            }
+
+        ),
         (
             ['--branch'],
             {
@@ -69,6 +78,16 @@ class CheckCommand(Command):
                 'help': 'Check the directories set in the config file'
             }
 
+        ),
+        (
+            ['-j', '--jobs'],
+            {
+                'default': 1,
+                'help': 'Number of instances to check at the same time',
+                'metavar': 'n',
+                'type': int
+            }
+
         ),
         (
             ['--remotes'],
@@ -77,6 +96,14 @@ class CheckCommand(Command):
                 'help': 'Check the remotes of your instances'
             }
 
+        ),
+        (
+            ['--stream'],
+            {
+                'action': 'store_true',
+                'help': 'Print the output of the instances as it comes rather than once they are done'
+            }
+
         ),
         (
             ['--wwwroot'],
@@ -89,12 +116,16 @@ class CheckCommand(Command):
     ]
     _description = 'Perform several checks on your current installation'
 
+    _failed = None
+
     def run(self, args):
 
+        self._failed = set()
+
         allChecks = True
         if not args.all:
             argsDict = vars(args)
-            commands = ['directories', 'cached', 'remotes', 'wwwroot', 'branch']
+            commands = ['directories', 'cached', 'alternates', 'remotes', 'wwwroot', 'branch']
             for i in commands:
                 if argsDict.get(i):
                     allChecks = False
@@ -108,6 +139,10 @@ class CheckCommand(Command):
         if args.cached or allChecks:
             self.cachedRepositories(args)
 
+        # Check the shared objects
+        if args.alternates or allChecks:
+            self.alternates(args)
+
         # Check instances remotes
         if args.remotes or allChecks:
             self.remotes(args)
@@ -120,14 +155,74 @@ class CheckCommand(Command):
         if args.branch or allChecks:
             self.branch(args)
 
+        if self._failed:
+            print 'The checks failed on: %s' % ', '.join(sorted(self._failed))
+            sys.exit(1)
+
+    def alternates(self, args):
+        """Ensure that the objects borrowed from the cached repositories are available"""
+
+        print 'Checking shared objects'
+        share = self.C.get('shareCacheObjects')
+        cacheStable = self.Wp.getCachedRemote()
+        cacheIntegration = self.Wp.getCachedRemote(True)
+
+        # The cached repositories, there is only one when singleCachedRepository is set.
+        for cache in sorted(set([cacheStable, cacheIntegration])):
+            if not os.path.isdir(cache):
+                continue
+            name = os.path.split(cache)[1]
+            repo = git.Git(cache, self.C.get('git'))
+            expected = os.path.join(cacheStable, 'objects') if cache != cacheStable else None
+            self._checkAlternates(name, repo, expected, args)
+
+            if share and repo.getConfig('gc.pruneExpire') != 'never':
+                print '  %s could prune objects borrowed by other repositories' % name
+                if args.fix:
+                    print '    Setting gc.pruneExpire to never'
+                    repo.setConfig('gc.pruneExpire', 'never')
+
+        # The instances.
+        def check(M):
+            expected = os.path.join(self.Wp.getCachedRemote(M.isIntegration()), 'objects')
+            self._checkAlternates(M.get('identifier'), M.git(), expected, args)
+
+        self._forEachInstance(args, 'alternates', check, self.Wp.resolveMultiple(self.Wp.list()))
+
+    def _checkAlternates(self, name, repo, expected, args):
+        """Validates the alternates of a repository, expected is the objects directory it should borrow from"""
+        alternates = repo.getAlternates()
+        missing = [alternate for alternate in alternates if not os.path.isdir(alternate)]
+        if expected and not os.path.isdir(expected):
+            expected = None
+
+        if missing:
+            print '  %s borrows objects from missing directories: %s' % (name, ', '.join(missing))
+            if args.fix:
+                if not expected:
+                    print '    Error: Could not find a cached repository to borrow the objects from!'
+                    return
+                print '    Borrowing objects from %s instead' % expected
+                alternates = [alternate for alternate in alternates if alternate not in missing]
+                if expected not in alternates:
+                    alternates.append(expected)
+                repo.setAlternates(alternates)
+
+        elif self.C.get('shareCacheObjects') and expected and expected not in alternates:
+            print '  %s does not borrow objects from %s' % (name, expected)
+            if args.fix:
+                print '    Borrowing objects and removing the duplicates, this can take a while'
+                repo.setAlternates(alternates + [expected])
+                if not repo.repack(all=True, delete=True, local=True):
+                    print '      Error: Repack unsuccessful!'
+
     def branch(self, args):
         """Make sure the correct branch is checked out. Only on integration branches."""
 
         print 'Checking integration instances branches'
 
-        instances = self.Wp.list(integration=True)
-        for identifier in instances:
-            M = self.Wp.get(identifier)
+        def check(M):
+            identifier = M.get('identifier')
             stablebranch = M.get('stablebranch')
             currentbranch = M.currentBranch()
             if stablebranch != currentbranch:
@@ -137,12 +232,18 @@ class CheckCommand(Command):
                     if not M.git().checkout(stablebranch):
                         print '      Error: Checkout unsucessful!'
 
+        self._forEachInstance(args, 'branch', check, self.Wp.resolveMultiple(self.Wp.list(integration=True)))
+
     def cachedRepositories(self, args):
         """Ensure that the cached repositories are valid"""
 
         print 'Checking cached repositories'
         cache = os.path.abspath(os.path.realpath(os.path.expanduser(self.C.get('dirs.mdk'))))
 
+        if self.C.get('singleCachedRepository'):
+            self._checkSingleCachedRepository(args)
+            return
+
         dirs = [
             {
                 'dir': os.path.join(cache, 'moodle.git'),
@@ -186,6 +287,44 @@ class CheckCommand(Command):
                         print '    Setting remote.origin.fetch to %s' % '+refs/*:refs/*'
                         repo.setConfig('remote.origin.fetch', '+refs/*:refs/*')
 
+    def _checkSingleCachedRepository(self, args):
+        """Ensure that the single cached repository is valid, migrating the separate ones if need be"""
+
+        mirror = self.Wp.getCachedRemote()
+        name = os.path.split(mirror)[1]
+        if not os.path.isdir(mirror):
+            print '  %s does not exist' % name
+            if args.fix:
+                print '    Creating %s from the existing cached repositories' % name
+                self.Wp.checkCachedClones()
+            return
+
+        repo = git.Git(mirror, self.C.get('git'))
+        if repo.getConfig('core.bare') != 'true':
+            print '  %s core.bare is not set to true' % name
+            if args.fix:
+                print '    Setting core.bare to true'
+                repo.setConfig('core.bare', 'true')
+
+        invalid = False
+        for remote in ['stable', 'integration']:
+            url = self.C.get('remotes.%s' % remote)
+            if repo.getRemote(remote) != url:
+                print '  %s uses a different %s remote (%s)' % (name, remote, repo.getRemote(remote))
+                invalid = True
+            refspec = '+refs/tags/*:refs/%s/tags/*' % remote
+            if repo.getConfig('remote.%s.fetch' % remote) != refspec:
+                print '  %s fetch value of %s is invalid (%s)' % (name, remote, repo.getConfig('remote.%s.fetch' % remote))
+                invalid = True
+
+        if invalid and args.fix:
+            print '    Setting up the remotes of %s' % name
+            self.Wp.checkCachedClones()
+
+        for legacy in ['moodle.git', 'integration.git']:
+            if os.path.isdir(os.path.join(self.Wp.cache, legacy)):
+                print '  %s is not used any more and can be deleted' % legacy
+
     def directories(self, args):
         """Check that the directories are valid"""
 
@@ -198,6 +337,12 @@ class CheckCommand(Command):
                     print '    Creating %s' % d
                     mkdir(d, 0777)
 
+    def _forEachInstance(self, args, check, func, Mlist):
+        """Run a check on each instance, with as many jobs as requested"""
+        executor = InstanceExecutor('check-%s' % check, jobs=args.jobs, stream=args.stream)
+        for M in executor.run(func, Mlist, summary=False):
+            self._failed.add(M.get('identifier'))
+
     def remotes(self, args):
         """Check that the correct remotes are used"""
 
@@ -210,10 +355,8 @@ class CheckCommand(Command):
         myRemote = self.C.get('myRemote')
         upstreamRemote = self.C.get('upstreamRemote')
 
-        instances = self.Wp.list()
-        for identifier in instances:
-            M = self.Wp.get(identifier)
-
+        def check(M):
+            identifier = M.get('identifier')
             remote = M.git().getRemote(myRemote)
             if remote != remotes['mine']:
                 print '  %s: Remote %s is %s, not %s' % (identifier, myRemote, remote, remotes['mine'])
@@ -221,7 +364,9 @@ class CheckCommand(Command):
                     print '    Setting %s to %s' % (myRemote, remotes['mine'])
                     M.git().setRemote(myRemote, remotes['mine'])
 
-            expected = remotes['stable'] if M.isStable() else remotes['integration']
+            # Determined before fixing anything as it is guessed from the upstream remote.
+            integration = M.isIntegration()
+            expected = remotes['integration'] if integration else remotes['stable']
             remote = M.git().getRemote(upstreamRemote)
             if remote != expected:
                 print '  %s: Remote %s is %s, not %s' % (identifier, upstreamRemote, remote, expected)
@@ -229,6 +374,21 @@ class CheckCommand(Command):
                     print '    Setting %s to %s' % (upstreamRemote, expected)
                     M.git().setRemote(upstreamRemote, expected)
 
+            if self.C.get('useCacheAsUpstreamRemote'):
+                refspecs = self.Wp.getCachedRemoteRefspecs(integration, upstreamRemote)
+            else:
+                refspecs = None
+            if refspecs == None:
+                refspecs = ['+refs/heads/*:refs/remotes/%s/*' % upstreamRemote]
+            refspec = M.git().getConfig('remote.%s.fetch' % upstreamRemote)
+            if refspec != refspecs[-1]:
+                print '  %s: Remote %s fetches %s, not %s' % (identifier, upstreamRemote, refspec, refspecs[-1])
+                if (args.fix):
+                    print '    Setting the refspecs of %s' % (upstreamRemote)
+                    M.git().setRemoteRefspecs(upstreamRemote, refspecs)
+
+        self._forEachInstance(args, 'remotes', check, self.Wp.resolveMultiple(self.Wp.list()))
+
     def wwwroot(self, args):
         """Check the wwwroot of the instances"""
 
@@ -239,9 +399,9 @@ class CheckCommand(Command):
         if self.C.get('path') != '' and self.C.get('path') != None:
             wwwroot = wwwroot + self.C.get('path') + '/'
 
-        for M in instances:
+        def check(M):
             if not M.isInstalled():
-                continue
+                return
             else:
                 actual = M.get('wwwroot')
                 expected = wwwroot + M.get('identifier')
@@ -250,3 +410,5 @@ class CheckCommand(Command):
                     if args.fix:
                         print '    Setting %s on %s' % (expected, M.get('identifier'))
                         M.updateConfig('wwwroot', expected)
+
+        self._forEachInstance(args, 'wwwroot', check, instances)
@@ -23,10 +23,11 @@ http://github.com/FMCorz/mdk
 """
 
 import re
+import sys
 import logging
 
 from lib.db import DB
-from lib.command import Command
+from lib.command import Command, InstanceExecutor
 from lib.tools import yesOrNo
 from lib.exceptions import CreateException, InstallException
 
@@ -56,6 +57,22 @@ class CreateCommand(Command):
                     'metavar': 'engine'
                 }
             ),
+            (
+                ['-j', '--jobs'],
+                {
+                    'default': 1,
+                    'help': 'number of instances to create and install at the same time',
+                    'metavar': 'n',
+                    'type': int
+                }
+            ),
+            (
+                ['--stream'],
+                {
+                    'action': 'store_true',
+                    'help': 'print the output of the instances as it comes rather than once they are done'
+                }
+            ),
             (
                 ['-t', '--integration'],
                 {
@@ -119,21 +136,46 @@ class CreateCommand(Command):
         # if engine and not install:
             # self.argumentError('--engine can only be used with --install.')
 
+        # The names are resolved, and the questions asked, before creating anything.
+        instances = []
         for version in versions:
             for suffix in suffixes:
+                name = self.Wp.generateInstanceName(version, integration=args.integration, suffix=suffix, identifier=args.identifier)
+                if name in [instance['identifier'] for instance in instances]:
+                    self.argumentError('the instance %s would be created more than once' % name)
+                # The database names are truncated, different instances could share the same one.
+                if install:
+                    for arguments in instances:
+                        if arguments['install'] and self.getDbName(arguments['identifier']) == self.getDbName(name):
+                            self.argumentError('the instances %s and %s would use the same database %s' %
+                                (arguments['identifier'], name, self.getDbName(name)))
                 arguments = {
                     'version': version,
                     'suffix': suffix,
                     'engine': engine,
                     'integration': args.integration,
-                    'identifier': args.identifier,
+                    'identifier': name,
                     'install': install,
+                    'dropDb': install and self.dropDb(name, engine),
                     'run': args.run
                 }
-                self.do(arguments)
-                logging.info('')
+                instances.append(arguments)
+
+        # The cached repositories are updated once for all the instances.
+        self.Wp.checkCachedClones(not args.integration, args.integration)
+        if not self.Wp.updateCachedClones(stable=not args.integration, integration=args.integration, verbose=False):
+            logging.warning('Could not update the cached repositories, the instances may not be up to date')
+
+        def create(arguments):
+            if not self.do(arguments):
+                raise Exception('Could not create %s' % arguments['identifier'])
+
+        executor = InstanceExecutor('create', jobs=args.jobs, stream=args.stream)
+        errors = executor.run(create, instances, summary=len(instances) > 1, identifier=lambda arguments: arguments['identifier'])
 
         logging.info('Process complete!')
+        if errors:
+            sys.exit(1)
 
     def do(self, args):
         """Proceeds to the creation of an instance"""
@@ -145,7 +187,7 @@ class CreateCommand(Command):
 
         engine = args.engine
         version = args.version
-        name = self.Wp.generateInstanceName(version, integration=args.integration, suffix=args.suffix, identifier=args.identifier)
+        name = args.identifier
 
         # Wording version
         versionNice = version
@@ -167,7 +209,8 @@ class CreateCommand(Command):
         kwargs = {
             'name': name,
             'version': version,
-            'integration': args.integration
+            'integration': args.integration,
+            'updateCache': False
         }
         try:
             M = self.Wp.create(**kwargs)
@@ -181,19 +224,11 @@ class CreateCommand(Command):
         # Run the install script
         if args.install:
 
-            # Checking database
-            dbname = re.sub(r'[^a-zA-Z0-9]', '', name).lower()[:28]
-            db = DB(engine, self.C.get('db.%s' % engine))
-            dropDb = False
-            if db.dbexists(dbname):
-                logging.info('Database already exists (%s)' % dbname)
-                dropDb = yesOrNo('Do you want to remove it?')
-
             # Install
             kwargs = {
                 'engine': engine,
-                'dbname': dbname,
-                'dropDb': dropDb,
+                'dbname': self.getDbName(name),
+                'dropDb': args.dropDb,
                 'fullname': fullname,
                 'dataDir': self.Wp.getPath(name, 'data')
             }
@@ -214,3 +249,18 @@ class CreateCommand(Command):
                         M.runScript(script)
                     except Exception as e:
                         logging.warning('Error while running the script \'%s\':\  %s' % (script, e))
+
+        return True
+
+    def dropDb(self, name, engine):
+        """Ask whether the existing database of an instance should be removed"""
+        dbname = self.getDbName(name)
+        db = DB(engine, self.C.get('db.%s' % engine))
+        dropDb = False
+        if db.dbexists(dbname):
+            logging.info('Database already exists (%s)' % dbname)
+            dropDb = yesOrNo('Do you want to remove it?')
+        return dropDb
+
+    def getDbName(self, name):
+        return re.sub(r'[^a-zA-Z0-9]', '', name).lower()[:28]
@@ -99,10 +99,10 @@ class InfoCommand(Command):
             else:
                 l = self.Wp.list()
             l.sort()
+            index = self.Wp.index()
             for i in l:
                 if not args.nameonly:
-                    M = self.Wp.get(i)
-                    print '{0:<25}'.format(i), M.get('release')
+                    print '{0:<25}'.format(i), index[i]['release']
                 else:
                     print i
 
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import os
+import sys
+import time
+import logging
+from lib import git
+from lib.command import Command
+from lib.tools import parallel
+
+
+class MaintainCommand(Command):
+
+    # The query timed before and after the maintenance, it walks the whole history.
+    _reference = 'rev-list --count --all'
+
+    _arguments = [
+        (
+            ['-a', '--all'],
+            {
+                'action': 'store_true',
+                'dest': 'all',
+                'help': 'maintain the cached repositories and each instance'
+            }
+        ),
+        (
+            ['-c', '--cached'],
+            {
+                'action': 'store_true',
+                'help': 'only maintain the cached (mirrored) repositories'
+            }
+        ),
+        (
+            ['-i', '--integration'],
+            {
+                'action': 'store_true',
+                'dest': 'integration',
+                'help': 'maintain integration instances'
+            }
+        ),
+        (
+            ['-j', '--jobs'],
+            {
+                'default': None,
+                'help': 'number of repositories to maintain at the same time, defaults to the number of CPUs',
+                'metavar': 'n',
+                'type': int
+            }
+        ),
+        (
+            ['-s', '--stable'],
+            {
+                'action': 'store_true',
+                'dest': 'stable',
+                'help': 'maintain stable instances'
+            }
+        ),
+        (
+            ['names'],
+            {
+                'default': None,
+                'help': 'name of the instances',
+                'metavar': 'names',
+                'nargs': '*'
+            }
+        )
+    ]
+    _description = 'Optimise the git repositories of the cache and the instances'
+
+    def run(self, args):
+
+        repositories = []
+
+        # The cached repositories.
+        if args.all or args.cached:
+            caches = set([self.Wp.getCachedRemote(False), self.Wp.getCachedRemote(True)])
+            for cache in sorted(caches):
+                if os.path.isdir(cache):
+                    repositories.append((os.path.basename(cache), git.Git(cache, self.C.get('git')), self.Wp.lockCache()))
+
+        # The instances.
+        if not args.cached:
+            names = args.names
+            if args.all:
+                names = self.Wp.list()
+            elif args.integration or args.stable:
+                names = self.Wp.list(integration=args.integration, stable=args.stable)
+
+            Mlist = self.Wp.resolveMultiple(names)
+            for M in Mlist:
+                repositories.append((M.get('identifier'), M.git(), M.lock()))
+
+        if len(repositories) < 1:
+            raise Exception('No repositories to work on. Exiting...')
+
+        logging.info('Maintaining %d repositories...' % len(repositories))
+        start = time.time()
+        results = parallel(lambda item: self.maintain(*item), repositories, args.jobs)
+
+        errors = []
+        logging.info('')
+        for ((name, repo, lock), report, exception) in results:
+            if exception != None or report == None:
+                errors.append(name)
+                logging.warning('%-20s failed: %s' % (name, exception))
+                continue
+            logging.info('%-20s query %6.2fs -> %6.2fs    disk %8.1fMB -> %8.1fMB' % (name,
+                report['before']['time'], report['after']['time'],
+                report['before']['size'] / 1024.0, report['after']['size'] / 1024.0))
+        logging.info('Maintained %d of %d repositories in %.1fs' % (len(repositories) - len(errors), len(repositories), time.time() - start))
+
+        if errors:
+            sys.exit(1)
+
+    def maintain(self, name, repo, lock):
+        """Repack, write the commit-graph and prune a repository while holding its lock, returns a report"""
+        with lock:
+            return self._maintain(name, repo)
+
+    def _maintain(self, name, repo):
+        version = repo.version()
+        report = {'before': self._measure(repo)}
+
+        # The objects of the cached repositories can be borrowed by other repositories.
+        expire = repo.getConfig('gc.pruneExpire') or '2.weeks.ago'
+        pruneUnreachable = expire != 'never'
+        if self.C.get('shareCacheObjects') and repo.getPath() in [self.Wp.getCachedRemote(False), self.Wp.getCachedRemote(True)]:
+            pruneUnreachable = False
+
+        logging.debug('%s: expiring the reflogs' % name)
+        repo.expireReflog()
+
+        # A geometric repack only rolls up the smallest packs, a full repack is never needed. Older
+        # versions of git fall back on packing the loose objects. Both keep the unreachable objects.
+        logging.debug('%s: repacking' % name)
+        if version >= (2, 33):
+            success = repo.repack(delete=True, local=True, geometric=2)
+        else:
+            success = repo.repack(delete=True, local=True)
+        if not success:
+            raise Exception('Could not repack %s' % name)
+
+        if version >= (2, 21):
+            logging.debug('%s: writing the multi-pack-index' % name)
+            repo.writeMultiPackIndex()
+
+        if version >= (2, 24):
+            logging.debug('%s: writing the commit-graph' % name)
+            repo.writeCommitGraph(split=True, changedPaths=version >= (2, 27))
+
+        logging.debug('%s: pruning' % name)
+        if pruneUnreachable:
+            repo.prune(expire=expire)
+        else:
+            repo.prune(packed=True)
+
+        report['after'] = self._measure(repo)
+        return report
+
+    def _measure(self, repo):
+        """Time the reference query and measure the disk usage of a repository"""
+        start = time.time()
+        repo.execute(self._reference)
+        elapsed = time.time() - start
+        stats = repo.countObjects()
+        size = stats.get('size', 0) + stats.get('size-pack', 0) + stats.get('size-garbage', 0)
+        return {'time': elapsed, 'size': size}
@@ -25,14 +25,31 @@ http://github.com/FMCorz/mdk
 import logging
 import os
 import gzip
+import sys
 import urllib
 from lib.command import Command
+from lib.phpunit import PHPUnit
 from lib.tools import process
 
 
 class PhpunitCommand(Command):
 
     _arguments = [
+        (
+            ['-a', '--affected'],
+            {
+                'action': 'store_true',
+                'help': 'only run the tests of the components changed by the current branch. This sets --run.'
+            }
+        ),
+        (
+            ['--dry-run'],
+            {
+                'action': 'store_true',
+                'dest': 'dryrun',
+                'help': 'with --affected, list the tests to run without running them'
+            }
+        ),
         (
             ['-f', '--force'],
             {
@@ -40,6 +57,24 @@ class PhpunitCommand(Command):
                 'help': 'force the initialisation'
             }
         ),
+        (
+            ['-j', '--jobs'],
+            {
+                'default': 1,
+                'dest': 'jobs',
+                'help': 'number of PHPUnit environments running the tests at the same time',
+                'metavar': 'N',
+                'type': int
+            }
+        ),
+        (
+            ['--junit'],
+            {
+                'default': None,
+                'help': 'file to write the JUnit report to',
+                'metavar': 'path'
+            }
+        ),
         (
             ['-r', '--run'],
             {
@@ -86,10 +121,28 @@ class PhpunitCommand(Command):
         if not M.get('installed'):
             raise Exception('This instance needs to be installed first')
 
+        if args.jobs < 1:
+            self.argumentError('The number of jobs must be at least 1.')
+        elif args.jobs > 1 and (args.testcase or args.unittest):
+            self.argumentError('The --jobs option cannot be used with --testcase or --unittest.')
+
         # Check if testcase option is available.
         if args.testcase and M.branch_compare('26', '<'):
             self.argumentError('The --testcase option only works with Moodle 2.6 or greater.')
 
+        if args.affected and (args.testcase or args.unittest):
+            self.argumentError('The --affected option cannot be used with --testcase or --unittest.')
+        elif args.dryrun and not args.affected:
+            self.argumentError('The --dry-run option only works with --affected.')
+
+        runner = PHPUnit(M, args.jobs)
+
+        # Select the tests of the components changed by the branch, without initialising PHPUnit.
+        if args.affected and args.dryrun:
+            for f in M.getAffectedTests(runner.getTestFiles(), always=self.C.get('affectedTests.phpunit')):
+                print f
+            return
+
         # Composer was introduced with PHP Unit, if the JSON file is there then we will use it
         hasComposer = os.path.isfile(os.path.join(M.get('path'), 'composer.json'))
 
@@ -113,23 +166,41 @@ class PhpunitCommand(Command):
 
         # Run cli
         try:
-            M.initPHPUnit(force=args.force)
+            runner.init(force=args.force)
             logging.info('PHPUnit ready!')
 
+            # The test suites of the plugins are only listed in phpunit.xml once PHPUnit is initialised.
+            files = None
+            if args.affected:
+                files = M.getAffectedTests(runner.getTestFiles(), always=self.C.get('affectedTests.phpunit'))
+                if not files:
+                    logging.info('No tests are affected by the changes of the branch')
+                    return
+                args.run = True
+
             if args.unittest or args.testcase:
                 args.run = True
 
             if args.run:
-                cmd = []
-                if hasComposer:
-                    cmd.append('vendor/bin/phpunit')
-                else:
-                    cmd.append('phpunit')
+                phpunit = 'vendor/bin/phpunit' if hasComposer else 'phpunit'
+                if args.jobs > 1 or files != None:
+                    if not runner.run(phpunit, junit=os.path.abspath(args.junit) if args.junit else None, files=files):
+                        sys.exit(1)
+                    return
+
+                # The report is also used to record the timings of the tests.
+                junit = os.path.abspath(args.junit) if args.junit else os.path.join(M.get('phpunit_dataroot'), 'junit.xml')
+                if os.path.isfile(junit):
+                    os.remove(junit)
+                cmd = [phpunit, '--log-junit %s' % junit]
                 if args.testcase:
                     cmd.append(args.testcase)
                 elif args.unittest:
                     cmd.append(args.unittest)
                 cmd = ' '.join(cmd)
-                process(cmd, M.get('path'), None, None)
+                result = process(cmd, M.get('path'), None, None, limited=False)
+                runner.record([junit])
+                if result[0] != 0:
+                    sys.exit(1)
         except Exception as e:
             raise e
@@ -22,8 +22,9 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 http://github.com/FMCorz/mdk
 """
 
+import sys
 import logging
-from lib.command import Command
+from lib.command import Command, InstanceExecutor
 
 
 class PurgeCommand(Command):
@@ -53,6 +54,16 @@ class PurgeCommand(Command):
                 'help': 'purge the cache on stable instances'
             }
         ),
+        (
+            ['-j', '--jobs'],
+            {
+                'default': 1,
+                'dest': 'jobs',
+                'help': 'number of instances to purge at the same time',
+                'metavar': 'n',
+                'type': int
+            }
+        ),
         (
             ['-m', '--manual'],
             {
@@ -61,6 +72,14 @@ class PurgeCommand(Command):
                 'help': 'perform a manual deletion of some cache in dataroot before executing the CLI script'
             }
         ),
+        (
+            ['--stream'],
+            {
+                'action': 'store_true',
+                'dest': 'stream',
+                'help': 'print the output of the instances as it comes rather than once they are done'
+            }
+        ),
         (
             ['names'],
             {
@@ -87,16 +106,12 @@ class PurgeCommand(Command):
         if len(Mlist) < 1:
             raise Exception('No instances to work on. Exiting...')
 
-        for M in Mlist:
+        def purge(M):
             logging.info('Purging cache on %s' % (M.get('identifier')))
+            M.purge(manual=args.manual)
+            logging.debug('Cache purged!')
 
-            try:
-                M.purge(manual=args.manual)
-            except Exception as e:
-                logging.error('Could not purge cache: %s' % e)
-            else:
-                logging.debug('Cache purged!')
-
-            logging.info('')
+        errors = InstanceExecutor('purge', jobs=args.jobs, stream=args.stream).run(purge, Mlist, summary=len(Mlist) > 1)
 
-        logging.info('Done.')
+        if errors:
+            sys.exit(1)
@@ -73,6 +73,15 @@ class RebaseCommand(Command):
                     'help': 'to use with --push, also add the diff information to the tracker issue'
                 }
             ),
+            (
+                ['-j', '--jobs'],
+                {
+                    'default': None,
+                    'help': 'number of repositories to fetch at the same time, defaults to the number of CPUs',
+                    'metavar': 'n',
+                    'type': int
+                }
+            ),
             (
                 ['-r', '--remote'],
                 {
@@ -121,12 +130,18 @@ class RebaseCommand(Command):
 
         # Updating cache remotes
         logging.info('Updating cached repositories')
-        self.Wp.updateCachedClones()
+        if not self.Wp.updateCachedClones(jobs=args.jobs):
+            logging.warning('Could not update the cached repositories, the instances may not be up to date')
+
+        # Fetching the instances
+        failed = self.Wp.fetchInstances(Mlist, jobs=args.jobs)
+        logging.info('')
 
         # Loops over instances to rebase
         for M in Mlist:
             logging.info('Working on %s' % (M.get('identifier')))
-            M.git().fetch(self.C.get('upstreamRemote'))
+            if M in failed:
+                logging.warning('Could not fetch %s, the rebase might not be on the latest upstream' % self.C.get('upstreamRemote'))
 
             # Test if currently in a detached branch
             if M.git().currentBranch() == 'HEAD':
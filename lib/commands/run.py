@@ -22,8 +22,9 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 http://github.com/FMCorz/mdk
 """
 
+import sys
 import logging
-from lib.command import Command
+from lib.command import Command, InstanceExecutor
 from lib.scripts import Scripts
 
 
@@ -62,6 +63,24 @@ class RunCommand(Command):
                 'help': 'runs the script on stable instances'
             }
         ),
+        (
+            ['-j', '--jobs'],
+            {
+                'default': 1,
+                'dest': 'jobs',
+                'help': 'number of instances to run the script on at the same time',
+                'metavar': 'n',
+                'type': int
+            }
+        ),
+        (
+            ['--stream'],
+            {
+                'action': 'store_true',
+                'dest': 'stream',
+                'help': 'print the output of the instances as it comes rather than once they are done'
+            }
+        ),
         (
             ['-g', '--arguments'],
             {
@@ -112,14 +131,13 @@ class RunCommand(Command):
         if len(Mlist) < 1:
             raise Exception('No instances to work on. Exiting...')
 
-        for M in Mlist:
+        def run(M):
             logging.info('Running \'%s\' on \'%s\'' % (args.script, M.get('identifier')))
-            try:
-                M.runScript(args.script, stderr=None, stdout=None, arguments=args.arguments)
-            except Exception as e:
-                logging.warning('Error while running the script on %s' % M.get('identifier'))
-                logging.debug(e)
-            else:
-                logging.info('')
-
-        logging.info('Done.')
+            result = M.runScript(args.script, stderr=None, stdout=None, arguments=args.arguments)
+            if result != 0:
+                raise Exception('The script exited with code %s' % result)
+
+        errors = InstanceExecutor('run', jobs=args.jobs, stream=args.stream).run(run, Mlist, summary=len(Mlist) > 1)
+
+        if errors:
+            sys.exit(1)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+from datetime import datetime
+from lib.command import Command
+from lib.timings import Timings
+
+
+class StatsCommand(Command):
+
+    _arguments = [
+        (
+            ['action'],
+            {
+                'help': 'the statistics to display',
+                'metavar': 'action',
+                'sub-commands': {
+                    'tests': (
+                        {
+                            'help': 'timings of the PHPUnit tests and Behat features'
+                        },
+                        [
+                            (
+                                ['-b', '--branch'],
+                                {
+                                    'default': None,
+                                    'help': 'branch to display the timings of, defaults to the one of the instance',
+                                    'metavar': 'branch'
+                                }
+                            ),
+                            (
+                                ['-d', '--details'],
+                                {
+                                    'action': 'store_true',
+                                    'help': 'list the test classes and scenarios rather than the files'
+                                }
+                            ),
+                            (
+                                ['-k', '--kind'],
+                                {
+                                    'choices': ['behat', 'phpunit'],
+                                    'default': 'phpunit',
+                                    'help': 'kind of tests, phpunit or behat. Defaults to phpunit.'
+                                }
+                            ),
+                            (
+                                ['-l', '--limit'],
+                                {
+                                    'default': 20,
+                                    'help': 'number of results to display',
+                                    'metavar': 'number',
+                                    'type': int
+                                }
+                            ),
+                            (
+                                ['-r', '--regressions'],
+                                {
+                                    'action': 'store_true',
+                                    'help': 'list the tests which were slower than usual during their latest run'
+                                }
+                            ),
+                            (
+                                ['-t', '--trend'],
+                                {
+                                    'default': None,
+                                    'help': 'display the latest timings of a test file or feature',
+                                    'metavar': 'path'
+                                }
+                            ),
+                            (
+                                ['name'],
+                                {
+                                    'default': None,
+                                    'help': 'name of the instance',
+                                    'metavar': 'name',
+                                    'nargs': '?'
+                                }
+                            )
+                        ]
+                    )
+                }
+            }
+        )
+    ]
+    _description = 'Display statistics'
+
+    def run(self, args):
+        if args.action == 'tests':
+            self.tests(args)
+
+    def tests(self, args):
+        branch = args.branch
+        if branch == None:
+            M = self.Wp.resolve(args.name)
+            if M:
+                branch = M.get('branch')
+            elif args.name:
+                raise Exception('This is not a Moodle instance')
+
+        timings = Timings()
+
+        if args.trend:
+            trend = timings.getTrend(args.kind, args.trend, branch=branch, limit=args.limit)
+            if not trend:
+                print 'No timings recorded for %s' % args.trend
+            for (created, instance, version, duration, failed) in trend:
+                date = datetime.fromtimestamp(created).strftime('%Y-%m-%d %H:%M')
+                print '{0:<17} {1:<20} {2:<15} {3:>9.2f}s {4}'.format(date, instance, version, duration, 'failed' if failed else '').rstrip()
+
+        elif args.regressions:
+            if branch == None:
+                self.argumentError('The branch is required to find the regressions, use --branch or name an instance.')
+            regressions = timings.getRegressions(args.kind, branch, limit=args.limit)
+            if not regressions:
+                print 'No regressions found'
+            for (item, latest, average) in regressions:
+                print '{0:>9.2f}s {1:>9.2f}s {2:>+6.0%}  {3}'.format(latest, average, latest / average - 1, item)
+
+        else:
+            slowest = timings.getSlowest(args.kind, branch=branch, details=args.details, limit=args.limit)
+            if not slowest:
+                print 'No timings recorded'
+            for (item, name, duration, failed) in slowest:
+                label = '%s: %s' % (item, name) if args.details else item
+                print '{0:>9.2f}s {1} {2}'.format(duration, label, '(failed)' if failed else '').rstrip()
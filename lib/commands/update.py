@@ -24,7 +24,7 @@ http://github.com/FMCorz/mdk
 
 import sys
 import logging
-from lib.command import Command
+from lib.command import Command, InstanceExecutor
 from lib.exceptions import UpgradeNotAllowed
 
 
@@ -54,6 +54,15 @@ class UpdateCommand(Command):
                 'help': 'update integration instances'
             }
         ),
+        (
+            ['-j', '--jobs'],
+            {
+                'default': 1,
+                'help': 'number of instances to update at the same time. The instances are all fetched in the background, as many at the same time as the setting maxProcesses allows',
+                'metavar': 'n',
+                'type': int
+            }
+        ),
         (
             ['-s', '--stable'],
             {
@@ -62,6 +71,14 @@ class UpdateCommand(Command):
                 'help': 'update stable instances'
             }
         ),
+        (
+            ['--stream'],
+            {
+                'action': 'store_true',
+                'dest': 'stream',
+                'help': 'print the output of the instances as it comes rather than once they are done'
+            }
+        ),
         (
             ['-u', '--upgrade'],
             {
@@ -85,7 +102,8 @@ class UpdateCommand(Command):
     def run(self, args):
 
         if args.cached:
-            self.updateCached()
+            if not self.updateCached():
+                sys.exit(1)
             return
 
         # Updating instances
@@ -99,41 +117,44 @@ class UpdateCommand(Command):
         if len(Mlist) < 1:
             raise Exception('No instances to work on. Exiting...')
 
-        self.updateCached()
+        if not self.updateCached():
+            logging.warning('Could not update the cached repositories, the instances may not be up to date')
 
-        errors = []
+        # All the instances are fetched in the background, each of them is updated and upgraded as soon
+        # as its own fetch has completed, while the others are still being fetched.
+        remote = self.C.get('upstreamRemote')
+        logging.info('Fetching %s in %d instances...' % (remote, len(Mlist)))
+        fetches = [(M, M.git().fetchAsync(remote)) for M in Mlist]
+        logging.info('')
 
-        for M in Mlist:
-            logging.info('Updating %s...' % M.get('identifier'))
+        fetches = dict(fetches)
+
+        def update(M):
             try:
-                M.update()
+                result = fetches[M].result()
             except Exception as e:
-                errors.append(M)
-                logging.warning('Error during the update of %s' % M.get('identifier'))
-                logging.debug(e)
-            else:
-                if args.upgrade:
-                    try:
-                        M.upgrade()
-                    except UpgradeNotAllowed as e:
-                        logging.info('Skipping upgrade of %s (not allowed)' % (M.get('identifier')))
-                        logging.debug(e)
-                    except Exception as e:
-                        errors.append(M)
-                        logging.warning('Error during the upgrade of %s' % M.get('identifier'))
-                        pass
-            logging.info('')
-        logging.info('Done.')
-
-        if errors and len(Mlist) > 1:
-            logging.info('')
-            logging.warning('/!\ Some errors occurred on the following instances:')
-            for M in errors:
-                logging.warning('- %s' % M.get('identifier'))
+                result = (1, '', str(e))
+            if result[0] != 0:
+                logging.debug(result[2])
+                raise Exception('Skipping update of %s, the fetch failed' % M.get('identifier'))
+
+            logging.info('Updating %s...' % M.get('identifier'))
+            M.update(fetch=False)
+
+            if args.upgrade:
+                try:
+                    M.upgrade()
+                except UpgradeNotAllowed as e:
+                    logging.info('Skipping upgrade of %s (not allowed)' % (M.get('identifier')))
+                    logging.debug(e)
+
+        errors = InstanceExecutor('update', jobs=args.jobs, stream=args.stream).run(update, Mlist, summary=len(Mlist) > 1)
+
+        if errors:
             # Remove sys.exit and handle error code
             sys.exit(1)
 
     def updateCached(self):
         # Updating cache
         print 'Updating cached repositories'
-        self.Wp.updateCachedClones(verbose=False)
+        return self.Wp.updateCachedClones(verbose=False)
@@ -24,7 +24,7 @@ http://github.com/FMCorz/mdk
 
 import sys
 import logging
-from lib.command import Command
+from lib.command import Command, InstanceExecutor
 from lib.exceptions import UpgradeNotAllowed
 
 class UpgradeCommand(Command):
@@ -38,6 +38,14 @@ class UpgradeCommand(Command):
                 'help': 'upgrade each instance'
             }
         ),
+        (
+            ['-f', '--force'],
+            {
+                'action': 'store_true',
+                'dest': 'force',
+                'help': 'run the upgrade script even when the versions have not changed'
+            }
+        ),
         (
             ['-i', '--integration'],
             {
@@ -54,6 +62,16 @@ class UpgradeCommand(Command):
                 'help': 'upgrade stable instances'
             }
         ),
+        (
+            ['-j', '--jobs'],
+            {
+                'default': 1,
+                'dest': 'jobs',
+                'help': 'number of instances to upgrade at the same time',
+                'metavar': 'n',
+                'type': int
+            }
+        ),
         (
             ['-n', '--no-checkout'],
             {
@@ -62,6 +80,14 @@ class UpgradeCommand(Command):
                 'help': 'do not checkout the stable branch before upgrading'
             }
         ),
+        (
+            ['--stream'],
+            {
+                'action': 'store_true',
+                'dest': 'stream',
+                'help': 'print the output of the instances as it comes rather than once they are done'
+            }
+        ),
         (
             ['-u', '--update'],
             {
@@ -97,38 +123,23 @@ class UpgradeCommand(Command):
         # Updating cache if required
         if args.update:
             print 'Updating cached repositories'
-            self.Wp.updateCachedClones(verbose=False)
-
-        errors = []
+            if not self.Wp.updateCachedClones(verbose=False):
+                logging.warning('Could not update the cached repositories, the instances may not be up to date')
 
-        for M in Mlist:
+        def upgrade(M):
             if args.update:
                 logging.info('Updating %s...' % M.get('identifier'))
-                try:
-                    M.update()
-                except Exception as e:
-                    errors.append(M)
-                    logging.warning('Error during update. Skipping...')
-                    logging.debug(e)
-                    continue
-            logging.info('Upgrading %s...' % M.get('identifier'))
+                M.update()
 
+            logging.info('Upgrading %s...' % M.get('identifier'))
             try:
-                M.upgrade(args.nocheckout)
+                M.upgrade(args.nocheckout, force=args.force)
             except UpgradeNotAllowed as e:
                 logging.info('Skipping upgrade of %s (not allowed)' % (M.get('identifier')))
                 logging.debug(e)
-            except Exception as e:
-                errors.append(M)
-                logging.warning('Error during the upgrade of %s' % M.get('identifier'))
-                logging.debug(e)
-            logging.info('')
-        logging.info('Done.')
-
-        if errors and len(Mlist) > 1:
-            logging.info('')
-            logging.warning('/!\ Some errors occurred on the following instances:')
-            for M in errors:
-                logging.warning('- %s' % M.get('identifier'))
+
+        errors = InstanceExecutor('upgrade', jobs=args.jobs, stream=args.stream).run(upgrade, Mlist, summary=len(Mlist) > 1)
+
+        if errors:
             # TODO Do not use sys.exit() but handle error code
             sys.exit(1)
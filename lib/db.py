@@ -110,6 +110,42 @@ class DB(object):
 
         return columns
 
+    def commit(self):
+        self.conn.commit()
+
+    def copydb(self, source, target):
+        """Create the database target as a copy of source"""
+
+        if self.engine == 'pgsql':
+            try:
+                # Disable transaction on PostgreSQL.
+                old_isolation_level = self.conn.isolation_level
+                self.conn.set_isolation_level(0)
+            except:
+                pass
+
+            # The copy is made by the server, file by file.
+            sql = 'CREATE DATABASE "%s" WITH TEMPLATE "%s"' % (target, source)
+            logging.debug(sql)
+            self.cur.execute(sql)
+
+            try:
+                self.conn.set_isolation_level(old_isolation_level)
+            except:
+                pass
+
+        elif self.engine == 'mysqli':
+            # The rows are copied by the server, they are not transferred to us.
+            self.createdb(target)
+            self.cur.execute('SHOW TABLES FROM `%s`' % source)
+            for row in self.cur.fetchall():
+                table = row[0]
+                for sql in ['CREATE TABLE `%s`.`%s` LIKE `%s`.`%s`' % (target, table, source, table),
+                        'INSERT INTO `%s`.`%s` SELECT * FROM `%s`.`%s`' % (target, table, source, table)]:
+                    logging.debug(sql)
+                    self.cur.execute(sql)
+            self.conn.commit()
+
     def createdb(self, db):
 
         try:
@@ -203,8 +239,11 @@ class DB(object):
                 insert = 'INSERT INTO %s (%s) VALUES(%s)' % (table, ','.join(columns), ','.join(values))
                 fd.write(insert + ';\n')
 
-    def execute(self, query):
-        self.cur.execute(query)
+    def execute(self, query, params=None):
+        if params != None:
+            self.cur.execute(query, params)
+        else:
+            self.cur.execute(query)
         # TODO: force transaction to be executed?
 
     def selectdb(self, db):
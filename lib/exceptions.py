@@ -63,6 +63,14 @@ class InstallException(Exception):
     pass
 
 
+class LockTimeout(Exception):
+    pass
+
+
+class ProcessTimeout(Exception):
+    pass
+
+
 class ScriptNotFound(Exception):
     pass
 
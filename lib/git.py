@@ -22,32 +22,127 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 http://github.com/FMCorz/mdk
 """
 
+import atexit
+import copy
+import functools
 import logging
+import os
 import re
 import shlex
+import shutil
 import subprocess
+import tempfile
+import threading
+from tools import process, processAsync, which
+
+# Paths of the repositories which have already been validated.
+_repositories = set()
+
+# Long-lived workers, indexed by binary and repository path.
+_workers = {}
+_workersLock = threading.Lock()
+
+# Versions of the git binaries, indexed by binary.
+_versions = {}
+
+
+class GitCache(object):
+    """Per-process cache of the results of the read-only queries made on the repositories"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, key):
+        """Returns a tuple (found, value)"""
+        with self._lock:
+            entries = self._data.get(path, {})
+            if key in entries:
+                self.hits += 1
+                return (True, copy.deepcopy(entries[key]))
+            self.misses += 1
+            return (False, None)
+
+    def invalidate(self, path=None):
+        """Forgets about the results of a repository, or of all of them"""
+        with self._lock:
+            if path == None:
+                self._data = {}
+            else:
+                self._data.pop(path, None)
+
+    def report(self):
+        """Logs the hits and misses"""
+        if self.hits or self.misses:
+            logging.debug('Git query cache: %d hits, %d misses' % (self.hits, self.misses))
+
+    def set(self, path, key, value):
+        with self._lock:
+            self._data.setdefault(path, {})[key] = copy.deepcopy(value)
+
+_cache = GitCache()
+atexit.register(_cache.report)
+
+
+def cached(func):
+    """Decorator caching the result of a read-only query until the repository is modified"""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        (found, value) = _cache.get(self.getPath(), key)
+        if found:
+            return value
+        value = func(self, *args, **kwargs)
+        _cache.set(self.getPath(), key, value)
+        return value
+    return wrapper
+
+
+def mutating(func):
+    """Decorator for the methods modifying the repository, the cached results are invalidated"""
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            _cache.invalidate(self.getPath())
+    return wrapper
 
 
 class Git(object):
 
     _path = None
     _bin = None
+    _persistent = True
+    _reader = False
 
-    def __init__(self, path, bin='/usr/bin/git'):
+    def __init__(self, path, bin='/usr/bin/git', persistent=True):
         self.setPath(path)
         self.setBin(bin)
+        self._persistent = persistent
 
+    @mutating
     def add(self, path):
         """Add a file/path"""
         cmd = 'add %s' % (path)
         result = self.execute(cmd)
         return result[0] == 0
 
+    @mutating
     def addRemote(self, name, remote):
         cmd = 'remote add %s %s' % (name, remote)
         result = self.execute(cmd)
         return result[0] == 0
 
+    @mutating
+    def addWorktree(self, path, ref):
+        """Check out ref in a new working tree at path, the HEAD of the working tree is detached"""
+        result = self.execute('worktree add --detach %s %s' % (path, ref))
+        return result[0] == 0
+
+    @mutating
     def apply(self, files):
         if type(files) == list:
             files = ' '.join(files)
@@ -59,6 +154,17 @@ class Git(object):
         result = self.execute(cmd)
         return result[0] == 0
 
+    def changedFiles(self, ref):
+        """Returns the files changed since ref, the uncommitted and untracked files included"""
+        files = []
+        for cmd in ['diff --name-only %s' % ref, 'ls-files --others --exclude-standard']:
+            (returncode, stdout, stderr) = self.execute(cmd)
+            if returncode != 0:
+                raise GitException('Error while listing the changed files. Command: %s' % (cmd))
+            files += [f for f in stdout.split('\n') if f and f not in files]
+        return files
+
+    @mutating
     def checkout(self, branch):
         if self.currentBranch == branch:
             return True
@@ -66,6 +172,7 @@ class Git(object):
         result = self.execute(cmd)
         return result[0] == 0
 
+    @mutating
     def commit(self, filepath=None):
         """Wrapper for the commit command"""
         cmd = 'commit'
@@ -82,6 +189,19 @@ class Git(object):
         else:
             return False
 
+    def countObjects(self):
+        """Return the statistics of count-objects, the sizes are in KiB"""
+        result = self.execute('count-objects -v')
+        stats = {}
+        for line in result[1].split('\n'):
+            try:
+                (key, value) = line.split(':', 1)
+                stats[key.strip()] = int(value.strip())
+            except ValueError:
+                continue
+        return stats
+
+    @mutating
     def createBranch(self, branch, track=None):
         if track != None:
             cmd = 'branch --track %s %s' % (branch, track)
@@ -93,17 +213,30 @@ class Git(object):
 
     def createPatch(self, ref, saveTo=None):
         cmd = 'format-patch %s --stdout' % (ref)
+        if saveTo != None:
+            # The patch is written directly to the file rather than held in memory.
+            with open(saveTo, 'w') as f:
+                result = self.execute(cmd, stdout=f)
+            if result[0] != 0:
+                os.remove(saveTo)
+                return False
+            return True
+
         result = self.execute(cmd)
         if result[0] != 0:
             return False
-        elif saveTo != None:
-            with open(saveTo, 'w') as f:
-                f.write(result[1])
-                return True
-            return False
         return result[1]
 
+    @cached
     def currentBranch(self):
+        reader = self.reader()
+        if reader:
+            try:
+                branch = reader.currentBranch()
+                return 'HEAD' if branch == None else branch.replace('refs/heads/', '')
+            except (GitReaderException, IOError, OSError) as e:
+                logging.debug(e)
+
         cmd = 'symbolic-ref -q HEAD'
         result = self.execute(cmd)
         if result[0] != 0:
@@ -111,37 +244,87 @@ class Git(object):
         else:
             return result[1].replace('refs/heads/', '').strip()
 
+    @mutating
     def delRemote(self, remote):
         cmd = 'remote rm %s' % remote
         result = self.execute(cmd)
         return result[0] == 0
 
-    def execute(self, cmd, path=None):
+    def execute(self, cmd, path=None, stdout=subprocess.PIPE, timeout=None):
+        """Execute a git command, stdout can be a file to write the output to instead of returning it"""
+        if path == None:
+            path = self.getPath()
+        return process(self._command(cmd, path), cwd=path, stdout=stdout, timeout=timeout)
+
+    def executeAsync(self, cmd, path=None, timeout=None):
+        """Execute a git command in the background, returns a ProcessFuture"""
         if path == None:
             path = self.getPath()
+        return processAsync(self._command(cmd, path), cwd=path, timeout=timeout)
 
+    def _command(self, cmd, path):
+        """Return the full command as a list, after making sure that path is a repository"""
         if not self.isRepository(path):
             raise Exception('This is not a Git repository')
 
         if not type(cmd) == 'list':
             cmd = shlex.split(str(cmd))
         cmd.insert(0, self.getBin())
+        return cmd
 
-        logging.debug(' '.join(cmd))
+    @mutating
+    def expireReflog(self, expire=None):
+        """Expire the old entries of the reflogs, git defaults apply when expire is not set"""
+        cmd = 'reflog expire --all'
+        if expire:
+            cmd += ' --expire=%s' % expire
+        result = self.execute(cmd)
+        return result[0] == 0
 
-        proc = subprocess.Popen(cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=path
-        )
-        (stdout, stderr) = proc.communicate()
-        return (proc.returncode, stdout, stderr)
+    @mutating
+    def fetch(self, remote='', ref='', tags=True, timeout=None):
+        return self.execute(self._fetchCommand(remote, ref, tags), timeout=timeout)
+
+    def fetchAsync(self, remote='', ref='', tags=True, timeout=None):
+        """Fetch in the background, returns a ProcessFuture"""
+        path = self.getPath()
+        future = self.executeAsync(self._fetchCommand(remote, ref, tags), timeout=timeout)
+        future.addDoneCallback(lambda f: _cache.invalidate(path))
+        return future
 
-    def fetch(self, remote='', ref=''):
+    def _fetchCommand(self, remote='', ref='', tags=True):
         cmd = 'fetch %s %s' % (remote, ref)
-        return self.execute(cmd)
+        if not tags:
+            cmd = 'fetch --no-tags %s %s' % (remote, ref)
+        return cmd
 
+    @cached
+    def getAlternates(self):
+        """Return the list of object directories this repository borrows objects from"""
+        path = os.path.join(self.gitDir(), 'objects', 'info', 'alternates')
+        if not os.path.isfile(path):
+            return []
+        alternates = []
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if not os.path.isabs(line):
+                    line = os.path.normpath(os.path.join(self.gitDir(), 'objects', line))
+                alternates.append(line)
+        return alternates
+
+    @cached
     def getConfig(self, name):
+        reader = self.reader()
+        if reader:
+            try:
+                value = reader.getConfig(name)
+                return value.strip() if value != None else None
+            except (GitReaderException, IOError, OSError) as e:
+                logging.debug(e)
+
         cmd = 'config --get %s' % name
         result = self.execute(cmd)
         if result[0] == 0:
@@ -153,8 +336,16 @@ class Git(object):
         remotes = self.getRemotes()
         return remotes.get(remote, None)
 
+    @cached
     def getRemotes(self):
         """Return the remotes"""
+        reader = self.reader()
+        if reader:
+            try:
+                return reader.getRemotes()
+            except (GitReaderException, IOError, OSError) as e:
+                logging.debug(e)
+
         cmd = 'remote -v'
         result = self.execute(cmd)
         remotes = None
@@ -167,34 +358,88 @@ class Git(object):
                 remotes[remote] = repo
         return remotes
 
+    @cached
+    def gitDir(self):
+        """Return the absolute path to the git directory"""
+        reader = self.reader()
+        if reader:
+            return os.path.abspath(reader.gitdir)
+        result = self.execute('rev-parse --git-dir')
+        if result[0] != 0:
+            raise GitException('Could not resolve the git directory of %s' % self.getPath())
+        return os.path.abspath(os.path.join(self.getPath(), result[1].strip()))
+
+    @cached
     def hasBranch(self, branch, remote=''):
         if remote != '':
-            cmd = 'show-ref --verify --quiet "refs/remotes/%s/%s"' % (remote, branch)
+            ref = 'refs/remotes/%s/%s' % (remote, branch)
         else:
-            cmd = 'show-ref --verify --quiet "refs/heads/%s"' % branch
+            ref = 'refs/heads/%s' % branch
+
+        reader = self.reader()
+        if reader:
+            try:
+                return reader.resolve(ref) != None
+            except (GitReaderException, IOError, OSError) as e:
+                logging.debug(e)
+
+        worker = self.worker()
+        if worker:
+            try:
+                return worker.resolve(ref) != None
+            except GitWorkerException as e:
+                logging.debug(e)
+
+        cmd = 'show-ref --verify --quiet "%s"' % ref
         (returncode, stdout, stderr) = self.execute(cmd)
         return returncode == 0
 
     def hashes(self, ref='', format='%H', limit=30, before=None):
         """Returns the latest hashes from git log"""
-        hashlist = self.log(count=limit, format=format, since=ref, before=before)
-        return hashlist.split('\n')[:-1]
+        return list(self.iterLog(count=limit, format=format, since=ref, before=before))
 
     def isRepository(self, path=None):
+        """Checks whether the path is a repository, positive results are cached"""
         if path == None:
             path = self.getPath()
 
-        cmd = shlex.split(str('%s log -1') % self.getBin())
+        if path in _repositories:
+            return True
+
+        cmd = shlex.split(str('%s rev-parse --git-dir') % self.getBin())
         proc = subprocess.Popen(cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             cwd=path
         )
         proc.wait()
-        return proc.returncode == 0
+        if proc.returncode == 0:
+            _repositories.add(path)
+            return True
+        return False
+
+    def iterLog(self, count=10, since=None, path=None, format=None, before=None):
+        """Calls the log command and yields its output line by line, as git produces it
+
+        Stopping the iteration early terminates git, this is cheaper than log() when
+        only the first commits are of interest.
+        """
+        cmd = self._logCommand(count=count, since=since, path=path, format=format, before=before)
+        for line in self.stream(cmd):
+            yield line
 
+    @cached
     def log(self, count=10, since=None, path=None, format=None, before=None):
         """Calls the log command and returns the raw output"""
+        cmd = self._logCommand(count=count, since=since, path=path, format=format, before=before)
+        (returncode, stdout, stderr) = self.execute(cmd)
+        if returncode != 0:
+            raise GitException('Error calling git log. Command: %s' % (cmd))
+
+        return stdout
+
+    def _logCommand(self, count=10, since=None, path=None, format=None, before=None):
+        """Build the log command"""
         cmd = 'log'
         if count != None and count != 0:
             cmd += ' -n %d ' % (int(count))
@@ -206,18 +451,13 @@ class Git(object):
             cmd += ' -- %s' % (path)
         if before != None:
             cmd += ' --before=%s ' % (before)
-
-        (returncode, stdout, stderr) = self.execute(cmd)
-        if returncode != 0:
-            raise GitException('Error calling git log. Command: %s' % (cmd))
-
-        return stdout
+        return cmd
 
     def messages(self, count=10, since=None, path=None):
         """Return the latest titles of the commit messages"""
-        messages = self.log(count=count, since=since, path=path, format='%s')
-        return messages.split('\n')[:-1]
+        return list(self.iterLog(count=count, since=since, path=path, format='%s'))
 
+    @mutating
     def pick(self, refs=None, abort=None, continu=None):
         """Wrapper for the cherry-pick command
 
@@ -235,10 +475,22 @@ class Git(object):
         cmd = 'cherry-pick %s' % (args)
         return self.execute(cmd)
 
+    @mutating
+    def prune(self, expire='2.weeks.ago', packed=False):
+        """Remove the unreachable loose objects, or only the loose objects already packed"""
+        if packed:
+            cmd = 'prune-packed'
+        else:
+            cmd = 'prune --expire=%s' % expire
+        result = self.execute(cmd)
+        return result[0] == 0
+
+    @mutating
     def pull(self, remote='', ref=''):
         cmd = 'pull %s %s' % (remote, ref)
         return self.execute(cmd)
 
+    @mutating
     def push(self, remote='', branch='', force=None):
         if force:
             force = '--force '
@@ -247,6 +499,7 @@ class Git(object):
         cmd = 'push %s%s %s' % (force, remote, branch)
         return self.execute(cmd)
 
+    @mutating
     def rebase(self, base=None, branch=None, abort=False):
         cmd = None
         if abort:
@@ -260,26 +513,71 @@ class Git(object):
 
     def remoteBranches(self, remote):
         pattern = 'refs/remotes/%s' % remote
-        cmd = 'show-ref'
-
-        result = self.execute(cmd)
-        if result[0] != 0:
-            return []
-
         refs = []
-        for ref in result[1].split('\n'):
-            try:
-                (hash, ref) = ref.split(' ', 1)
-            except ValueError:
-                continue
-            if not ref.startswith(pattern):
-                continue
+        for (hash, ref) in self.refs(pattern):
             ref = ref.replace(pattern, '').strip('/')
             if ref == 'HEAD':
                 continue
             refs.append([hash, ref])
         return refs
 
+    def reader(self):
+        """Returns the reader of the files of this repository, or None when its layout is not standard"""
+        if self._reader == False:
+            self._reader = GitReader.find(self.getPath(), self.getBin())
+        return self._reader
+
+    @cached
+    def refs(self, prefix):
+        """Return the references under prefix, sorted by name, as a list of [hash, ref]"""
+        reader = self.reader()
+        if reader:
+            try:
+                return [[objectHash, refName] for (objectHash, refName) in reader.refs(prefix)]
+            except (GitReaderException, IOError, OSError) as e:
+                logging.debug(e)
+
+        cmd = 'for-each-ref --format="%%(objectname) %%(refname)" %s' % prefix
+        refs = []
+        try:
+            for line in self.stream(cmd):
+                try:
+                    (hash, ref) = line.split(' ', 1)
+                except ValueError:
+                    continue
+                refs.append([hash, ref])
+        except GitException as e:
+            logging.debug(e)
+            return []
+        return refs
+
+    @mutating
+    def removeWorktree(self, path):
+        """Remove a working tree created by addWorktree"""
+        result = self.execute('worktree remove --force %s' % path)
+        if result[0] != 0:
+            # Older versions of git do not support worktree remove.
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            result = self.execute('worktree prune')
+        return result[0] == 0
+
+    @mutating
+    def repack(self, all=False, delete=False, local=False, geometric=None):
+        """Wrapper for the repack command"""
+        cmd = 'repack'
+        if all:
+            cmd += ' -a'
+        if delete:
+            cmd += ' -d'
+        if local:
+            cmd += ' -l'
+        if geometric:
+            cmd += ' --geometric=%d' % geometric
+        result = self.execute(cmd)
+        return result[0] == 0
+
+    @mutating
     def reset(self, to, hard=False):
         mode = ''
         if hard:
@@ -288,11 +586,26 @@ class Git(object):
         result = self.execute(cmd)
         return result[0] == 0
 
+    @mutating
+    def setAlternates(self, alternates):
+        """Set the list of object directories this repository borrows objects from"""
+        path = os.path.join(self.gitDir(), 'objects', 'info', 'alternates')
+        if not alternates:
+            if os.path.isfile(path):
+                os.remove(path)
+            return True
+        with open(path, 'w') as f:
+            for alternate in alternates:
+                f.write(os.path.abspath(alternate) + '\n')
+        return True
+
+    @mutating
     def setConfig(self, name, value):
         cmd = 'config %s %s' % (name, value)
         result = self.execute(cmd)
         return result[0] == 0
 
+    @mutating
     def setRemote(self, remote, url):
         if not self.getRemote(remote):
             cmd = 'remote add %s %s' % (remote, url)
@@ -301,27 +614,632 @@ class Git(object):
         result = self.execute(cmd)
         return result[0] == 0
 
+    @mutating
+    def setRemoteRefspecs(self, remote, refspecs):
+        """Replace the fetch refspecs of a remote"""
+        self.execute('config --unset-all remote.%s.fetch' % remote)
+        for refspec in refspecs:
+            result = self.execute('config --add remote.%s.fetch %s' % (remote, refspec))
+            if result[0] != 0:
+                return False
+        return True
+
+    @mutating
     def stash(self, command='save', untracked=False):
         cmd = 'stash %s' % command
         if untracked:
             cmd += ' --include-untracked'
         return self.execute(cmd)
 
+    def stream(self, cmd, path=None):
+        """Execute a git command and yield its output line by line, without the line endings
+
+        The output is never held in memory as a whole. GitException is raised once the output
+        is exhausted when the command failed. Stopping the iteration early terminates git.
+        """
+        if path == None:
+            path = self.getPath()
+        cmd = self._command(cmd, path)
+
+        logging.debug(' '.join(cmd))
+
+        # The errors go to a file, a pipe could fill up and block git while we read its output.
+        stderr = tempfile.TemporaryFile()
+        proc = subprocess.Popen(cmd,
+            stdout=subprocess.PIPE,
+            stderr=stderr,
+            cwd=path
+        )
+        try:
+            for line in iter(proc.stdout.readline, ''):
+                yield line.rstrip('\n')
+            proc.stdout.close()
+            if proc.wait() != 0:
+                stderr.seek(0)
+                raise GitException('Error calling git %s: %s' % (' '.join(cmd[1:]), stderr.read().strip()))
+        finally:
+            if proc.poll() == None:
+                proc.stdout.close()
+                proc.kill()
+                proc.wait()
+            stderr.close()
+
     def status(self):
         return self.execute('status')
 
+    @mutating
+    def updateRef(self, ref, value):
+        """Point the reference ref to value, without touching the working tree"""
+        result = self.execute('update-ref %s %s' % (ref, value))
+        return result[0] == 0
+
+    def version(self):
+        """Return the version of the git binary as a tuple of integers"""
+        bin = self.getBin()
+        if bin not in _versions:
+            proc = subprocess.Popen([bin, '--version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            (stdout, stderr) = proc.communicate()
+            match = re.search(r'(\d+)\.(\d+)(?:\.(\d+))?', stdout)
+            _versions[bin] = tuple([int(x or 0) for x in match.groups()]) if match else (0, 0, 0)
+        return _versions[bin]
+
+    def worker(self):
+        """Returns the long-lived worker of this repository, or None when it cannot be used"""
+        if not self._persistent:
+            return None
+
+        path = self.getPath()
+        if not self.isRepository(path):
+            raise Exception('This is not a Git repository')
+
+        key = (self.getBin(), path)
+        with _workersLock:
+            worker = _workers.get(key)
+            if worker == None or not worker.isAlive():
+                try:
+                    worker = GitWorker(path, self.getBin())
+                except OSError as e:
+                    logging.debug('Could not start git worker in %s: %s' % (path, e))
+                    self._persistent = False
+                    return None
+                _workers[key] = worker
+        return worker
+
+    @mutating
+    def writeCommitGraph(self, split=True, changedPaths=False):
+        """Write the commit-graph of the reachable commits"""
+        cmd = 'commit-graph write --reachable'
+        if split:
+            cmd += ' --split'
+        if changedPaths:
+            cmd += ' --changed-paths'
+        result = self.execute(cmd)
+        return result[0] == 0
+
+    @mutating
+    def writeMultiPackIndex(self):
+        """Write the multi-pack-index of the packs"""
+        result = self.execute('multi-pack-index write')
+        return result[0] == 0
+
     def getBin(self):
         return self._bin
 
     def setBin(self, bin):
         self._bin = str(bin)
+        self._reader = False
 
     def getPath(self):
         return self._path
 
     def setPath(self, path):
         self._path = str(path)
+        self._reader = False
+
+
+class GitReader(object):
+    """Reads references and configuration straight from the files of a repository
+
+    This only supports the standard layout of a repository (a .git directory, or
+    a bare repository) with the files backend for the references. Whenever something
+    is found which is not supported a GitReaderException is raised, the caller is then
+    expected to fallback on the git command line.
+    """
+
+    # Environment variables changing the behaviour of git which we do not support.
+    _unsupportedEnv = ['GIT_DIR', 'GIT_COMMON_DIR', 'GIT_CONFIG', 'GIT_CONFIG_COUNT', 'GIT_CONFIG_GLOBAL',
+        'GIT_CONFIG_NOSYSTEM', 'GIT_CONFIG_PARAMETERS', 'GIT_CONFIG_SYSTEM', 'GIT_NAMESPACE']
+
+    _reConfigSection = re.compile(r'^\[\s*([a-zA-Z0-9.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+    _reConfigKey = re.compile(r'^([a-zA-Z][a-zA-Z0-9-]*)\s*(=|$|[;#])')
+
+    def __init__(self, gitdir, bin='/usr/bin/git'):
+        self.gitdir = gitdir
+        self.bin = bin
+        self._files = {}
+
+    @classmethod
+    def find(cls, path, bin='/usr/bin/git'):
+        """Returns a reader for the repository in path, or None when its layout is not standard"""
+        for env in cls._unsupportedEnv:
+            if env in os.environ:
+                return None
+
+        gitdir = os.path.join(path, '.git')
+        if not os.path.isdir(gitdir):
+            gitdir = path
+
+        # Linked worktrees and repositories without the usual files are left to git.
+        for f in ['HEAD', 'config']:
+            if not os.path.isfile(os.path.join(gitdir, f)):
+                return None
+        for d in ['objects', 'refs']:
+            if not os.path.isdir(os.path.join(gitdir, d)):
+                return None
+        if os.path.exists(os.path.join(gitdir, 'commondir')):
+            return None
+
+        return cls(gitdir, bin)
+
+    def _read(self, path, parser):
+        """Returns the result of parser on the file, the result is cached until the file changes"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._files.pop(path, None)
+            return None
+        signature = (stat.st_ino, stat.st_size, stat.st_mtime)
+        cached = self._files.get(path)
+        if cached and cached[0] == signature:
+            return cached[1]
+        with open(path, 'r') as f:
+            content = f.read()
+        result = parser(path, content)
+        self._files[path] = (signature, result)
+        return result
+
+    # References.
+
+    def _parsePackedRefs(self, path, content):
+        refs = {}
+        for line in content.split('\n'):
+            if not line or line.startswith('#') or line.startswith('^'):
+                continue
+            try:
+                (sha, ref) = line.split(' ', 1)
+            except ValueError:
+                continue
+            refs[ref] = sha
+        return refs
+
+    def _packedRefs(self):
+        return self._read(os.path.join(self.gitdir, 'packed-refs'), self._parsePackedRefs) or {}
+
+    def _rawRef(self, ref):
+        """Returns the raw value of a reference, the target of a symbolic one starts with 'ref: '"""
+        loose = os.path.join(self.gitdir, ref)
+        if os.path.isfile(loose):
+            with open(loose, 'r') as f:
+                return f.read().strip()
+        elif os.path.isdir(loose):
+            return None
+        return self._packedRefs().get(ref)
+
+    def currentBranch(self):
+        """Same as `git symbolic-ref -q HEAD`, returns None when HEAD is detached"""
+        value = self._rawRef('HEAD')
+        if value == None or not value.startswith('ref:'):
+            return None
+        return value[4:].strip()
+
+    def refs(self, prefix):
+        """Returns the references under prefix, sorted by name, as a list of (hash, name)"""
+        prefix = prefix.rstrip('/') + '/'
+        names = set()
+        for ref in self._packedRefs().keys():
+            if ref.startswith(prefix):
+                names.add(ref)
+
+        top = os.path.join(self.gitdir, prefix)
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            for f in filenames:
+                if f.endswith('.lock'):
+                    continue
+                names.add(os.path.relpath(os.path.join(dirpath, f), self.gitdir).replace(os.sep, '/'))
+
+        refs = []
+        for name in sorted(names):
+            sha = self.resolve(name)
+            if sha == None:
+                # Broken references are ignored by git too.
+                continue
+            refs.append((sha, name))
+        return refs
+
+    def resolve(self, ref):
+        """Returns the hash a reference points to, following symbolic references"""
+        for i in range(5):
+            value = self._rawRef(ref)
+            if value == None:
+                return None
+            elif not value.startswith('ref:'):
+                if not re.match(r'^[0-9a-f]{40}$', value):
+                    raise GitReaderException('Unexpected value for reference %s' % ref)
+                return value
+            ref = value[4:].strip()
+        raise GitReaderException('Too many levels of symbolic references')
+
+    # Configuration.
+
+    def _systemConfigFile(self):
+        """Path to the system config file, as defined when git is compiled with the default options"""
+        path = which(self.bin)
+        if path == None:
+            raise GitReaderException('Could not find the executable %s' % self.bin)
+        prefix = os.path.dirname(os.path.dirname(os.path.realpath(path)))
+        if prefix == '/usr':
+            return '/etc/gitconfig'
+        return os.path.join(prefix, 'etc', 'gitconfig')
+
+    def _parseConfig(self, path, content):
+        """Parses a config file into a list of (section, subsection, key, value)
+
+        The sections and keys are lowercased, the subsection is kept as is, and
+        a key without value has the value None.
+        """
+        entries = []
+        section = None
+        subsection = None
+        lines = content.replace('\r\n', '\n').split('\n')
+        i = 0
+        while i < len(lines):
+            line = lines[i].lstrip()
+            i += 1
+
+            if line.startswith('['):
+                match = self._reConfigSection.match(line)
+                if not match:
+                    raise GitReaderException('Could not parse section in %s' % path)
+                section = match.group(1).lower()
+                subsection = None
+                if match.group(2) != None:
+                    subsection = re.sub(r'\\(.)', r'\1', match.group(2))
+                elif '.' in section:
+                    # Deprecated syntax [section.subsection].
+                    (section, subsection) = section.split('.', 1)
+                line = line[match.end():].lstrip()
+
+            if not line or line[0] in '#;':
+                continue
+            elif section == None:
+                raise GitReaderException('Key outside of a section in %s' % path)
+
+            match = self._reConfigKey.match(line)
+            if not match:
+                raise GitReaderException('Could not parse line in %s' % path)
+            key = match.group(1).lower()
+            if match.group(2) != '=':
+                entries.append((section, subsection, key, None))
+                continue
+
+            # Parse the value, it can span over multiple lines.
+            value = ''
+            pending = 0
+            quote = False
+            rest = line[match.end():]
+            j = 0
+            while True:
+                if j >= len(rest):
+                    if quote:
+                        raise GitReaderException('Unterminated quote in %s' % path)
+                    break
+                c = rest[j]
+                j += 1
+                if c == '\\':
+                    if j >= len(rest):
+                        # Line continuation.
+                        if i >= len(lines):
+                            break
+                        rest = lines[i]
+                        i += 1
+                        j = 0
+                        continue
+                    c = rest[j]
+                    j += 1
+                    escapes = {'n': '\n', 't': '\t', 'b': '\b', '"': '"', '\\': '\\'}
+                    if c not in escapes:
+                        raise GitReaderException('Invalid escape sequence in %s' % path)
+                    value += ' ' * pending + escapes[c]
+                    pending = 0
+                elif c == '"':
+                    value += ' ' * pending
+                    pending = 0
+                    quote = not quote
+                elif not quote and c in '#;':
+                    break
+                elif not quote and c.isspace():
+                    if value:
+                        pending += 1
+                else:
+                    value += ' ' * pending + c
+                    pending = 0
+            entries.append((section, subsection, key, value))
+
+        return entries
+
+    def _configEntries(self, path, depth=0):
+        """Returns the entries of a config file, and of the files it includes"""
+        if depth > 10:
+            raise GitReaderException('Too many levels of config includes')
+
+        entries = []
+        for entry in self._read(path, self._parseConfig) or []:
+            (section, subsection, key, value) = entry
+            entries.append(entry)
+
+            if key != 'path' or value == None:
+                continue
+            elif section == 'include' and subsection == None:
+                pass
+            elif section == 'includeif' and subsection != None:
+                if not self._includeIf(subsection):
+                    continue
+            else:
+                continue
+
+            include = os.path.expanduser(value)
+            if not os.path.isabs(include):
+                include = os.path.join(os.path.dirname(path), include)
+            entries += self._configEntries(include, depth + 1)
+        return entries
+
+    def _includeIf(self, condition):
+        """Evaluates the condition of an includeIf section"""
+        if condition.startswith('gitdir:') or condition.startswith('gitdir/i:'):
+            (kind, pattern) = condition.split(':', 1)
+            flags = re.I if kind == 'gitdir/i' else 0
+            if pattern.startswith('~/'):
+                pattern = os.path.expanduser(pattern)
+            elif pattern.startswith('./'):
+                raise GitReaderException('Relative gitdir conditions are not supported')
+            if not pattern.startswith('/'):
+                pattern = '**/' + pattern
+            if pattern.endswith('/'):
+                pattern += '**'
+            gitdir = os.path.realpath(self.gitdir)
+            regex = re.compile(self._globToRegex(pattern), flags)
+            return bool(regex.match(gitdir) or regex.match(os.path.abspath(self.gitdir)))
+
+        elif condition.startswith('onbranch:'):
+            pattern = condition.split(':', 1)[1]
+            if pattern.endswith('/'):
+                pattern += '**'
+            branch = self.currentBranch()
+            if branch == None or not branch.startswith('refs/heads/'):
+                return False
+            return bool(re.match(self._globToRegex(pattern), branch[11:]))
+
+        raise GitReaderException('Unsupported includeIf condition: %s' % condition)
+
+    def _globToRegex(self, pattern):
+        """Converts a wildmatch pattern, in which * does not match slashes, to a regex"""
+        regex = ''
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith('**/', i):
+                regex += '(?:.*/)?'
+                i += 3
+            elif pattern.startswith('**', i):
+                regex += '.*'
+                i += 2
+            elif pattern[i] == '*':
+                regex += '[^/]*'
+                i += 1
+            elif pattern[i] == '?':
+                regex += '[^/]'
+                i += 1
+            elif pattern[i] == '[' and ']' in pattern[i + 1:]:
+                end = pattern.index(']', i + 1)
+                regex += '[' + pattern[i + 1:end].replace('!', '^', 1) + ']'
+                i = end + 1
+            else:
+                regex += re.escape(pattern[i])
+                i += 1
+        return regex + '$'
+
+    def config(self):
+        """Returns the entries of all the config files, in the order git reads them"""
+        files = [self._systemConfigFile()]
+        xdg = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+        files.append(os.path.join(xdg, 'git', 'config'))
+        files.append(os.path.expanduser('~/.gitconfig'))
+        files.append(os.path.join(self.gitdir, 'config'))
+
+        entries = []
+        for f in files:
+            entries += self._configEntries(f)
+
+        for (section, subsection, key, value) in entries:
+            if section == 'extensions' and key in ['worktreeconfig', 'refstorage']:
+                raise GitReaderException('Unsupported repository extension %s' % key)
+        return entries
+
+    def getConfig(self, name):
+        """Same as `git config --get name`, returns None when not set"""
+        parts = name.split('.')
+        if len(parts) < 2:
+            return None
+        section = parts[0].lower()
+        key = parts[-1].lower()
+        subsection = '.'.join(parts[1:-1]) if len(parts) > 2 else None
+
+        found = False
+        result = None
+        for entry in self.config():
+            if entry[0] == section and entry[1] == subsection and entry[2] == key:
+                found = True
+                result = entry[3]
+        if not found:
+            return None
+        elif result == None:
+            return ''
+        return result
+
+    def getRemotes(self):
+        """Same as `git remote -v`, returns a dict of remote names with their push URL"""
+        for d in ['remotes', 'branches']:
+            d = os.path.join(self.gitdir, d)
+            if os.path.isdir(d) and os.listdir(d):
+                raise GitReaderException('Legacy remotes definitions are not supported')
+
+        names = []
+        urls = {}
+        pushurls = {}
+        insteadOf = {}
+        pushInsteadOf = {}
+        for (section, subsection, key, value) in self.config():
+            if section == 'remote' and subsection != None:
+                if subsection not in names:
+                    names.append(subsection)
+                if value == None:
+                    continue
+                elif key == 'url':
+                    urls.setdefault(subsection, []).append(value)
+                elif key == 'pushurl':
+                    pushurls.setdefault(subsection, []).append(value)
+            elif section == 'url' and subsection != None and value != None:
+                if key == 'insteadof':
+                    insteadOf[value] = subsection
+                elif key == 'pushinsteadof':
+                    pushInsteadOf[value] = subsection
+
+        def rewrite(url, rules):
+            best = None
+            for prefix in rules.keys():
+                if url.startswith(prefix) and (best == None or len(prefix) > len(best)):
+                    best = prefix
+            if best == None:
+                return None
+            return rules[best] + url[len(best):]
+
+        remotes = {}
+        for name in names:
+            push = [rewrite(u, insteadOf) or u for u in pushurls.get(name, [])]
+            if not push:
+                push = [rewrite(u, pushInsteadOf) for u in urls.get(name, [])]
+                push = [u for u in push if u != None]
+            if not push:
+                push = [rewrite(u, insteadOf) or u for u in urls.get(name, [])]
+            remotes[name] = push[-1] if push else ''
+        return remotes
+
+
+class GitWorker(object):
+    """Long-lived git process answering reference and object lookups
+
+    This wraps `git cat-file --batch-check` which reads names from its standard
+    input and resolves them against the current state of the repository. Using
+    it instead of forking a new process for each lookup is much faster.
+    """
+
+    _proc = None
+
+    def __init__(self, path, bin='/usr/bin/git'):
+        self.path = path
+        self.bin = bin
+        self._lock = threading.Lock()
+        cmd = [self.bin, 'cat-file', '--batch-check']
+        logging.debug(' '.join(cmd))
+        with open(os.devnull, 'w') as devnull:
+            self._proc = subprocess.Popen(cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=devnull,
+                cwd=path
+            )
+
+    def isAlive(self):
+        return self._proc != None and self._proc.poll() == None
+
+    def resolve(self, name):
+        """Returns the hash of the object name points to, or None if it does not exist"""
+        name = str(name).strip()
+        if not name or '\n' in name:
+            return None
+
+        with self._lock:
+            if not self.isAlive():
+                raise GitWorkerException('The git worker in %s is not running' % self.path)
+            try:
+                self._proc.stdin.write(name + '\n')
+                self._proc.stdin.flush()
+                line = self._proc.stdout.readline()
+            except (IOError, OSError) as e:
+                self.stop()
+                raise GitWorkerException('The git worker in %s failed: %s' % (self.path, e))
+
+        if not line:
+            self.stop()
+            raise GitWorkerException('The git worker in %s exited unexpectedly' % self.path)
+
+        line = line.rstrip('\n')
+        if line.endswith(' missing') or line.endswith(' ambiguous'):
+            return None
+        return line.split(' ', 1)[0]
+
+    def stop(self):
+        """Stops the process"""
+        proc = self._proc
+        self._proc = None
+        if proc == None or proc.poll() != None:
+            return
+        try:
+            proc.stdin.close()
+            proc.wait()
+        except (IOError, OSError):
+            pass
+
+
+def readBundle(path):
+    """Read the header of a bundle, returns its prerequisites and its references as lists of (hash, ref)"""
+    prerequisites = []
+    refs = []
+    with open(path, 'rb') as f:
+        signature = f.readline().strip()
+        if signature not in ['# v2 git bundle', '# v3 git bundle']:
+            raise GitException('%s is not a bundle' % path)
+        for line in iter(f.readline, ''):
+            line = line.rstrip('\n')
+            if line == '':
+                break
+            elif line.startswith('@'):
+                # Capabilities of v3 bundles.
+                continue
+            elif line.startswith('-'):
+                prerequisites.append((line[1:].split(' ', 1)[0], None))
+            else:
+                (hash, ref) = line.split(' ', 1)
+                refs.append((hash, ref))
+    return (prerequisites, refs)
+
+
+def stopWorkers():
+    """Stops all the long-lived workers"""
+    with _workersLock:
+        for worker in _workers.values():
+            worker.stop()
+        _workers.clear()
+
+atexit.register(stopWorkers)
 
 
 class GitException(Exception):
     pass
+
+
+class GitReaderException(GitException):
+    pass
+
+
+class GitWorkerException(GitException):
+    pass
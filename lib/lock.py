@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import errno
+import functools
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+from config import Conf
+from exceptions import LockTimeout
+
+try:
+    import fcntl
+except ImportError:
+    # Locking is not supported on this platform, the locks are always acquired.
+    fcntl = None
+
+C = Conf()
+
+# The locks held by each thread, indexed by path.
+_held = threading.local()
+
+
+def locked(exclusive=True):
+    """Decorator for the methods to run while holding the lock returned by self.lock()"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.lock(exclusive=exclusive):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Lock(object):
+    """Advisory lock on a file, to be used as a context manager
+
+    Several processes can hold a shared lock at the same time, while an exclusive lock is only
+    held by one of them. The locks are held with flock(), the system releases them when their
+    process ends. They are re-entrant within a thread, a lock already held by the thread is
+    acquired again at once. A shared lock cannot be upgraded to an exclusive one, as another
+    process could take the lock in between. Different threads, as different processes, wait
+    for each other.
+
+    When wait is False, or after timeout seconds, LockTimeout is raised if the lock could not
+    be acquired. The timeout defaults to the setting lockTimeout.
+    """
+
+    exclusive = True
+    path = None
+    timeout = None
+    wait = True
+
+    def __init__(self, path, exclusive=True, wait=True, timeout=None):
+        self.path = path
+        self.exclusive = exclusive
+        self.wait = wait
+        self.timeout = timeout if timeout != None else C.get('lockTimeout')
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.release()
+
+    def acquire(self):
+        held = self._getHeld().get(self.path)
+
+        if held != None:
+            if self.exclusive and not held['exclusive']:
+                raise Exception('Cannot lock %s exclusively while holding a shared lock on it' % self.path)
+            held['depth'] += 1
+            return
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            if fcntl:
+                # The processes we start must not inherit the lock.
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            self._flock(fd)
+            self._writeHolder(fd)
+        except:
+            os.close(fd)
+            raise
+
+        self._getHeld()[self.path] = {'depth': 1, 'exclusive': self.exclusive, 'fd': fd}
+
+    def _flock(self, fd):
+        """Wait for the lock on fd, raises LockTimeout"""
+        if not fcntl:
+            return
+
+        mode = fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH
+        start = time.time()
+        delay = 0.05
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(fd, mode | fcntl.LOCK_NB)
+                return
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+
+            elapsed = time.time() - start
+            if not self.wait or (self.timeout != None and elapsed >= self.timeout):
+                raise LockTimeout('Could not lock %s, %s' % (self.path, self.getHolder()))
+            elif not waiting:
+                logging.info('Waiting for the lock on %s, %s' % (self.path, self.getHolder()))
+                waiting = True
+
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+
+    def getHolder(self):
+        """Describes the last process which acquired the lock"""
+        try:
+            with open(self.path, 'r') as f:
+                (pid, host, command) = (f.read().split('\n') + ['', '', ''])[:3]
+            pid = int(pid)
+        except (IOError, ValueError):
+            return 'it is held by another process'
+
+        holder = 'it is held by %s (pid %d)' % (command or 'another process', pid)
+        if host == socket.gethostname() and not self._isRunning(pid):
+            # Only a process started from the one which locked the file could still hold it.
+            holder += ' which has ended, one of the processes it started is probably still running'
+        return holder
+
+    def _getHeld(self):
+        if not hasattr(_held, 'locks'):
+            _held.locks = {}
+        return _held.locks
+
+    def _isRunning(self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def release(self):
+        locks = self._getHeld()
+        held = locks.get(self.path)
+        if held == None:
+            return
+
+        held['depth'] -= 1
+        if held['depth'] > 0:
+            return
+
+        del locks[self.path]
+        if fcntl:
+            fcntl.flock(held['fd'], fcntl.LOCK_UN)
+        os.close(held['fd'])
+
+    def _writeHolder(self, fd):
+        """Record the process holding the lock, to tell the others who they are waiting for"""
+        os.ftruncate(fd, 0)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, '%d\n%s\n%s' % (os.getpid(), socket.gethostname(), ' '.join(['mdk'] + sys.argv[1:])))
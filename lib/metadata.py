@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2012 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import atexit
+import copy
+import json
+import logging
+import os
+import tempfile
+import threading
+from config import Conf
+
+C = Conf()
+
+
+class Metadata(object):
+    """Persistent cache of the information extracted from the files of the instances
+
+    Each entry is stored with the modification time, size and inode of the files it was
+    extracted from, it is only returned as long as none of them have changed.
+    """
+
+    _data = None
+    _dirty = False
+    _instance = None
+    _lock = None
+    _path = None
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super(Metadata, cls).__new__(cls, *args, **kwargs)
+            cls._instance._lock = threading.RLock()
+            atexit.register(cls._instance.save)
+        return cls._instance
+
+    def get(self, kind, key, files):
+        """Return the entry of kind for key, or None when one of the files has changed"""
+        with self._lock:
+            data = self._load()
+            entry = data.get('%s:%s' % (kind, key))
+            if entry == None:
+                return None
+            elif entry['stamps'] != self._stamps(files):
+                del data['%s:%s' % (kind, key)]
+                self._dirty = True
+                return None
+            return copy.deepcopy(entry['value'])
+
+    def getPath(self):
+        if self._path == None:
+            self._path = os.path.join(os.path.expanduser(C.get('dirs.mdk')), 'metadata.json')
+        return self._path
+
+    def invalidate(self, key=None):
+        """Remove the entries of a key, or all of them"""
+        with self._lock:
+            data = self._load()
+            for name in data.keys():
+                if key == None or name.split(':', 1)[1] == key:
+                    del data[name]
+                    self._dirty = True
+
+    def _load(self):
+        if self._data == None:
+            self._data = {}
+            try:
+                with open(self.getPath(), 'r') as f:
+                    self._data = json.load(f)
+            except (IOError, ValueError) as e:
+                logging.debug('Could not load the metadata cache: %s' % e)
+        return self._data
+
+    def save(self):
+        """Write the entries to the cache file, if they have changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            path = self.getPath()
+            if not os.path.isdir(os.path.dirname(path)):
+                return
+            try:
+                # Write to a temporary file first, a concurrent process never reads a partial file.
+                (fd, tmp) = tempfile.mkstemp(prefix='.metadata-', dir=os.path.dirname(path))
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self._data, f)
+                os.rename(tmp, path)
+                self._dirty = False
+            except (IOError, OSError) as e:
+                logging.debug('Could not save the metadata cache: %s' % e)
+
+    def set(self, kind, key, files, value):
+        """Store the entry of kind for key, extracted from the files, which do not have to exist"""
+        stamps = self._stamps(files)
+        with self._lock:
+            data = self._load()
+            data['%s:%s' % (kind, key)] = {'stamps': stamps, 'value': copy.deepcopy(value)}
+            self._dirty = True
+
+    def _stamps(self, files):
+        """Return the modification time, size and inode of each file, or None if missing"""
+        stamps = []
+        for f in files:
+            try:
+                stat = os.stat(f)
+                stamps.append([stat.st_mtime, stat.st_size, stat.st_ino])
+            except OSError:
+                stamps.append(None)
+        return stamps
@@ -26,15 +26,21 @@ import os
 import re
 import logging
 import shutil
-from tempfile import gettempdir
+import stat
+from contextlib import contextmanager
+from tempfile import gettempdir, mkdtemp, mkstemp
 
-from tools import getMDLFromCommitMessage, mkdir, process, parseBranch
+from tools import getMDLFromCommitMessage, mkdir, process, processAsync, parseBranch
 from db import DB
 from config import Conf
 from git import Git, GitException
+from metadata import Metadata
+from plugins import PluginManager
 from exceptions import InstallException, UpgradeNotAllowed
 from jira import Jira, JiraException
+from lock import Lock, locked
 from scripts import Scripts
+from templates import InstallTemplate
 
 C = Conf()
 
@@ -47,6 +53,7 @@ class Moodle(object):
     version = None
     config = None
 
+    _configEditor = None
     _dbo = None
     _git = None
     _loaded = False
@@ -76,45 +83,8 @@ class Moodle(object):
     def addConfig(self, name, value):
         """Add a parameter to the config file
         Will attempt to write them before the inclusion of lib/setup.php"""
-        configFile = os.path.join(self.path, 'config.php')
-        if not os.path.isfile(configFile):
-            return None
-
-        if name in self._reservedKeywords:
-            raise Exception('Cannot use reserved keywords for settings in config.php')
-
-        if type(value) == bool:
-            value = 'true' if value else 'false'
-        elif type(value) != int:
-            value = "'" + str(value) + "'"
-        value = str(value)
-
-        try:
-            f = open(configFile, 'r')
-            lines = f.readlines()
-            f.close()
-
-            for i, line in enumerate(lines):
-                if re.search(r'^// MDK Edit\.$', line.rstrip()):
-                    break
-                elif re.search(r'require_once.*/lib/setup\.php', line):
-                    lines.insert(i, '// MDK Edit.\n')
-                    lines.insert(i + 1, '\n')
-                    # As we've added lines, let's move the index
-                    break
-
-            i += 1
-            if i > len(lines):
-                i = len(lines)
-            lines.insert(i, '$CFG->%s = %s;\n' % (name, value))
-
-            f = open(configFile, 'w')
-            f.writelines(lines)
-            f.close()
-        except:
-            raise Exception('Error while writing to config file')
-
-        self.reload()
+        with self.editConfig() as config:
+            return config.add(name, value)
 
     def branch_compare(self, branch, compare='>='):
         """Compare the branch of the current instance with the one passed"""
@@ -178,13 +148,19 @@ class Moodle(object):
 
     def cli(self, cli, args='', **kwargs):
         """Executes a command line tool script"""
+        return process(self._cliCommand(cli, args), cwd=self.get('path'), **kwargs)
+
+    def cliAsync(self, cli, args='', **kwargs):
+        """Executes a command line tool script in the background, returns a ProcessFuture"""
+        return processAsync(self._cliCommand(cli, args), cwd=self.get('path'), **kwargs)
+
+    def _cliCommand(self, cli, args=''):
         cli = os.path.join(self.get('path'), cli.lstrip('/'))
         if not os.path.isfile(cli):
             raise Exception('Could not find script to call')
         if type(args) == 'list':
             args = ' '.join(args)
-        cmd = '%s %s %s' % (C.get('php'), cli, args)
-        return process(cmd, cwd=self.get('path'), **kwargs)
+        return '%s %s %s' % (C.get('php'), cli, args)
 
     def currentBranch(self):
         """Returns the current branch on the git repository"""
@@ -202,6 +178,20 @@ class Moodle(object):
                     pass
         return self._dbo
 
+    def editConfig(self):
+        """Return an editing session of the config file, to be used as a context manager
+
+        The changes are written at once when the outermost session ends, the sessions opened
+        while another one is active join it.
+
+            with M.editConfig() as config:
+                config.set('debug', 32767)
+                config.remove('theme')
+        """
+        if self._configEditor == None:
+            self._configEditor = ConfigEditor(self)
+        return self._configEditor
+
     def generateBranchName(self, issue, suffix='', version=''):
         """Generates a branch name"""
         mdl = re.sub(r'(MDL|mdl)(-|_)?', '', issue)
@@ -224,6 +214,102 @@ class Moodle(object):
         except:
             return default
 
+    def getAffectedTests(self, tests, always=None, ref=None):
+        """Returns the tests affected by the changes made since ref, see getChangedComponents()
+
+        The tests are the paths of the test files, or features, relative to the root of the
+        instance. The ones of the changed components are selected, and the ones within the paths
+        of always."""
+        components = self.getChangedComponents(ref)
+        logging.info('Changed components: %s' % (', '.join(sorted(components.keys())) or 'none'))
+        directories = components.values()
+        always = [path.strip('/') for path in (always or [])]
+
+        affected = []
+        for test in tests:
+            changed = any([test.startswith(d + '/tests/') for d in directories])
+            required = any([test == path or test.startswith(path + '/') for path in always])
+            if changed or required:
+                affected.append(test)
+        return affected
+
+    def getChangedComponents(self, ref=None):
+        """Returns the components changed since ref, with their directory, indexed by component
+
+        The ref defaults to the head commit of the current branch, the changes not committed
+        yet are included."""
+        if ref == None:
+            ref = self.headcommit()
+            if not ref:
+                raise Exception('Could not resolve the head commit of the branch')
+        return PluginManager.getComponents(self, self.git().changedFiles(ref))
+
+    def getComponentVersions(self, path=None):
+        """Returns the versions of core and of the plugins found in the files, indexed by component
+
+        The files are read from path when set, it must be a working tree of this instance."""
+        if path == None:
+            path = self.get('path')
+
+        reVersion = re.compile(r'^\s*\$(?:version|plugin->version|module->version)\s*=\s*([0-9.]+)\s*;')
+
+        def readVersion(versionFile):
+            try:
+                with open(versionFile, 'r') as f:
+                    for line in f:
+                        match = reVersion.search(line)
+                        if match:
+                            return match.group(1)
+            except IOError:
+                pass
+            return None
+
+        versions = {'core': readVersion(os.path.join(path, 'version.php'))}
+        for (t, typePath) in PluginManager.getPluginTypes(self, path).items():
+            typeDir = os.path.join(path, typePath)
+            if not os.path.isdir(typeDir):
+                continue
+            for name in os.listdir(typeDir):
+                version = readVersion(os.path.join(typeDir, name, 'version.php'))
+                if version != None:
+                    versions['%s_%s' % (t, name)] = version
+        return versions
+
+    def getInstalledCoreVersion(self):
+        """Returns the version of core recorded in the database"""
+        db = self.dbo()
+        if db == None:
+            raise Exception('Could not connect to the database of the instance')
+        db.selectdb(self.get('dbname'))
+        db.execute("SELECT value FROM %sconfig WHERE name = 'version'" % self.get('prefix', 'mdl_'))
+        row = db.cur.fetchone()
+        return row[0] if row else None
+
+    def getInstalledVersions(self):
+        """Returns the versions of core and of the plugins recorded in the database, indexed by component"""
+        versions = {}
+        versions['core'] = self.getInstalledCoreVersion()
+        db = self.dbo()
+        prefix = self.get('prefix', 'mdl_')
+
+        db.execute("SELECT plugin, value FROM %sconfig_plugins WHERE name = 'version'" % prefix)
+        for (plugin, value) in db.cur.fetchall():
+            versions[plugin] = value
+
+        # Older versions record the activities and blocks in their own tables.
+        for (table, t) in [('modules', 'mod'), ('block', 'block')]:
+            try:
+                db.execute('SELECT name, version FROM %s%s' % (prefix, table))
+                for (name, value) in db.cur.fetchall():
+                    versions.setdefault('%s_%s' % (t, name), str(value))
+            except Exception:
+                try:
+                    db.conn.rollback()
+                except Exception:
+                    pass
+
+        return versions
+
     def git(self):
         """Returns a Git object"""
         if self._git == None:
@@ -254,7 +340,7 @@ class Moodle(object):
         try:
             # Trying to smart guess the last commit needed
             if smartSearch:
-                commits = self.git().log(since=branch, count=C.get('smartHeadCommitLimit'), format='%s_____%h').split('\n')[:-1]
+                commits = self.git().iterLog(since=branch, count=C.get('smartHeadCommitLimit'), format='%s_____%h')
 
                 # Looping over the last commits to find the commit messages that match the MDL-12345.
                 candidate = None
@@ -281,22 +367,22 @@ class Moodle(object):
 
         return headcommit
 
+    @locked()
     def initPHPUnit(self, force=False):
         """Initialise the PHPUnit environment"""
 
         if self.branch_compare(23, '<'):
             raise Exception('PHPUnit is only available from Moodle 2.3')
 
-        # Set PHPUnit data root
+        # Set PHPUnit data root and prefix
         phpunit_dataroot = self.get('dataroot') + '_phpu'
-        self.updateConfig('phpunit_dataroot', phpunit_dataroot)
+        phpunit_prefix = 'phpu_'
+        with self.editConfig() as config:
+            config.set('phpunit_dataroot', phpunit_dataroot)
+            config.set('phpunit_prefix', phpunit_prefix)
         if not os.path.isdir(phpunit_dataroot):
             mkdir(phpunit_dataroot, 0777)
 
-        # Set PHPUnit prefix
-        phpunit_prefix = 'phpu_'
-        self.updateConfig('phpunit_prefix', phpunit_prefix)
-
         result = (None, None, None)
         exception = None
         try:
@@ -314,6 +400,7 @@ class Moodle(object):
             else:
                 raise exception
 
+    @locked()
     def initBehat(self, switchcompletely=False):
         """Initialise the Behat environment"""
 
@@ -325,29 +412,31 @@ class Moodle(object):
         if int(phpVersion) <= 0:
             switchcompletely = True
 
-        # Set Behat data root
-        behat_dataroot = self.get('dataroot') + '_behat'
-        self.updateConfig('behat_dataroot', behat_dataroot)
+        with self.editConfig() as config:
+
+            # Set Behat data root
+            behat_dataroot = self.get('dataroot') + '_behat'
+            config.set('behat_dataroot', behat_dataroot)
 
-        # Set Behat DB prefix
-        behat_prefix = 'zbehat_'
-        self.updateConfig('behat_prefix', behat_prefix)
+            # Set Behat DB prefix
+            behat_prefix = 'zbehat_'
+            config.set('behat_prefix', behat_prefix)
 
-        # Switch completely?
-        if self.branch_compare(27, '<'):
-            if switchcompletely:
-                self.updateConfig('behat_switchcompletely', switchcompletely)
-                self.updateConfig('behat_wwwroot', self.get('wwwroot'))
+            # Switch completely?
+            if self.branch_compare(27, '<'):
+                if switchcompletely:
+                    config.set('behat_switchcompletely', switchcompletely)
+                    config.set('behat_wwwroot', self.get('wwwroot'))
+                else:
+                    config.remove('behat_switchcompletely')
+                    config.remove('behat_wwwroot')
             else:
-                self.removeConfig('behat_switchcompletely')
-                self.removeConfig('behat_wwwroot')
-        else:
-            # Defining wwwroot.
-            wwwroot = '%s://%s/' % (C.get('scheme'), C.get('behat.host'))
-            if C.get('path') != '' and C.get('path') != None:
-                wwwroot = wwwroot + C.get('path') + '/'
-            wwwroot = wwwroot + self.identifier
-            self.updateConfig('behat_wwwroot', wwwroot)
+                # Defining wwwroot.
+                wwwroot = '%s://%s/' % (C.get('scheme'), C.get('behat.host'))
+                if C.get('path') != '' and C.get('path') != None:
+                    wwwroot = wwwroot + C.get('path') + '/'
+                wwwroot = wwwroot + self.identifier
+                config.set('behat_wwwroot', wwwroot)
 
         # Force a cache purge
         self.purge()
@@ -374,6 +463,7 @@ class Moodle(object):
             info[k] = v
         return info
 
+    @locked()
     def install(self, dbname=None, engine=None, dataDir=None, fullname=None, dropDb=False):
         """Launch the install script of an Instance"""
 
@@ -395,12 +485,8 @@ class Moodle(object):
         if db.dbexists(dbname):
             if dropDb:
                 db.dropdb(dbname)
-                db.createdb(dbname)
             else:
                 raise InstallException('Cannot install an instance on an existing database (%s)' % dbname)
-        else:
-            db.createdb(dbname)
-        db.selectdb(dbname)
 
         # Defining wwwroot.
         wwwroot = '%s://%s/' % (C.get('scheme'), C.get('host'))
@@ -408,10 +494,39 @@ class Moodle(object):
             wwwroot = wwwroot + C.get('path') + '/'
         wwwroot = wwwroot + self.identifier
 
+        # The options of the installer shared by the instances, the templates are identified by them.
+        options = {
+            'adminpass': C.get('passwd'),
+            'adminuser': C.get('login'),
+            'dbhost': C.get('db.%s.host' % engine),
+            'dbpass': C.get('db.%s.passwd' % engine),
+            'dbuser': C.get('db.%s.user' % engine),
+            'lang': 'en',
+            'prefix': 'mdl_'
+        }
+
+        # Copying the template of a previous installation of the same version.
+        template = None
+        if C.get('installTemplates'):
+            template = InstallTemplate.getForInstance(self, engine, options)
+            with template.lock(exclusive=False):
+                if template.exists():
+                    logging.info('Installing %s from a template...' % self.identifier)
+                    try:
+                        template.apply(self, dbname, dataDir, wwwroot, fullname)
+                        self.reload()
+                        return
+                    except Exception as e:
+                        logging.warning('Could not install from the template, running the installer instead')
+                        logging.debug(e)
+
+        db.createdb(dbname)
+        db.selectdb(dbname)
+
         logging.info('Installing %s...' % self.identifier)
         cli = 'admin/cli/install.php'
-        params = (wwwroot, dataDir, engine, dbname, C.get('db.%s.user' % engine), C.get('db.%s.passwd' % engine), C.get('db.%s.host' % engine), fullname, self.identifier, C.get('login'), C.get('passwd'))
-        args = '--wwwroot="%s" --dataroot="%s" --dbtype="%s" --dbname="%s" --dbuser="%s" --dbpass="%s" --dbhost="%s" --fullname="%s" --shortname="%s" --adminuser="%s" --adminpass="%s" --allow-unstable --agree-license --non-interactive' % params
+        params = (wwwroot, dataDir, engine, dbname, options['dbuser'], options['dbpass'], options['dbhost'], options['prefix'], fullname, self.identifier, options['adminuser'], options['adminpass'], options['lang'])
+        args = '--wwwroot="%s" --dataroot="%s" --dbtype="%s" --dbname="%s" --dbuser="%s" --dbpass="%s" --dbhost="%s" --prefix="%s" --fullname="%s" --shortname="%s" --adminuser="%s" --adminpass="%s" --lang="%s" --allow-unstable --agree-license --non-interactive' % params
         result = self.cli(cli, args, stdout=None, stderr=None)
         if result[0] != 0:
             raise InstallException('Error while running the install, please manually fix the problem.\n- Command was: %s %s %s' % (C.get('php'), cli, args))
@@ -425,6 +540,14 @@ class Moodle(object):
 
         self.reload()
 
+        if template:
+            try:
+                with template.lock():
+                    template.save(self)
+            except Exception as e:
+                logging.warning('Could not save the installation as a template')
+                logging.debug(e)
+
     def isInstalled(self):
         """Returns whether this instance is installed or not"""
         # Reload the configuration if necessary.
@@ -435,6 +558,10 @@ class Moodle(object):
     def isInstance(path):
         """Check whether the path is a Moodle web directory"""
         version = os.path.join(path, 'version.php')
+        cached = Metadata().get('instance', path, [version])
+        if cached != None:
+            return cached
+
         try:
             f = open(version, 'r')
             lines = f.readlines()
@@ -446,25 +573,48 @@ class Moodle(object):
             if line.find('MOODLE VERSION INFORMATION') > -1:
                 found = True
                 break
-        if not found:
-            return False
 
-        return True
+        Metadata().set('instance', path, [version], found)
+        return found
 
     def isIntegration(self):
         """Returns whether an instance is an integration one or not"""
-        r = C.get('upstreamRemote') or 'upstream'
+        upstream = C.get('upstreamRemote') or 'upstream'
+        gitconfig = os.path.join(self.path, '.git', 'config')
+        cached = Metadata().get('integration', self.path, [gitconfig])
+        if cached != None and cached['upstreamRemote'] == upstream:
+            return cached['integration']
+
+        integration = False
+        r = upstream
         if not self.git().getRemote(r):
             r = 'origin'
         remote = self.git().getConfig('remote.%s.url' % r)
         if remote != None and remote.endswith('integration.git'):
-            return True
-        return False
+            integration = True
+        # The single cached repository stores the integration branches in their own namespace.
+        refspec = self.git().getConfig('remote.%s.fetch' % r)
+        if refspec != None and 'refs/integration/' in refspec:
+            integration = True
+
+        Metadata().set('integration', self.path, [gitconfig], {'upstreamRemote': upstream, 'integration': integration})
+        return integration
 
     def isStable(self):
         """Assume an instance is stable if not integration"""
         return not self.isIntegration()
 
+    def lock(self, exclusive=True, wait=True, timeout=None):
+        """Return the lock of the instance, see lock.Lock
+
+        The methods changing the repository, the config file or the database hold it, an exclusive
+        lock should be held while performing several of those operations to prevent other processes
+        from working on the instance in between.
+        """
+        gitDir = os.path.join(self.path, '.git')
+        path = os.path.join(gitDir, 'mdk.lock') if os.path.isdir(gitDir) else os.path.join(self.path, '.mdk.lock')
+        return Lock(path, exclusive=exclusive, wait=wait, timeout=timeout)
+
     def _load(self):
         """Loads the information"""
         if not self.isInstance(self.path):
@@ -478,21 +628,7 @@ class Moodle(object):
         version = os.path.join(self.path, 'version.php')
         if os.path.isfile(version):
 
-            reVersion = re.compile(r'^\s*\$version\s*=\s*([0-9.]+)\s*;')
-            reRelease = re.compile(r'^\s*\$release\s*=\s*(?P<brackets>[\'"])?(.+)(?P=brackets)\s*;')
-            reMaturity = re.compile(r'^\s*\$maturity\s*=\s*([a-zA-Z0-9_]+)\s*;')
-            reBranch = re.compile(r'^\s*\$branch\s*=\s*(?P<brackets>[\'"])?([0-9]+)(?P=brackets)\s*;')
-
-            f = open(version, 'r')
-            for line in f:
-                if reVersion.search(line):
-                    self.version['version'] = reVersion.search(line).group(1)
-                elif reRelease.search(line):
-                    self.version['release'] = reRelease.search(line).group(2)
-                elif reMaturity.search(line):
-                    self.version['maturity'] = reMaturity.search(line).group(1).replace('MATURITY_', '').lower()
-                elif reBranch.search(line):
-                    self.version['branch'] = reBranch.search(line).group(2)
+            self.version = self._parseVersion(version)
 
             # Several checks about the branch
             try:
@@ -513,7 +649,6 @@ class Moodle(object):
             # Integration or stable?
             self.version['integration'] = self.isIntegration()
 
-            f.close()
         else:
             # Should never happen
             raise Exception('This does not appear to be a Moodle instance')
@@ -523,6 +658,12 @@ class Moodle(object):
         config = os.path.join(self.path, 'config.php')
         if os.path.isfile(config):
             self.installed = True
+            cached = Metadata().get('config', self.path, [config])
+            if cached != None:
+                self.config = cached
+                self._loaded = True
+                return True
+
             prog = re.compile(r'^\s*\$CFG->([a-z_]+)\s*=\s*((?P<brackets>[\'"])?(.+)(?P=brackets)|([0-9.]+)|(true|false|null))\s*;$', re.I)
             try:
                 f = open(config, 'r')
@@ -550,6 +691,7 @@ class Moodle(object):
                     self.config[match.group(1)] = value
 
                 f.close()
+                Metadata().set('config', self.path, [config], self.config)
 
             except IOError:
                 self.installed = False
@@ -561,6 +703,34 @@ class Moodle(object):
         self._loaded = True
         return True
 
+    def _parseVersion(self, version):
+        """Extracts the information from the version.php file"""
+        cached = Metadata().get('version', self.path, [version])
+        if cached != None:
+            return cached
+
+        info = {}
+        reVersion = re.compile(r'^\s*\$version\s*=\s*([0-9.]+)\s*;')
+        reRelease = re.compile(r'^\s*\$release\s*=\s*(?P<brackets>[\'"])?(.+)(?P=brackets)\s*;')
+        reMaturity = re.compile(r'^\s*\$maturity\s*=\s*([a-zA-Z0-9_]+)\s*;')
+        reBranch = re.compile(r'^\s*\$branch\s*=\s*(?P<brackets>[\'"])?([0-9]+)(?P=brackets)\s*;')
+
+        f = open(version, 'r')
+        for line in f:
+            if reVersion.search(line):
+                info['version'] = reVersion.search(line).group(1)
+            elif reRelease.search(line):
+                info['release'] = reRelease.search(line).group(2)
+            elif reMaturity.search(line):
+                info['maturity'] = reMaturity.search(line).group(1).replace('MATURITY_', '').lower()
+            elif reBranch.search(line):
+                info['branch'] = reBranch.search(line).group(2)
+        f.close()
+
+        Metadata().set('version', self.path, [version], info)
+        return info
+
+    @locked()
     def purge(self, manual=False):
         """Purge the cache of an instance"""
         if not self.isInstalled():
@@ -639,58 +809,47 @@ class Moodle(object):
 
     def removeConfig(self, name):
         """Remove a configuration setting from the config file."""
-        configFile = os.path.join(self.path, 'config.php')
-        if not os.path.isfile(configFile):
-            return None
-
-        try:
-            f = open(configFile, 'r')
-            lines = f.readlines()
-            f.close()
-
-            for line in lines:
-                if re.search(r'\$CFG->%s\s*=.*;' % (name), line):
-                    lines.remove(line)
-                    break
-
-            f = open(configFile, 'w')
-            f.writelines(lines)
-            f.close()
-        except:
-            raise Exception('Error while writing to config file')
-
-        self.reload()
+        with self.editConfig() as config:
+            return config.remove(name)
 
+    @locked(exclusive=False)
     def runScript(self, scriptname, arguments=None, **kwargs):
         """Runs a script on the instance"""
         return Scripts.run(scriptname, self.get('path'), arguments=arguments, cmdkwargs=kwargs)
 
-    def update(self, remote=None):
-        """Update the instance from the remote"""
+    @locked()
+    def update(self, remote=None, fetch=True):
+        """Update the instance from the remote, set fetch to False if the remote has already been fetched"""
 
         if remote == None:
             remote = C.get('upstreamRemote')
 
         # Fetch
-        if not self.git().fetch(remote):
+        if fetch and not self.git().fetch(remote):
             raise Exception('Could not fetch remote %s' % remote)
 
-        # Checkout stable
-        self.checkout_stable(True)
+        stablebranch = self.get('stablebranch')
+        upstream = '%s/%s' % (remote, stablebranch)
+
+        # When the stable branch is not checked out, its reference is moved without touching the working tree.
+        if self.currentBranch() != stablebranch:
+            if not self.git().hasBranch(stablebranch):
+                if not self.git().createBranch(stablebranch, upstream):
+                    raise Exception('Could not create the branch %s' % stablebranch)
+            elif not self.git().updateRef('refs/heads/%s' % stablebranch, upstream):
+                raise Exception('Could not update the branch %s' % stablebranch)
+            return
 
         # Reset HARD
-        upstream = '%s/%s' % (remote, self.get('stablebranch'))
         if not self.git().reset(to=upstream, hard=True):
             raise Exception('Error while executing git reset.')
 
-        # Return to previous branch
-        self.checkout_stable(False)
-
     def updateConfig(self, name, value):
         """Update a setting in the config file."""
-        self.removeConfig(name)
-        self.addConfig(name, value)
+        with self.editConfig() as config:
+            return config.set(name, value)
 
+    @locked()
     def uninstall(self):
         """Uninstall the instance"""
 
@@ -771,8 +930,9 @@ class Moodle(object):
                 (fieldrepositoryurl, repositoryurl, fieldbranch, branch, fielddiffurl, diffurl))
             J.setCustomFields(issue, {fieldrepositoryurl: repositoryurl, fieldbranch: branch, fielddiffurl: diffurl})
 
-    def upgrade(self, nocheckout=False):
-        """Calls the upgrade script"""
+    @locked()
+    def upgrade(self, nocheckout=False, force=False):
+        """Calls the upgrade script, unless the versions have not changed and force is not set"""
         if not self.isInstalled():
             raise Exception('Cannot upgrade an instance which is not installed.')
         elif not self.branch_compare(20):
@@ -780,16 +940,239 @@ class Moodle(object):
         elif os.path.isfile(os.path.join(self.get('path'), '.noupgrade')):
             raise UpgradeNotAllowed('Upgrade not allowed, found .noupgrade.')
 
-        # Checkout stable
-        if not nocheckout:
-            self.checkout_stable(True)
+        # The upgrade runs from a temporary working tree of the stable branch, unless it is already checked out.
+        if nocheckout or self.currentBranch() == self.get('stablebranch'):
+            return self._upgrade(self.get('path'), force)
+
+        with self._stableWorktree() as path:
+            if path != None:
+                return self._upgrade(path, force)
+
+        logging.debug('Could not use a temporary working tree, checking out the stable branch')
+        self.checkout_stable(True)
+        try:
+            return self._upgrade(self.get('path'), force)
+        finally:
+            self.checkout_stable(False)
+
+    def _upgrade(self, path, force=False):
+        """Runs the upgrade script from the files in path when needed, returns whether it ran"""
+        versions = self.getComponentVersions(path)
+        if not force:
+            try:
+                changes = self.upgradeNeeded(versions)
+            except Exception as e:
+                # The upgrade will tell.
+                logging.debug('Could not compare the versions: %s' % e)
+                changes = None
+            if changes == []:
+                logging.info('The versions have not changed, no need to upgrade')
+                return False
+            elif changes:
+                logging.info('Upgrade required by %s' % ', '.join(['%s (%s -> %s)' % (component, installed or 'new', version)
+                    for (component, installed, version) in changes]))
+
+        cmd = '%s %s %s' % (C.get('php'), os.path.join(path, 'admin', 'cli', 'upgrade.php'), '--non-interactive --allow-unstable')
+        result = process(cmd, cwd=path, stdout=None, stderr=None)
+
+        # The caches built during the upgrade refer to the files of the temporary working tree.
+        if path != self.get('path'):
+            try:
+                self.purge(manual=True)
+            except Exception as e:
+                logging.warning('Could not purge the caches after the upgrade, please purge them manually')
+                logging.debug(e)
 
-        cli = '/admin/cli/upgrade.php'
-        args = '--non-interactive --allow-unstable'
-        result = self.cli(cli, args, stdout=None, stderr=None)
         if result[0] != 0:
             raise Exception('Error while running the upgrade.')
 
-        # Return to previous branch
-        if not nocheckout:
-            self.checkout_stable(False)
+        try:
+            upgraded = {'core': self.getInstalledCoreVersion(), 'versions': versions}
+            Metadata().set('upgraded', self.path, [os.path.join(self.path, 'config.php')], upgraded)
+        except Exception as e:
+            logging.debug('Could not record the upgraded versions: %s' % e)
+        return True
+
+    def upgradeNeeded(self, versions=None):
+        """Returns the components whose version in the files differs from the installed one
+
+        The result is a list of tuples (component, installed version, version in the files), the
+        installed version being None for new components. The versions recorded after the last
+        upgrade are compared first, along with the version of core in the database, the versions
+        of the plugins are only queried when they differ. Versions defaults to the ones found in
+        the files of the instance, see getComponentVersions().
+        """
+        if versions == None:
+            versions = self.getComponentVersions()
+        configFile = os.path.join(self.path, 'config.php')
+        upgraded = {'core': self.getInstalledCoreVersion(), 'versions': versions}
+        if Metadata().get('upgraded', self.path, [configFile]) == upgraded:
+            return []
+
+        installed = self.getInstalledVersions()
+        changes = []
+        for component in sorted(versions.keys()):
+            current = installed.get(component)
+            try:
+                changed = current == None or float(current) != float(versions[component])
+            except ValueError:
+                changed = current != versions[component]
+            if changed:
+                changes.append((component, current, versions[component]))
+
+        if not changes:
+            Metadata().set('upgraded', self.path, [configFile], upgraded)
+        return changes
+
+    @contextmanager
+    def _stableWorktree(self):
+        """Context manager providing a temporary working tree of the stable branch
+
+        The working tree shares the config.php of this instance, whose caches must be purged
+        once they have been built from it. Its path is None when the working tree could not
+        be created."""
+        path = mkdtemp(prefix='mdk-stable-')
+        if not self.git().addWorktree(path, self.get('stablebranch')):
+            shutil.rmtree(path)
+            yield None
+            return
+
+        try:
+            shutil.copy2(os.path.join(self.get('path'), 'config.php'), os.path.join(path, 'config.php'))
+            yield path
+        finally:
+            self.git().removeWorktree(path)
+
+
+class ConfigEditor(object):
+    """Editing session of the config.php file of an instance, see Moodle.editConfig()
+
+    The file is parsed once when the session starts, the changes are applied in memory and
+    written atomically when the session ends, the instance is then reloaded once. The instance
+    is locked for the duration of the session.
+    """
+
+    M = None
+    _changed = False
+    _depth = 0
+    _lines = None
+    _lock = None
+
+    def __init__(self, M):
+        self.M = M
+
+    def __enter__(self):
+        if self._depth == 0:
+            self._changed = False
+            self._lines = None
+            self._lock = self.M.lock()
+            self._lock.acquire()
+            try:
+                with open(self.getPath(), 'r') as f:
+                    self._lines = f.readlines()
+            except IOError:
+                # No config file, the changes are ignored.
+                pass
+        self._depth += 1
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self._depth -= 1
+        if self._depth > 0:
+            return
+        try:
+            if excType == None and self._changed:
+                self.save()
+        finally:
+            self._lines = None
+            self._lock.release()
+
+    def add(self, name, value):
+        """Add a setting before the inclusion of lib/setup.php"""
+        if name in self.M._reservedKeywords:
+            raise Exception('Cannot use reserved keywords for settings in config.php')
+        elif self._lines == None:
+            return None
+
+        if type(value) == bool:
+            value = 'true' if value else 'false'
+        elif type(value) != int:
+            value = "'" + str(value) + "'"
+        value = str(value)
+
+        lines = self._lines
+        i = 0
+        for i, line in enumerate(lines):
+            if re.search(r'^// MDK Edit\.$', line.rstrip()):
+                break
+            elif re.search(r'require_once.*/lib/setup\.php', line):
+                lines.insert(i, '// MDK Edit.\n')
+                lines.insert(i + 1, '\n')
+                # As we've added lines, let's move the index
+                break
+
+        i += 1
+        if i > len(lines):
+            i = len(lines)
+        lines.insert(i, '$CFG->%s = %s;\n' % (name, value))
+        self._changed = True
+
+    def getPath(self):
+        return os.path.join(self.M.path, 'config.php')
+
+    def remove(self, name):
+        """Remove a setting"""
+        if self._lines == None:
+            return None
+
+        for line in self._lines:
+            if re.search(r'\$CFG->%s\s*=.*;' % (name), line):
+                self._lines.remove(line)
+                self._changed = True
+                break
+
+    def save(self):
+        """Write the file atomically, and reload the instance"""
+        path = self.getPath()
+        tmp = None
+        try:
+            (fd, tmp) = mkstemp(prefix='.config-', suffix='.php', dir=os.path.dirname(path))
+            with os.fdopen(fd, 'w') as f:
+                f.writelines(self._lines)
+            os.chmod(tmp, stat.S_IMODE(os.stat(path).st_mode))
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            raise Exception('Error while writing to config file')
+        finally:
+            if tmp and os.path.isfile(tmp):
+                os.remove(tmp)
+        self._changed = False
+        self.M.reload()
+
+    def set(self, name, value):
+        """Set the value of a setting, replacing the existing one"""
+        self.remove(name)
+        return self.add(name, value)
+
+    def setBlock(self, name, code=None):
+        """Set a block of PHP code, placed after the settings, or remove it when code is None"""
+        if self._lines == None:
+            return None
+
+        start = '// MDK %s start.\n' % name
+        end = '// MDK %s end.\n' % name
+        if start in self._lines and end in self._lines:
+            del self._lines[self._lines.index(start):self._lines.index(end) + 1]
+            self._changed = True
+        if code == None:
+            return
+
+        i = len(self._lines)
+        for j, line in enumerate(self._lines):
+            if re.search(r'require_once.*/lib/setup\.php', line):
+                i = j
+                break
+        block = [start] + [line + '\n' for line in code.rstrip('\n').split('\n')] + [end]
+        self._lines[i:i] = block
+        self._changed = True
+
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import logging
+import os
+import xml.etree.ElementTree as ET
+from command import InstanceExecutor
+from timings import Timings
+from tools import mkdir, parallel, process
+
+# Read from config.php to select the environment of a shard, see PHPUnit.
+_shardVariable = 'MDK_PHPUNIT_SHARD'
+
+
+class PHPUnit(object):
+    """Runs the PHPUnit tests of an instance split in shards running at the same time
+
+    Each shard has its own PHPUnit environment, its tables and data directory are the ones set
+    by Moodle.initPHPUnit() suffixed with the number of the shard. The environment variable
+    MDK_PHPUNIT_SHARD selects the shard from config.php, the first shard uses the environment
+    of the instance. The test files are distributed according to their recorded timings.
+    """
+
+    M = None
+    shards = 1
+
+    def __init__(self, M, shards=1):
+        self.M = M
+        self.shards = max(1, shards)
+
+    def getShardDataroot(self, shard):
+        return self.M.get('phpunit_dataroot') + (str(shard) if shard > 0 else '')
+
+    def getShardEnv(self, shard):
+        return {_shardVariable: str(shard)} if shard > 0 else None
+
+    def getShardPrefix(self, shard):
+        prefix = self.M.get('phpunit_prefix')
+        return prefix.rstrip('_') + str(shard) + '_' if shard > 0 else prefix
+
+    def getTestFiles(self):
+        """Return the test files of the test suites of phpunit.xml, relative to the root of the instance
+
+        The configuration shipped with Moodle, phpunit.xml.dist, is read when PHPUnit has not
+        been initialised yet."""
+        root = self.M.get('path')
+        for name in ['phpunit.xml', 'phpunit.xml.dist']:
+            config = os.path.join(root, name)
+            if os.path.isfile(config):
+                break
+        else:
+            raise Exception('Could not find the configuration of PHPUnit, phpunit.xml')
+
+        def resolve(element):
+            return os.path.normpath(os.path.join(root, element.text.strip()))
+
+        files = set()
+        for suite in ET.parse(config).getroot().iter('testsuite'):
+            excluded = set([resolve(exclude) for exclude in suite.findall('exclude') if exclude.text])
+            for directory in suite.findall('directory'):
+                if not directory.text:
+                    continue
+                prefix = directory.get('prefix', '')
+                suffix = directory.get('suffix', 'Test.php')
+                for (dirpath, dirnames, filenames) in os.walk(resolve(directory)):
+                    dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) not in excluded]
+                    for filename in filenames:
+                        path = os.path.join(dirpath, filename)
+                        if filename.startswith(prefix) and filename.endswith(suffix) and path not in excluded:
+                            files.add(path)
+            for element in suite.findall('file'):
+                if element.text and os.path.isfile(resolve(element)):
+                    files.add(resolve(element))
+
+        return sorted([os.path.relpath(test, root) for test in files])
+
+    def init(self, force=False):
+        """Initialise the PHPUnit environment of each shard"""
+        M = self.M
+        with M.lock():
+            M.initPHPUnit(force=force)
+
+            code = None
+            if self.shards > 1:
+                code = '\n'.join([
+                    "if ($mdkshard = (int) getenv('%s')) {" % _shardVariable,
+                    "    $CFG->phpunit_prefix = rtrim($CFG->phpunit_prefix, '_') . $mdkshard . '_';",
+                    "    $CFG->phpunit_dataroot .= $mdkshard;",
+                    "}"
+                ])
+            with M.editConfig() as config:
+                config.setBlock('PHPUnit shards', code)
+
+            if self.shards < 2:
+                return
+
+            def initShard(shard):
+                dataroot = self.getShardDataroot(shard)
+                if not os.path.isdir(dataroot):
+                    mkdir(dataroot, 0777)
+
+                env = self.getShardEnv(shard)
+                if force:
+                    M.cli('/admin/tool/phpunit/cli/util.php', args='--drop', env=env)
+                result = M.cli('/admin/tool/phpunit/cli/init.php', env=env)
+                if result[0] != 0:
+                    logging.debug(result[1])
+                    raise Exception('Error while initialising the PHPUnit environment of shard %d' % shard)
+
+            logging.info('Initialising %d other PHPUnit environments...' % (self.shards - 1))
+            results = parallel(initShard, range(1, self.shards), self.shards)
+            failed = False
+            for (shard, result, exception) in results:
+                if exception != None:
+                    logging.error('Shard %d: %s' % (shard, exception))
+                    failed = True
+            if failed:
+                raise Exception('Could not initialise the PHPUnit environments')
+
+    def _parseJUnit(self, paths):
+        """Parse the JUnit reports, returns their test suites, the totals and the timings of the tests"""
+        suites = []
+        totals = {'tests': 0, 'assertions': 0, 'failures': 0, 'errors': 0, 'time': 0.0}
+        timings = []
+        files = {}
+
+        for path in paths:
+            if not os.path.isfile(path):
+                continue
+            root = ET.parse(path).getroot()
+            for suite in root.findall('testsuite'):
+                suites.append(suite)
+                for key in totals.keys():
+                    totals[key] += type(totals[key])(suite.get(key, 0))
+
+            # The suites of the test classes refer to their file, the ones of the data providers are named class::method.
+            for suite in root.iter('testsuite'):
+                if not suite.get('file') or '::' in suite.get('name', ''):
+                    continue
+                item = os.path.relpath(suite.get('file'), self.M.get('path'))
+                duration = float(suite.get('time', 0))
+                failed = int(suite.get('failures', 0)) + int(suite.get('errors', 0)) > 0
+                timings.append((item, suite.get('name'), duration, failed))
+                (total, anyFailed) = files.get(item, (0.0, False))
+                files[item] = (total + duration, anyFailed or failed)
+
+        timings += [(test, '', fileDuration, fileFailed) for (test, (fileDuration, fileFailed)) in files.items()]
+        return (suites, totals, timings)
+
+    def record(self, paths):
+        """Record the timings of the tests from their JUnit reports"""
+        (suites, totals, timings) = self._parseJUnit(paths)
+        Timings().record('phpunit', self.M, timings)
+
+    def run(self, phpunit, junit=None, files=None):
+        """Run the tests, returns whether they passed. A merged JUnit report is written to junit
+
+        The files to test default to all the test files of the instance."""
+        M = self.M
+        if files == None:
+            files = self.getTestFiles()
+        timings = Timings()
+        shards = timings.schedule('phpunit', M.get('branch'), files, self.shards)
+        logging.info('Running %d test files in %d shards...' % (sum([len(shardFiles) for shardFiles in shards]), len(shards)))
+
+        configs = [self._writeConfig(shard, shardFiles) for (shard, shardFiles) in enumerate(shards)]
+        reports = [os.path.join(self.getShardDataroot(shard), 'junit.xml') for shard in range(len(shards))]
+
+        def runShard(shard):
+            if os.path.isfile(reports[shard]):
+                os.remove(reports[shard])
+            cmd = [phpunit, '-c', configs[shard], '--log-junit', reports[shard]]
+            result = process(cmd, cwd=M.get('path'), stdout=None, stderr=None, env=self.getShardEnv(shard), limited=False)
+            if result[0] != 0:
+                raise Exception('Some tests did not pass')
+
+        try:
+            failed = InstanceExecutor('phpunit', jobs=len(shards)).run(runShard, range(len(shards)),
+                identifier=lambda shard: '%s-shard%d' % (M.get('identifier'), shard))
+        finally:
+            for config in configs:
+                os.remove(config)
+
+        (suites, totals, testTimings) = self._parseJUnit(reports)
+        if junit:
+            merged = ET.Element('testsuites')
+            merged.extend(suites)
+            ET.ElementTree(merged).write(junit, encoding='UTF-8', xml_declaration=True)
+        logging.info('Tests: %d, Assertions: %d, Failures: %d, Errors: %d, Time: %.1fs' % (totals['tests'],
+            totals['assertions'], totals['failures'], totals['errors'], totals['time']))
+        timings.record('phpunit', M, testTimings)
+        return len(failed) == 0
+
+    def _writeConfig(self, shard, files):
+        """Write the PHPUnit configuration of a shard, based on phpunit.xml, returns its path"""
+        tree = ET.parse(os.path.join(self.M.get('path'), 'phpunit.xml'))
+        root = tree.getroot()
+        for suites in root.findall('testsuites'):
+            root.remove(suites)
+
+        suites = ET.SubElement(root, 'testsuites')
+        suite = ET.SubElement(suites, 'testsuite', {'name': 'mdk_shard_%d' % shard})
+        for f in files:
+            ET.SubElement(suite, 'file').text = f
+
+        # In the root of the instance, the paths in the configuration are relative to it.
+        path = os.path.join(self.M.get('path'), 'phpunit.mdk-shard%d.xml' % shard)
+        tree.write(path, encoding='UTF-8', xml_declaration=True)
+        return path
@@ -144,21 +144,112 @@ class PluginManager(object):
                 if not os.path.isfile(subpluginsfile):
                     continue
 
-                regex = re.compile(r'^\s*(?P<brackets>[\'"])(.*)(?P=brackets)\s*=>\s*(?P=brackets)(.*)(?P=brackets)')
-
-                searchOpen = False
-                f = open(subpluginsfile, 'r')
-                for line in f:
-                    if '$subplugins' in line:
-                        searchOpen = True
-
-                    if searchOpen:
-                        search = regex.findall(line)
-                        if search:
-                            for match in search:
-                                subtypes[match[1]] = match[2].replace('admin/', '{admin}/')
+                for (subtype, subpath) in cls._parseSubplugins(subpluginsfile).items():
+                    subtypes[subtype] = subpath.replace('admin/', '{admin}/')
         return subtypes
 
+    @classmethod
+    def _parseSubplugins(cls, subpluginsfile):
+        """Return the directories of the sub plugin types declared in a db/subplugins.php file"""
+        subtypes = {}
+        regex = re.compile(r'(?P<brackets>[\'"])([^\'"]+)(?P=brackets)\s*=>\s*(?P=brackets)([^\'"]+)(?P=brackets)')
+
+        searchOpen = False
+        f = open(subpluginsfile, 'r')
+        for line in f:
+            if '$subplugins' in line:
+                searchOpen = True
+
+            if searchOpen:
+                search = regex.findall(line)
+                if search:
+                    for match in search:
+                        subtypes[match[1]] = match[2]
+        f.close()
+        return subtypes
+
+    @classmethod
+    def getPluginTypes(cls, M, path=None):
+        """Returns the directories of all the plugin types of an instance, sub plugins included.
+
+        The directories are relative to the root of the instance, or of path when set. The types
+        are read from lib/components.json when it exists."""
+        root = path if path != None else M.get('path')
+        types = {}
+
+        components = os.path.join(root, 'lib', 'components.json')
+        if os.path.isfile(components):
+            with open(components, 'r') as f:
+                types.update(json.load(f).get('plugintypes', {}))
+        else:
+            for (t, typePath) in cls._pluginTypesPath.items():
+                types[t] = typePath.replace('{admin}', M.get('admin', 'admin')).strip('/')
+
+        # Any plugin can declare sub plugins, which can declare their own.
+        queue = types.items()
+        while queue:
+            (t, typePath) = queue.pop()
+            typeDir = os.path.join(root, typePath)
+            if not os.path.isdir(typeDir):
+                continue
+            for name in os.listdir(typeDir):
+                subpluginsfile = os.path.join(typeDir, name, 'db', 'subplugins.php')
+                if not os.path.isfile(subpluginsfile):
+                    continue
+                for (subtype, subpath) in cls._parseSubplugins(subpluginsfile).items():
+                    if subtype not in types:
+                        types[subtype] = subpath.replace('admin/', M.get('admin', 'admin') + '/').strip('/')
+                        queue.append((subtype, types[subtype]))
+
+        return types
+
+    @classmethod
+    def getComponents(cls, M, files):
+        """Returns the components the files belong to, with their directory, indexed by component.
+
+        The files and directories are relative to the root of the instance. The files of core
+        belong to its subsystems, read from lib/components.json when it exists, or named after
+        the top directory of the file. The remaining ones belong to core, in the directory lib."""
+        root = M.get('path')
+        types = cls.getPluginTypes(M)
+
+        subsystems = {}
+        componentsFile = os.path.join(root, 'lib', 'components.json')
+        if os.path.isfile(componentsFile):
+            with open(componentsFile, 'r') as f:
+                for (name, path) in json.load(f).get('subsystems', {}).items():
+                    if path:
+                        subsystems['core_%s' % name] = path.strip('/')
+
+        components = {}
+        for f in files:
+            component = None
+
+            # The deepest plugin type first, sub plugins are within their plugin.
+            for (t, typePath) in sorted(types.items(), key=lambda item: len(item[1]), reverse=True):
+                if not f.startswith(typePath + '/'):
+                    continue
+                name = f[len(typePath) + 1:].split('/')[0]
+                if os.path.isfile(os.path.join(root, typePath, name, 'version.php')):
+                    component = ('%s_%s' % (t, name), '%s/%s' % (typePath, name))
+                    break
+
+            if not component:
+                for (name, path) in sorted(subsystems.items(), key=lambda item: len(item[1]), reverse=True):
+                    if f.startswith(path + '/'):
+                        component = (name, path)
+                        break
+
+            if not component:
+                top = f.split('/')[0]
+                if top != 'lib' and '/' in f and os.path.isdir(os.path.join(root, top)):
+                    component = ('core_%s' % top, top)
+                else:
+                    component = ('core', 'lib')
+
+            components[component[0]] = component[1]
+        return components
+
     @classmethod
     def getTypeDirectory(cls, t, M=None):
         """Returns the path to the plugin type directory. If M is passed, the full path is returned."""
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import string
+import sys
+import time
+import urlparse
+from config import Conf
+from db import DB
+from lock import Lock
+from tools import chmodRecursive
+
+C = Conf()
+
+# The directories of the dataroot which are not part of a template, they are rebuilt as needed.
+_ignoredDirs = ['cache', 'localcache', 'lock', 'sessions', 'temp', 'trashdir']
+
+
+class InstallTemplate(object):
+    """Snapshot of the database and dataroot of a fresh installation
+
+    A template is identified by the content of version.php, the options given to the installer
+    and the database engine. An instance with the same version.php and options can be installed
+    by copying the template rather than running the installer. The database is copied by the
+    server, and the settings specific to the instance are rewritten afterwards.
+    """
+
+    dbname = None
+    digest = None
+    engine = None
+    key = None
+    path = None
+
+    def __init__(self, engine, digest):
+        self.digest = digest
+        self.engine = engine
+        self.key = '%s-%s' % (engine, digest)
+        self.dbname = 'mdktpl_%s_%s' % (engine, digest)
+        self.path = os.path.join(os.path.expanduser(C.get('dirs.mdk')), 'templates', self.key)
+
+    def apply(self, M, dbname, dataDir, wwwroot, fullname):
+        """Install M from the template, the database dbname must not exist
+
+        When the installation fails, the database and the files created from the template are
+        removed before the exception is raised. What was in dataDir before is left untouched."""
+        source = os.path.join(self.path, 'dataroot')
+        configFile = os.path.join(M.get('path'), 'config.php')
+        conflicts = [name for name in os.listdir(source) if os.path.lexists(os.path.join(dataDir, name))]
+        if conflicts:
+            raise Exception('The data directory already contains %s' % ', '.join(sorted(conflicts)))
+        elif os.path.lexists(configFile):
+            raise Exception('The file %s already exists' % configFile)
+
+        created = []
+        db = DB(self.engine, C.get('db.%s' % self.engine))
+        try:
+            if db.dbexists(dbname):
+                raise Exception('The database %s already exists' % dbname)
+
+            try:
+                logging.info('Copying the database of the template...')
+                db.copydb(self.dbname, dbname)
+
+                logging.info('Copying the data directory of the template...')
+                for name in os.listdir(source):
+                    path = os.path.join(dataDir, name)
+                    created.append(path)
+                    self._copy(os.path.join(source, name), path)
+                    chmodRecursive(path, 0777)
+
+                created.append(configFile)
+                shutil.copyfile(os.path.join(self.path, 'config.php'), configFile)
+                os.chmod(configFile, 0666)
+                M.reload()
+                with M.editConfig() as config:
+                    config.set('wwwroot', wwwroot)
+                    config.set('dataroot', dataDir)
+                    config.set('dbname', dbname)
+                    config.set('sessioncookiepath', '/%s/' % M.get('identifier'))
+
+                # The site identifier must be unique, it is used to name the sessions and caches.
+                logging.info('Renaming the site...')
+                host = urlparse.urlparse(wwwroot).hostname or ''
+                identifier = ''.join([random.choice(string.ascii_letters + string.digits) for i in range(32)]) + host
+                prefix = M.get('prefix')
+                db.selectdb(dbname)
+                db.execute('UPDATE %scourse SET fullname = %%s, shortname = %%s WHERE id = 1' % prefix, (fullname, M.get('identifier')))
+                db.execute('UPDATE %sconfig SET value = %%s WHERE name = %%s' % prefix, (identifier, 'siteidentifier'))
+                db.commit()
+            except:
+                info = sys.exc_info()
+                self._revert(M, db, dbname, created)
+                raise info[0], info[1], info[2]
+        finally:
+            db.close()
+
+    def _copy(self, source, target):
+        """Copy a file, a symbolic link or a directory"""
+        if os.path.islink(source):
+            os.symlink(os.readlink(source), target)
+        elif os.path.isdir(source):
+            shutil.copytree(source, target, symlinks=True)
+        else:
+            shutil.copy2(source, target)
+
+    def exists(self):
+        if not os.path.isfile(os.path.join(self.path, 'info.json')):
+            return False
+        db = DB(self.engine, C.get('db.%s' % self.engine))
+        try:
+            return db.dbexists(self.dbname)
+        finally:
+            db.close()
+
+    @staticmethod
+    def getForInstance(M, engine, options):
+        """Return the template matching the version.php of M and the options of the installer"""
+        with open(os.path.join(M.get('path'), 'version.php'), 'r') as f:
+            content = f.read()
+        digest = hashlib.sha1(content + json.dumps(options, sort_keys=True)).hexdigest()[:16]
+        return InstallTemplate(engine, digest)
+
+    def lock(self, exclusive=True):
+        return Lock(self.path + '.lock', exclusive=exclusive)
+
+    def _revert(self, M, db, dbname, created):
+        """Remove the database and the files created by a failed application of the template"""
+        for path in reversed(created):
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                elif os.path.lexists(path):
+                    os.remove(path)
+            except Exception as e:
+                logging.warning('Could not remove %s' % path)
+                logging.debug(e)
+        try:
+            if db.dbexists(dbname):
+                db.dropdb(dbname)
+        except Exception as e:
+            logging.warning('Could not drop the database %s' % dbname)
+            logging.debug(e)
+        M.reload()
+
+    def remove(self):
+        """Delete the template"""
+        db = DB(self.engine, C.get('db.%s' % self.engine))
+        try:
+            if db.dbexists(self.dbname):
+                db.dropdb(self.dbname)
+        finally:
+            db.close()
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+
+    def save(self, M):
+        """Create the template from M, which has just been installed"""
+        if self.exists():
+            return
+
+        logging.info('Saving the installation as a template...')
+        if os.path.isdir(self.path):
+            self.remove()
+
+        db = DB(self.engine, C.get('db.%s' % self.engine))
+        try:
+            db.copydb(M.get('dbname'), self.dbname)
+        finally:
+            db.close()
+
+        ignore = lambda directory, names: [name for name in names if name in _ignoredDirs] if directory == M.get('dataroot') else []
+        shutil.copytree(M.get('dataroot'), os.path.join(self.path, 'dataroot'), symlinks=True, ignore=ignore)
+        shutil.copyfile(os.path.join(M.get('path'), 'config.php'), os.path.join(self.path, 'config.php'))
+
+        # Written last, the template is not used until then.
+        info = {
+            'branch': M.get('branch'),
+            'created': int(time.time()),
+            'digest': self.digest,
+            'engine': self.engine,
+            'release': M.get('release')
+        }
+        with open(os.path.join(self.path, 'info.json'), 'w') as f:
+            json.dump(info, f, sort_keys=True, indent=4)
+
+        self._removeOutdated(info)
+
+    def _removeOutdated(self, info):
+        """Remove the templates replaced by this one, they are for the same branch and engine"""
+        directory = os.path.dirname(self.path)
+        for key in os.listdir(directory):
+            path = os.path.join(directory, key)
+            if key == self.key or not os.path.isfile(os.path.join(path, 'info.json')):
+                continue
+            try:
+                with open(os.path.join(path, 'info.json'), 'r') as f:
+                    other = json.load(f)
+            except ValueError:
+                continue
+            if other.get('branch') != info['branch'] or other.get('engine') != info['engine']:
+                continue
+
+            logging.debug('Removing the outdated template %s' % key)
+            template = InstallTemplate(other['engine'], other['digest'])
+            with template.lock():
+                template.remove()
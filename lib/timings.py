@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import heapq
+import os
+import sqlite3
+import time
+from config import Conf
+
+C = Conf()
+
+# The number of latest measures averaged to estimate the duration of a test.
+_sampleSize = 5
+
+_schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    instance TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    version TEXT,
+    created INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS timings (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    item TEXT NOT NULL,
+    name TEXT NOT NULL DEFAULT '',
+    duration REAL NOT NULL,
+    failed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS runs_kind_branch ON runs (kind, branch);
+CREATE INDEX IF NOT EXISTS timings_run ON timings (run);
+"""
+
+
+def schedule(items, durations, count):
+    """Distribute the items in count groups, the longest first, each in the group ending first
+
+    The items without a known duration are expected to last as long as the median one.
+    Returns the list of items of each group, the empty groups are left out."""
+    known = sorted(durations.values())
+    default = known[len(known) / 2] if known else 1.0
+
+    heap = [(0.0, index, []) for index in range(max(1, count))]
+    for item in sorted(items, key=lambda item: durations.get(item, default), reverse=True):
+        (total, group, assigned) = heapq.heappop(heap)
+        assigned.append(item)
+        heapq.heappush(heap, (total + durations.get(item, default), group, assigned))
+
+    return [groupItems for (groupTotal, groupIndex, groupItems) in sorted(heap, key=lambda entry: entry[1]) if groupItems]
+
+
+class Timings(object):
+    """The durations of the tests measured on the instances, stored in a SQLite database
+
+    Each run of the tests of an instance is recorded along with its kind (phpunit or behat),
+    branch and version. The timings of a run are indexed by item, the test file or feature,
+    and name. The timings without a name are the ones of the whole item, which is the unit
+    the tests are scheduled by, the others detail its test classes or scenarios.
+    """
+
+    path = None
+
+    def __init__(self, path=None):
+        if path == None:
+            path = os.path.join(os.path.expanduser(C.get('dirs.mdk')), 'timings.sqlite')
+        self.path = path
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.executescript(_schema)
+        return db
+
+    def getDurations(self, kind, branch):
+        """Return the estimated duration of each item, the average of its latest measures"""
+        measures = self._getMeasures(kind, branch, _sampleSize)
+        return dict([(item, sum(samples) / len(samples)) for (item, samples) in measures.items()])
+
+    def _getMeasures(self, kind, branch, size):
+        """Return the latest measures of each item, the most recent first"""
+        db = self._connect()
+        try:
+            rows = db.execute("""SELECT t.item, t.duration
+                                   FROM timings t
+                                   JOIN runs r ON r.id = t.run
+                                  WHERE r.kind = ? AND r.branch = ? AND t.name = ''
+                               ORDER BY r.created DESC, r.id DESC""", (kind, str(branch))).fetchall()
+        finally:
+            db.close()
+
+        measures = {}
+        for (item, duration) in rows:
+            samples = measures.setdefault(item, [])
+            if len(samples) < size:
+                samples.append(duration)
+        return measures
+
+    def getRegressions(self, kind, branch, ratio=1.5, limit=20):
+        """Return the items which lasted longer than usual during their latest run
+
+        Returns a list of tuples (item, latest duration, average of the previous measures)."""
+        # The latest measure is compared to the ones preceding it.
+        measures = self._getMeasures(kind, branch, _sampleSize + 1)
+        regressions = []
+        for (item, samples) in measures.items():
+            if len(samples) < 2:
+                continue
+            average = sum(samples[1:]) / len(samples[1:])
+            if average > 0 and samples[0] / average >= ratio:
+                regressions.append((item, samples[0], average))
+        return sorted(regressions, key=lambda regression: regression[1] / regression[2], reverse=True)[:limit]
+
+    def getSlowest(self, kind, branch=None, details=False, limit=20):
+        """Return the slowest items, or their classes and scenarios, from their latest measure
+
+        Returns a list of tuples (item, name, duration, failed)."""
+        conditions = ['r.kind = ?', "t.name != ''" if details else "t.name = ''"]
+        params = [kind]
+        if branch != None:
+            conditions.append('r.branch = ?')
+            params.append(str(branch))
+        query = """SELECT t.item, t.name, t.duration, t.failed, r.branch
+                     FROM timings t
+                     JOIN runs r ON r.id = t.run
+                    WHERE %s
+                 ORDER BY r.created DESC, r.id DESC""" % ' AND '.join(conditions)
+
+        db = self._connect()
+        try:
+            rows = db.execute(query, params).fetchall()
+        finally:
+            db.close()
+
+        latest = {}
+        for (item, name, duration, failed, rowBranch) in rows:
+            latest.setdefault((rowBranch, item, name), (item, name, duration, bool(failed)))
+        return sorted(latest.values(), key=lambda timing: timing[2], reverse=True)[:limit]
+
+    def getTrend(self, kind, item, branch=None, limit=20):
+        """Return the latest measures of an item
+
+        Returns a list of tuples (created, instance, version, duration, failed), oldest first."""
+        conditions = ['r.kind = ?', 't.item = ?', "t.name = ''"]
+        params = [kind, item]
+        if branch != None:
+            conditions.append('r.branch = ?')
+            params.append(str(branch))
+        query = """SELECT r.created, r.instance, r.version, t.duration, t.failed
+                     FROM timings t
+                     JOIN runs r ON r.id = t.run
+                    WHERE %s
+                 ORDER BY r.created DESC, r.id DESC
+                    LIMIT ?""" % ' AND '.join(conditions)
+        params.append(limit)
+
+        db = self._connect()
+        try:
+            rows = db.execute(query, params).fetchall()
+        finally:
+            db.close()
+        return [(created, instance, version, duration, bool(failed)) for (created, instance, version, duration, failed) in reversed(rows)]
+
+    def record(self, kind, M, timings):
+        """Record a run of the tests of M
+
+        The timings are a list of tuples (item, name, duration, failed)."""
+        if not timings:
+            return
+
+        db = self._connect()
+        try:
+            with db:
+                cursor = db.execute('INSERT INTO runs (kind, instance, branch, version, created) VALUES (?, ?, ?, ?, ?)',
+                    (kind, M.get('identifier'), str(M.get('branch')), M.get('version'), int(time.time())))
+                db.executemany('INSERT INTO timings (run, item, name, duration, failed) VALUES (?, ?, ?, ?, ?)',
+                    [(cursor.lastrowid, item, name or '', duration, 1 if failed else 0) for (item, name, duration, failed) in timings])
+        finally:
+            db.close()
+
+    def schedule(self, kind, branch, items, count):
+        """Distribute the items in count groups according to their estimated durations, see schedule()"""
+        return schedule(items, self.getDurations(kind, branch), count)
@@ -24,7 +24,11 @@ http://github.com/FMCorz/mdk
 
 import sys
 import os
+import collections
+import contextlib
+import errno
 import signal
+import socket
 import subprocess
 import shlex
 import re
@@ -32,6 +36,20 @@ import threading
 import getpass
 import logging
 import hashlib
+import multiprocessing
+import Queue
+import time
+from exceptions import ProcessTimeout
+
+# Limits the number of processes running at the same time, see setProcessLimit().
+_processLimit = None
+_processLimitLock = threading.Lock()
+
+# Whether each thread is running a limited process, see _processTurn().
+_processTurns = threading.local()
+
+# Where the output of each thread goes, see captureOutput().
+_threadOutput = threading.local()
 
 
 def yesOrNo(q):
@@ -62,6 +80,16 @@ def question(q, default=None, options=None, password=False):
         return i
 
 
+def captureOutput(func=None):
+    """Send the output of the current thread to func(text, stream), stop capturing when func is None
+
+    This applies to the output of the processes started with stdout and stderr set to None, and
+    to what is written to the streams wrapped in a ThreadOutput. The stream passed to func is the
+    one the text was written to, or None for the output of processes.
+    """
+    _threadOutput.capture = func
+
+
 def chmodRecursive(path, chmod):
     os.chmod(path, chmod)
     for (dirpath, dirnames, filenames) in os.walk(path):
@@ -73,6 +101,14 @@ def chmodRecursive(path, chmod):
             os.chmod(file, chmod)
 
 
+def cpuCount():
+    """Return the number of CPUs, or 1 if that cannot be determined"""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
 def getMDLFromCommitMessage(message):
     """Return the MDL-12345 number from a commit message"""
     mdl = None
@@ -110,6 +146,52 @@ def mkdir(path, perms=0755):
     os.umask(oldumask)
 
 
+def parallel(func, items, jobs=None):
+    """Call func on each item, with at most jobs threads running at the same time
+
+    Returns a list of tuples (item, result, exception) in the same order as items.
+    An exception raised by func does not stop the processing of the other items.
+    """
+    items = list(items)
+    if jobs == None:
+        jobs = cpuCount()
+    jobs = max(1, min(int(jobs), len(items)))
+    results = [None] * len(items)
+
+    queue = Queue.Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def work():
+        while True:
+            try:
+                (i, item) = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (item, func(item), None)
+            except Exception as e:
+                logging.debug('Error while processing %s: %s' % (item, e))
+                results[i] = (item, None, e)
+
+    if jobs == 1:
+        work()
+        return results
+
+    threads = []
+    for j in range(jobs):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        # Joining with a timeout keeps the main thread responsive to KeyboardInterrupt.
+        while thread.is_alive():
+            thread.join(1)
+
+    return results
+
+
 def parseBranch(branch, pattern):
     pattern = re.compile(pattern, flags=re.I)
     result = pattern.search(branch)
@@ -126,15 +208,122 @@ def parseBranch(branch, pattern):
     return result
 
 
-def process(cmd, cwd=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+def process(cmd, cwd=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=None, env=None, limited=True):
+    """Run a process and wait for it, returns (returncode, stdout, stderr)
+
+    The process waits for its turn when the maximum number of processes are running, see
+    setProcessLimit(). The long-running processes, such as the test runs, are not limited
+    with limited=False, they would hold their turn for as long as they run. When the timeout
+    (in seconds) is reached the process is killed and ProcessTimeout is raised. The variables
+    of env are added to the environment of the process.
+    """
     if type(cmd) != list:
         cmd = shlex.split(str(cmd))
-    logging.debug(' '.join(cmd))
-    proc = subprocess.Popen(cmd, cwd=cwd, stdout=stdout, stderr=stderr)
-    (out, err) = proc.communicate()
+
+    # The output which would have gone to the terminal is captured, see captureOutput().
+    capture = getattr(_threadOutput, 'capture', None)
+    if capture and stdout == None and stderr == None:
+        stdout = subprocess.PIPE
+        stderr = subprocess.STDOUT
+    else:
+        capture = None
+
+    with _processTurn(limited):
+        logging.debug(' '.join(cmd))
+        if env:
+            env = dict(os.environ, **env)
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=stdout, stderr=stderr, env=env)
+
+        timer = None
+        expired = []
+        if timeout:
+            def kill():
+                expired.append(True)
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+            timer = threading.Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            if capture:
+                # Reading what is available rather than lines, prompts are not held back.
+                for chunk in iter(lambda: os.read(proc.stdout.fileno(), 4096), ''):
+                    capture(chunk, None)
+                proc.stdout.close()
+                proc.wait()
+                (out, err) = (None, None)
+            else:
+                (out, err) = proc.communicate()
+        finally:
+            if timer:
+                timer.cancel()
+
+    if expired:
+        raise ProcessTimeout('%s did not complete within %ss' % (' '.join(cmd), timeout))
     return (proc.returncode, out, err)
 
 
+def processAsync(cmd, cwd=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=None, env=None, limited=True):
+    """Run a process in the background, returns a ProcessFuture
+
+    The arguments are the same as for process(), which is called from a separate thread.
+    """
+    future = ProcessFuture(cmd)
+    capture = getattr(_threadOutput, 'capture', None)
+
+    def run():
+        captureOutput(capture)
+        try:
+            future._setResult(process(cmd, cwd=cwd, stdout=stdout, stderr=stderr, timeout=timeout, env=env, limited=limited))
+        except Exception as e:
+            future._setException(e)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+def setProcessLimit(limit=None):
+    """Set the maximum number of limited processes running at the same time, see process()
+
+    Defaults to twice the number of CPUs, as a lot of processes wait on the network. The
+    processes run from threads, each of them waits for its turn on a semaphore.
+    """
+    global _processLimit
+    if not limit:
+        limit = max(4, cpuCount() * 2)
+    with _processLimitLock:
+        _processLimit = threading.BoundedSemaphore(int(limit))
+
+
+def _getProcessLimit():
+    """Return the semaphore limiting the number of processes"""
+    if _processLimit == None:
+        setProcessLimit()
+    return _processLimit
+
+
+@contextlib.contextmanager
+def _processTurn(limited=True):
+    """Wait for the turn of a process, see setProcessLimit()
+
+    A thread which already has a turn does not wait for another one, it could wait for itself."""
+    if not limited or getattr(_processTurns, 'held', False):
+        yield
+        return
+
+    with _getProcessLimit():
+        _processTurns.held = True
+        try:
+            yield
+        finally:
+            _processTurns.held = False
+
+
 def downloadProcessHook(count, size, total):
     """Hook to report the downloading a file using urllib.urlretrieve"""
     if count <= 0:
@@ -147,42 +336,263 @@ def downloadProcessHook(count, size, total):
     sys.stderr.flush()
 
 
+def isPortOpen(port, host='localhost'):
+    """Whether a process accepts connections on the port"""
+    try:
+        socket.create_connection((host, port), 1).close()
+        return True
+    except socket.error:
+        return False
+
+
 def stableBranch(version):
     if version == 'master':
         return 'master'
     return 'MOODLE_%d_STABLE' % int(version)
 
 
-class ProcessInThread(threading.Thread):
-    """Executes a process in a separate thread"""
+def which(program):
+    """Return the path of the executable started for program, found in PATH as the system does, or None"""
+    if os.path.dirname(program):
+        return program
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory or os.curdir, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+class ProcessFuture(object):
+    """The result of a process running in the background, see processAsync()"""
 
     cmd = None
-    cwd = None
-    stdout = None
-    stderr = None
-    _kill = False
-    _pid = None
-
-    def __init__(self, cmd, cwd=None, stdout=subprocess.PIPE, stderr=subprocess.PIPE):
-        threading.Thread.__init__(self)
-        if type(cmd) != 'list':
-            cmd = shlex.split(str(cmd))
+
+    def __init__(self, cmd):
         self.cmd = cmd
-        self.cwd = cwd
-        self.stdout = stdout
-        self.stderr = stderr
+        self._callbacks = []
+        self._done = threading.Event()
+        self._exception = None
+        self._lock = threading.Lock()
+        self._result = None
+
+    def addDoneCallback(self, func):
+        """Call func with this future once the process has completed, now if it already has"""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def done(self):
+        """Whether the process has completed"""
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        """Wait for the process and return the exception it raised, if any"""
+        self._wait(timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        """Wait for the process and return (returncode, stdout, stderr), or raise its exception"""
+        self._wait(timeout)
+        if self._exception != None:
+            raise self._exception
+        return self._result
+
+    def _setException(self, exception):
+        self._set(None, exception)
+
+    def _setResult(self, result):
+        self._set(result, None)
+
+    def _set(self, result, exception):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for func in callbacks:
+            try:
+                func(self)
+            except Exception as e:
+                logging.debug('Error in the callback of %s: %s' % (' '.join(self.cmd), e))
+
+    def _wait(self, timeout=None):
+        """Wait for the process to complete, raises ProcessTimeout if it does not in time"""
+        # Waiting in short steps keeps the main thread responsive to KeyboardInterrupt.
+        start = time.time()
+        while not self._done.is_set():
+            remaining = 1 if timeout == None else timeout - (time.time() - start)
+            if remaining <= 0:
+                raise ProcessTimeout('%s did not complete within %ss' % (' '.join(self.cmd), timeout))
+            self._done.wait(min(1, remaining))
+
+
+class ProcessSupervisor(object):
+    """Runs processes in the background, such as servers, to be used as a context manager
+
+    The processes are stopped when leaving the context, see SupervisedProcess.stop().
+    """
+
+    def __init__(self):
+        self._processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stopAll()
+
+    def start(self, cmd, cwd=None, env=None, log=None, port=None, timeout=30):
+        """Start a process, returns its SupervisedProcess
+
+        The output of the process is written to the file log, or to the terminal when log is
+        None. When port is set, this waits for the process to accept connections on it, an
+        exception is raised when it does not within timeout seconds."""
+        if port and isPortOpen(port):
+            raise Exception('Cannot start %s, the port %d is already in use' % (cmd, port))
+
+        proc = SupervisedProcess(cmd, cwd=cwd, env=env, log=log)
+        self._processes.append(proc)
+        if port:
+            proc.waitForPort(port, timeout=timeout)
+        return proc
+
+    def stopAll(self, timeout=10):
+        """Stop the processes, the last started first"""
+        while self._processes:
+            self._processes.pop().stop(timeout)
+
+
+class RingLog(object):
+    """Log file limited in size, the older output is moved to path.1 which it replaces"""
+
+    path = None
+    size = 0
+    maxSize = None
+
+    _file = None
+
+    def __init__(self, path, maxSize=5242880):
+        self.path = path
+        self.maxSize = maxSize
+        self._file = open(path, 'w')
+
+    def close(self):
+        self._file.close()
+
+    def write(self, data):
+        if self.size + len(data) > self.maxSize and self.size > 0:
+            self._file.close()
+            os.rename(self.path, self.path + '.1')
+            self._file = open(self.path, 'w')
+            self.size = 0
+        self._file.write(data)
+        self._file.flush()
+        self.size += len(data)
+
+
+class SupervisedProcess(object):
+    """Process running in the background, see ProcessSupervisor
+
+    The process is the leader of a new session, stopping it terminates the processes it started
+    as well. A thread writes its output to the log and waits for it to exit, nothing is polled.
+    """
 
-    def kill(self):
-        os.kill(self._pid, signal.SIGKILL)
+    cmd = None
+    log = None
+    pid = None
+    returncode = None
 
-    def run(self):
-        logging.debug(' '.join(self.cmd))
-        proc = subprocess.Popen(self.cmd, cwd=self.cwd, stdout=self.stdout, stderr=self.stderr)
-        self._pid = proc.pid
-        while True:
-            if proc.poll():
-                break
+    def __init__(self, cmd, cwd=None, env=None, log=None):
+        if type(cmd) != list:
+            cmd = shlex.split(str(cmd))
+        self.cmd = cmd
+        self.log = log
+        self._exited = threading.Event()
+        self._tail = collections.deque(maxlen=20)
+
+        logging.debug(' '.join(cmd))
+        if env:
+            env = dict(os.environ, **env)
+        output = subprocess.PIPE if log else None
+        self._proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=output, stderr=subprocess.STDOUT if log else None,
+            close_fds=True, preexec_fn=os.setsid)
+        self.pid = self._proc.pid
+
+        thread = threading.Thread(target=self._supervise)
+        thread.daemon = True
+        thread.start()
+
+    def isRunning(self):
+        return not self._exited.is_set()
+
+    def stop(self, timeout=10):
+        """Terminate the process and the ones it started, they are killed after timeout seconds"""
+        try:
+            os.killpg(self.pid, signal.SIGTERM)
+            if not self._exited.wait(timeout):
+                logging.debug('Killing %s, it did not stop within %ss' % (' '.join(self.cmd), timeout))
+                os.killpg(self.pid, signal.SIGKILL)
+                self._exited.wait(timeout)
+        except OSError as e:
+            # The processes have already exited.
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _supervise(self):
+        """Write the output of the process to its log until it closes it, then wait for it"""
+        if self.log:
+            log = RingLog(self.log)
+            try:
+                for line in iter(self._proc.stdout.readline, ''):
+                    log.write(line)
+                    self._tail.append(line)
+            finally:
+                log.close()
+                self._proc.stdout.close()
+        self.returncode = self._proc.wait()
+        self._exited.set()
+
+    def tail(self):
+        """The latest lines of output of the process"""
+        return ''.join(self._tail)
+
+    def waitForPort(self, port, host='localhost', timeout=30):
+        """Wait for the process to accept connections on the port, the attempts are further and further apart
+
+        Raises an exception when the process exits, or does not accept connections within
+        timeout seconds."""
+        start = time.time()
+        delay = 0.1
+        while not isPortOpen(port, host):
+            if not self.isRunning():
+                raise Exception('%s exited with the code %s\n%s' % (' '.join(self.cmd), self.returncode, self.tail()))
+            elif time.time() - start >= timeout:
+                raise Exception('%s did not accept connections on port %d within %ss' % (' '.join(self.cmd), port, timeout))
+            self._exited.wait(delay)
+            delay = min(delay * 2, 2)
+
+
+class ThreadOutput(object):
+    """Wraps a stream, the output of the threads capturing it is redirected, see captureOutput()"""
+
+    stream = None
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def flush(self):
+        self.stream.flush()
+
+    def write(self, text):
+        capture = getattr(_threadOutput, 'capture', None)
+        if capture:
+            capture(text, self.stream)
+        else:
+            self.stream.write(text)
 
-            # Reading the output seems to prevent the process to hang.
-            if self.stdout == subprocess.PIPE:
-                proc.stdout.read(1)
@@ -25,9 +25,13 @@ http://github.com/FMCorz/mdk
 import os
 import shutil
 import logging
-from tools import mkdir, process, stableBranch
+import tempfile
+import time
+from tools import mkdir, parallel, process, stableBranch
 from exceptions import CreateException
 from config import Conf
+from lock import Lock
+from metadata import Metadata
 import git
 import moodle
 
@@ -58,17 +62,24 @@ class Workplace(object):
 
     def checkCachedClones(self, stable=True, integration=True):
         """Clone the official repository in a local cache"""
-        cacheStable = self.getCachedRemote(False)
-        cacheIntegration = self.getCachedRemote(True)
+        with self.lockCache():
+            self._checkCachedClones(stable, integration)
+
+    def _checkCachedClones(self, stable=True, integration=True):
+        self._seedCachedClones(stable, integration)
+
+        if C.get('singleCachedRepository'):
+            return self._checkSingleCachedClone(stable, integration)
+
+        cacheStable = self._getCachedClonePath('stable')
+        cacheIntegration = self._getCachedClonePath('integration')
 
         if not os.path.isdir(cacheStable) and stable:
             logging.info('Cloning stable repository into cache...')
 
             # For faster clone, we will copy the integration clone if it exists.
             if os.path.isdir(cacheIntegration):
-                shutil.copytree(cacheIntegration, cacheStable)
-                repo = git.Git(cacheStable, C.get('git'))
-                repo.setRemote('origin', C.get('remotes.stable'))
+                self._copyCachedClone(cacheIntegration, cacheStable, C.get('remotes.stable'))
                 # The repository is not updated at this stage, it has to be done manually.
             else:
                 logging.info('This is going to take a while...')
@@ -79,17 +90,107 @@ class Workplace(object):
 
             # For faster clone, we will copy the integration clone if it exists.
             if os.path.isdir(cacheStable):
-                shutil.copytree(cacheStable, cacheIntegration)
-                repo = git.Git(cacheIntegration, C.get('git'))
-                repo.setRemote('origin', C.get('remotes.integration'))
+                self._copyCachedClone(cacheStable, cacheIntegration, C.get('remotes.integration'))
                 # The repository is not updated at this stage, it has to be done manually.
             else:
                 logging.info('Have a break, this operation is slow...')
                 process('%s clone --mirror %s %s' % (C.get('git'), C.get('remotes.integration'), cacheIntegration))
 
-    def create(self, name=None, version='master', integration=False, useCacheAsRemote=False):
+        # Objects borrowed by other repositories must never be pruned.
+        if C.get('shareCacheObjects'):
+            for cache in [cacheStable, cacheIntegration]:
+                if os.path.isdir(cache):
+                    repo = git.Git(cache, C.get('git'))
+                    if repo.getConfig('gc.pruneExpire') != 'never':
+                        repo.setConfig('gc.pruneExpire', 'never')
+
+    def _checkSingleCachedClone(self, stable=True, integration=True):
+        """Set up the cached repository holding both the stable and integration remotes.
+
+        Each remote is fetched in its own namespace (refs/stable/ and refs/integration/), the
+        objects they have in common are only stored once. When the separate mirrors exist, they
+        are used to populate the repository rather than fetching everything from the network."""
+        mirror = self.getCachedRemote()
+        if not os.path.isdir(mirror):
+            logging.info('Creating the cached repository...')
+            process('%s init --bare %s' % (C.get('git'), mirror))
+
+        repo = git.Git(mirror, C.get('git'))
+        for (remote, wanted) in [('stable', stable), ('integration', integration)]:
+            url = C.get('remotes.%s' % remote)
+            refspecs = [
+                '+refs/heads/*:refs/%s/heads/*' % remote,
+                '+refs/tags/*:refs/%s/tags/*' % remote
+            ]
+            if repo.getRemote(remote) != url:
+                repo.setRemote(remote, url)
+            if repo.getConfig('remote.%s.fetch' % remote) != refspecs[-1]:
+                repo.setRemoteRefspecs(remote, refspecs)
+            if repo.getConfig('remote.%s.tagopt' % remote) != '--no-tags':
+                repo.setConfig('remote.%s.tagopt' % remote, '--no-tags')
+
+            if not wanted or len(repo.refs('refs/%s/heads' % remote)) > 0:
+                continue
+
+            legacy = self._getCachedClonePath(remote)
+            if os.path.isdir(legacy):
+                logging.info('Importing %s into the cached repository...' % os.path.basename(legacy))
+                result = repo.fetch(legacy, ' '.join(refspecs), tags=False)
+                if result[0] == 0:
+                    logging.info('The repository %s is not used any more, it can be deleted.' % legacy)
+                    # The repository is not updated at this stage, it has to be done manually.
+                    continue
+                logging.warning('Could not import %s' % legacy)
+                logging.debug(result[2])
+
+            logging.info('Fetching %s remote into cache, this is going to take a while...' % remote)
+            result = repo.fetch(remote)
+            if result[0] != 0:
+                logging.debug(result[2])
+                raise Exception('Could not fetch %s in repository %s' % (remote, mirror))
+
+        # Objects borrowed by other repositories must never be pruned.
+        if C.get('shareCacheObjects') and repo.getConfig('gc.pruneExpire') != 'never':
+            repo.setConfig('gc.pruneExpire', 'never')
+
+    def _seedCachedClones(self, stable=True, integration=True):
+        """Populate the missing cached repositories from the bundles defined in the settings"""
+        bundles = C.get('cacheBundles')
+        if not bundles:
+            return
+        elif type(bundles) != list:
+            bundles = [bundles]
+
+        if C.get('singleCachedRepository'):
+            mirror = git.Git(self.getCachedRemote(), C.get('git'))
+            missing = [ns for (ns, wanted) in [('stable', stable), ('integration', integration)]
+                if wanted and (not os.path.isdir(mirror.getPath()) or len(mirror.refs('refs/%s/heads' % ns)) < 1)]
+        else:
+            missing = [ns for (ns, wanted) in [('stable', stable), ('integration', integration)]
+                if wanted and not os.path.isdir(self._getCachedClonePath(ns))]
+
+        if not missing:
+            return
+
+        logging.info('Seeding the cache from local bundles...')
+        try:
+            self.importCache([os.path.expanduser(bundle) for bundle in bundles], namespaces=missing)
+        except Exception as e:
+            logging.warning('Could not seed the cache: %s' % e)
+
+    def _copyCachedClone(self, source, destination, url):
+        """Creates a cached repository from another one, sharing the objects when possible"""
+        if C.get('shareCacheObjects'):
+            process('%s clone --mirror --shared %s %s' % (C.get('git'), source, destination))
+        else:
+            shutil.copytree(source, destination)
+        repo = git.Git(destination, C.get('git'))
+        repo.setRemote('origin', url)
+
+    def create(self, name=None, version='master', integration=False, useCacheAsRemote=False, updateCache=True):
         """Creates a new instance of Moodle.
-        The parameter useCacheAsRemote has been deprecated.
+        The parameter useCacheAsRemote has been deprecated. Set updateCache to False when the
+        cached repositories have already been checked and updated.
         """
         if name == None:
             name = self.generateInstanceName(version, integration=integration)
@@ -104,17 +205,27 @@ class Workplace(object):
         elif os.path.isdir(installDir):
             raise CreateException('Installation path exists: %s' % installDir)
 
-        self.checkCachedClones(not integration, integration)
-        self.updateCachedClones(stable=not integration, integration=integration, verbose=False)
+        if updateCache:
+            self.checkCachedClones(not integration, integration)
+            if not self.updateCachedClones(stable=not integration, integration=integration, verbose=False):
+                logging.warning('Could not update the cached repositories, the instance may not be up to date')
         mkdir(installDir, 0755)
         mkdir(wwwDir, 0755)
         mkdir(dataDir, 0777)
 
         repository = self.getCachedRemote(integration)
 
-        # Clone the instances
+        # Clone the instances, borrowing the objects of the cache if required.
         logging.info('Cloning repository...')
-        process('%s clone %s %s' % (C.get('git'), repository, wwwDir))
+        with self.lockCache(exclusive=False):
+            if C.get('singleCachedRepository'):
+                # The branches of the cache are namespaced, a clone would not find them.
+                process('%s init %s' % (C.get('git'), wwwDir))
+                if C.get('shareCacheObjects'):
+                    git.Git(wwwDir, C.get('git')).setAlternates([os.path.join(repository, 'objects')])
+            else:
+                shared = '--shared ' if C.get('shareCacheObjects') else ''
+                process('%s clone %s%s %s' % (C.get('git'), shared, repository, wwwDir))
 
         # Symbolic link
         if os.path.islink(linkDir):
@@ -138,10 +249,11 @@ class Workplace(object):
 
         # Setting up the correct remote names
         repo.setRemote(C.get('myRemote'), C.get('remotes.mine'))
-        repo.setRemote(C.get('upstreamRemote'), repository)
+        self.setUpstreamRemote(repo, integration)
 
         # Creating, fetch, pulling branches
-        repo.fetch(C.get('upstreamRemote'))
+        with self.lockCache(exclusive=False):
+            repo.fetch(C.get('upstreamRemote'))
         branch = stableBranch(version)
         track = '%s/%s' % (C.get('upstreamRemote'), branch)
         if not repo.hasBranch(branch) and not repo.createBranch(branch, track):
@@ -155,9 +267,10 @@ class Workplace(object):
         if not C.get('useCacheAsUpstreamRemote'):
             realupstream = C.get('remotes.integration') if integration else C.get('remotes.stable')
             if realupstream:
-                repo.setRemote(C.get('upstreamRemote'), realupstream)
+                self.setUpstreamRemote(repo, integration, useCache=False)
 
         M = self.get(name)
+        self.updateIndex(name)
         return M
 
     def delete(self, name):
@@ -166,6 +279,11 @@ class Workplace(object):
         # Instantiating the object also checks if it exists
         M = self.get(name)
 
+        # Waiting for the other processes working on the instance. The lock file is part of the
+        # instance, it is released before being deleted so that no process waits on a deleted file.
+        with M.lock():
+            pass
+
         # Deleting the whole thing
         shutil.rmtree(os.path.join(self.path, name))
 
@@ -183,6 +301,111 @@ class Workplace(object):
         if DB and dbname and DB.dbexists(dbname):
             DB.dropdb(dbname)
 
+        self.updateIndex(name)
+
+    def exportCache(self, path, since=None, split=None):
+        """Write the cached repositories to a bundle, returns the list of files written.
+
+        The references of the bundle are namespaced (refs/stable/ and refs/integration/) whatever
+        the layout of the cache. When since is a list of previous bundles, their references are
+        excluded to create an incremental bundle. When split is set, the bundle is split in parts
+        of that many bytes, named path.000, path.001, etc."""
+
+        exclusions = set()
+        for previous in since or []:
+            (prerequisites, refs) = git.readBundle(self._getBundleHeader(previous))
+            exclusions.update(['^%s' % hash for (hash, ref) in refs])
+
+        with self.lockCache(exclusive=False):
+            return self._exportCache(path, exclusions, split)
+
+    def _exportCache(self, path, exclusions, split):
+        temporary = None
+        if C.get('singleCachedRepository'):
+            source = git.Git(self.getCachedRemote(), C.get('git'))
+            if not os.path.isdir(source.getPath()):
+                raise Exception('The cached repository does not exist')
+        else:
+            # Gather the references of each cached repository in a temporary repository, the
+            # objects are borrowed so that nothing is copied.
+            caches = [(ns, self._getCachedClonePath(ns)) for ns in ['stable', 'integration']]
+            caches = [(ns, cache) for (ns, cache) in caches if os.path.isdir(cache)]
+            if not caches:
+                raise Exception('There are no cached repositories to export')
+            temporary = tempfile.mkdtemp(prefix='export-', dir=self.cache)
+            process('%s init --bare %s' % (C.get('git'), temporary))
+            source = git.Git(temporary, C.get('git'))
+            source.setAlternates([os.path.join(cache, 'objects') for (ns, cache) in caches])
+            for (ns, cache) in caches:
+                refspecs = '+refs/heads/*:refs/%s/heads/* +refs/tags/*:refs/%s/tags/*' % (ns, ns)
+                result = source.fetch(cache, refspecs, tags=False)
+                if result[0] != 0:
+                    shutil.rmtree(temporary)
+                    raise Exception('Could not read the references of %s' % cache)
+
+        try:
+            logging.info('Writing the bundle %s...' % path)
+            result = source.execute('bundle create %s --all %s' % (path, ' '.join(sorted(exclusions))))
+        finally:
+            if temporary:
+                shutil.rmtree(temporary)
+
+        if result[0] != 0:
+            if exclusions and 'empty bundle' in result[2]:
+                logging.info('Nothing new since the previous bundles')
+                return []
+            raise Exception('Could not create the bundle: %s' % result[2].strip())
+
+        if split:
+            return self._splitBundle(path, split)
+        return [path]
+
+    def _getBundleHeader(self, path):
+        """Return the file holding the header of a bundle, which is the first part of a split bundle"""
+        if not os.path.isfile(path) and os.path.isfile('%s.000' % path):
+            return '%s.000' % path
+        return path
+
+    def _splitBundle(self, path, size):
+        """Split a bundle in parts of size bytes, the original file is removed"""
+        parts = []
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(size), ''):
+                part = '%s.%03d' % (path, len(parts))
+                with open(part, 'wb') as p:
+                    p.write(chunk)
+                parts.append(part)
+        os.remove(path)
+        return parts
+
+    def fetchInstances(self, Mlist, remote=None, jobs=None):
+        """Fetch the remote in each instance in parallel, returns the list of instances which failed"""
+        if remote == None:
+            remote = C.get('upstreamRemote')
+
+        def fetch(M):
+            start = time.time()
+            result = M.git().fetch(remote)
+            if result[0] != 0:
+                logging.warning('  %s: could not fetch %s' % (M.get('identifier'), remote))
+                logging.debug(result[2])
+                return False
+            logging.info('  %s: fetched %s (%.1fs)' % (M.get('identifier'), remote, time.time() - start))
+            return True
+
+        logging.info('Fetching %s in %d instances...' % (remote, len(Mlist)))
+        return self._fetchInParallel(fetch, Mlist, jobs)
+
+    def _fetchInParallel(self, fetch, items, jobs=None):
+        """Run the fetch function on each item and report a summary, returns the items which failed"""
+        start = time.time()
+        failed = []
+        for (item, result, exception) in parallel(fetch, items, jobs):
+            if exception != None or not result:
+                failed.append(item)
+        logging.info('Fetched %d of %d repositories in %.1fs' % (len(items) - len(failed), len(items), time.time() - start))
+        return failed
+
     def generateInstanceName(self, version, integration=False, suffix='', identifier=None):
         """Creates a name (identifier) from arguments"""
 
@@ -224,10 +447,25 @@ class Workplace(object):
 
     def getCachedRemote(self, integration=False):
         """Return the path to the cached remote"""
-        if integration:
-            return os.path.join(self.cache, 'integration.git')
-        else:
-            return os.path.join(self.cache, 'moodle.git')
+        if C.get('singleCachedRepository'):
+            return os.path.join(self.cache, 'mirror.git')
+        return self._getCachedClonePath('integration' if integration else 'stable')
+
+    def _getCachedClonePath(self, namespace):
+        """Return the path to the separate cached repository of stable or integration"""
+        return os.path.join(self.cache, 'integration.git' if namespace == 'integration' else 'moodle.git')
+
+    def getCachedRemoteRefspecs(self, integration=False, remote=None):
+        """Return the refspecs to fetch from the cached remote, or None when the default ones apply"""
+        if not C.get('singleCachedRepository'):
+            return None
+        if remote == None:
+            remote = C.get('upstreamRemote')
+        namespace = 'integration' if integration else 'stable'
+        return [
+            '+refs/%s/heads/*:refs/remotes/%s/*' % (namespace, remote),
+            'refs/%s/tags/*:refs/tags/*' % namespace
+        ]
 
     def getPath(self, name, mode=None):
         """Returns the path of an instance base on its name"""
@@ -239,6 +477,130 @@ class Workplace(object):
         else:
             return base
 
+    def importCache(self, bundles, namespaces=None):
+        """Populate the cached repositories from bundles written by exportCache.
+
+        The bundles are imported in order, an incremental bundle must come after the ones it
+        was based on. Namespaces restricts the upstreams to import (stable, integration)."""
+
+        with self.lockCache():
+            for path in bundles:
+                self._importBundle(path, namespaces)
+
+    def _importBundle(self, path, namespaces=None):
+        """Import the namespaces of a bundle in the cached repositories"""
+        (bundle, joined) = self._joinBundle(path)
+        try:
+            (prerequisites, refs) = git.readBundle(bundle)
+            found = sorted(set([ref.split('/')[1] for (hash, ref) in refs
+                if ref.startswith('refs/stable/') or ref.startswith('refs/integration/')]))
+            if not found:
+                raise Exception('The bundle %s does not contain any cached repository' % path)
+
+            for ns in found:
+                if namespaces != None and ns not in namespaces:
+                    continue
+                (repo, refspecs) = self._getCachedCloneForImport(ns)
+                logging.info('Importing %s references from %s...' % (ns, path))
+                result = repo.fetch(bundle, ' '.join(refspecs), tags=False)
+                if result[0] != 0:
+                    raise Exception('Could not import %s: %s' % (path, result[2].strip()))
+        finally:
+            if joined:
+                os.remove(bundle)
+
+    def _getCachedCloneForImport(self, namespace):
+        """Return the cached repository receiving a namespace of a bundle, and the refspecs to use"""
+        if C.get('singleCachedRepository'):
+            # Creates and configures the repository without fetching anything.
+            self._checkSingleCachedClone(stable=False, integration=False)
+            repo = git.Git(self.getCachedRemote(), C.get('git'))
+            return (repo, ['+refs/%s/*:refs/%s/*' % (namespace, namespace)])
+
+        path = self._getCachedClonePath(namespace)
+        if not os.path.isdir(path):
+            # Same configuration as a mirror clone.
+            process('%s init --bare %s' % (C.get('git'), path))
+            repo = git.Git(path, C.get('git'))
+            repo.setConfig('remote.origin.url', C.get('remotes.%s' % namespace))
+            repo.setConfig('remote.origin.fetch', '+refs/*:refs/*')
+            repo.setConfig('remote.origin.mirror', 'true')
+        repo = git.Git(path, C.get('git'))
+        return (repo, ['+refs/%s/heads/*:refs/heads/*' % namespace, '+refs/%s/tags/*:refs/tags/*' % namespace])
+
+    def _joinBundle(self, path):
+        """Return the path to a complete bundle, joining its parts in a temporary file if need be"""
+        if os.path.isfile(path):
+            return (path, False)
+
+        parts = []
+        while os.path.isfile('%s.%03d' % (path, len(parts))):
+            parts.append('%s.%03d' % (path, len(parts)))
+        if not parts:
+            raise Exception('The bundle %s does not exist' % path)
+
+        (fd, joined) = tempfile.mkstemp(prefix='import-', suffix='.bundle', dir=self.cache)
+        with os.fdopen(fd, 'wb') as f:
+            for part in parts:
+                with open(part, 'rb') as p:
+                    shutil.copyfileobj(p, f)
+        return (joined, True)
+
+    def index(self):
+        """Return the index of the instances, a dict of their main properties indexed by name
+
+        The index is revalidated incrementally. The directories are only listed again when the
+        storage directory has changed, and an instance is only loaded again when one of its
+        directories or main files has changed.
+        """
+        meta = Metadata()
+        names = meta.get('workplace', self.path, [self.path])
+        if names == None:
+            names = sorted([d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d))])
+            meta.set('workplace', self.path, [self.path], names)
+        else:
+            # The names are decoded from JSON, they are used as the raw names of the directories.
+            names = [name.encode('utf-8') for name in names]
+
+        index = {}
+        for name in names:
+            entry = self._getIndexEntry(name)
+            if entry:
+                index[name] = entry
+        return index
+
+    def _getIndexEntry(self, name):
+        """Return the entry of the index for an instance, or None when it is not an instance"""
+        installDir = os.path.join(self.path, name)
+        wwwDir = os.path.join(installDir, self.wwwDir)
+        files = [
+            installDir,
+            wwwDir,
+            os.path.join(installDir, self.dataDir),
+            os.path.join(wwwDir, 'version.php'),
+            os.path.join(wwwDir, 'config.php'),
+            os.path.join(wwwDir, '.git', 'config')
+        ]
+
+        meta = Metadata()
+        entry = meta.get('index', installDir, files)
+        if entry != None:
+            return entry or None
+
+        entry = False
+        if self.isMoodle(name):
+            M = self.get(name)
+            entry = {
+                'branch': M.get('branch'),
+                'dbtype': M.get('dbtype'),
+                'installed': M.isInstalled(),
+                'integration': M.isIntegration(),
+                'release': M.get('release'),
+                'stablebranch': M.get('stablebranch')
+            }
+        meta.set('index', installDir, files, entry)
+        return entry or None
+
     def isMoodle(self, name):
         """Checks whether a Moodle instance exist under this name"""
         d = os.path.join(self.path, name)
@@ -255,19 +617,23 @@ class Workplace(object):
 
         return True
 
-    def list(self, integration=None, stable=None):
-        """Return the list of Moodle instances"""
-        dirs = os.listdir(self.path)
+    def lockCache(self, exclusive=True, wait=True, timeout=None):
+        """Return the lock of the cached repositories, see lock.Lock"""
+        return Lock(os.path.join(self.cache, 'cache.lock'), exclusive=exclusive, wait=wait, timeout=timeout)
+
+    def list(self, integration=None, stable=None, branch=None, installed=None, dbtype=None):
+        """Return the list of Moodle instances, filtered by the properties of the index"""
         names = []
-        for d in dirs:
-            if d == '.' or d == '..': continue
-            if not os.path.isdir(os.path.join(self.path, d)): continue
-            if not self.isMoodle(d): continue
+        index = self.index()
+        for name in sorted(index.keys()):
+            entry = index[name]
             if integration != None or stable != None:
-                M = self.get(d)
-                if not integration and M.isIntegration(): continue
-                if not stable and M.isStable(): continue
-            names.append(d)
+                if not integration and entry['integration']: continue
+                if not stable and not entry['integration']: continue
+            if branch != None and entry['branch'] != str(branch): continue
+            if installed != None and entry['installed'] != installed: continue
+            if dbtype != None and entry['dbtype'] != dbtype: continue
+            names.append(name)
         return names
 
     def resolve(self, name=None, path=None):
@@ -318,32 +684,100 @@ class Workplace(object):
 
         # Try to resolve each instance
         result = []
+        index = self.index()
         for name in names:
-            M = self.resolve(name=name)
-            if M:
-                result.append(M)
+            if name in index:
+                result.append(self.get(name))
             else:
                 logging.info('Could not find instance called %s' % name)
         return result
 
-    def updateCachedClones(self, integration=True, stable=True, verbose=True):
-        """Update the cached clone of the repositories"""
+    def setUpstreamRemote(self, repo, integration=False, useCache=True):
+        """Point the upstream remote of a repository to the cache, or to the real upstream"""
+        remote = C.get('upstreamRemote')
+        refspecs = None
+        if useCache:
+            url = self.getCachedRemote(integration)
+            refspecs = self.getCachedRemoteRefspecs(integration, remote)
+        else:
+            url = C.get('remotes.integration') if integration else C.get('remotes.stable')
+
+        if refspecs == None:
+            refspecs = ['+refs/heads/*:refs/remotes/%s/*' % remote]
 
+        return repo.setRemote(remote, url) and repo.setRemoteRefspecs(remote, refspecs)
+
+    def updateIndex(self, name=None):
+        """Revalidate the index, call when an instance has been created, removed or restored"""
+        meta = Metadata()
+        meta.invalidate(self.path)
+        if name != None:
+            meta.invalidate(os.path.join(self.path, name))
+        self.index()
+
+    def updateCachedClones(self, integration=True, stable=True, verbose=True, jobs=None):
+        """Update the cached clone of the repositories, returns whether they were all fetched
+
+        The separate repositories are fetched in parallel, the remotes of the single cached
+        repository are fetched one after the other."""
+
+        with self.lockCache():
+            if C.get('singleCachedRepository'):
+                return self._updateSingleCachedClone(integration, stable)
+            return self._updateCachedClones(integration, stable, jobs)
+
+    def _updateCachedClones(self, integration=True, stable=True, jobs=None):
         caches = []
 
         if integration:
-            caches.append(os.path.join(self.cache, 'integration.git'))
+            caches.append(self._getCachedClonePath('integration'))
         if stable:
-            caches.append(os.path.join(self.cache, 'moodle.git'))
+            caches.append(self._getCachedClonePath('stable'))
 
-        for cache in caches:
-            if not os.path.isdir(cache):
-                continue
+        caches = [cache for cache in caches if os.path.isdir(cache)]
+        if not caches:
+            return True
 
+        def fetch(cache):
+            name = os.path.basename(cache)
             repo = git.Git(cache, C.get('git'))
-
-            logging.info('Fetching cached repository %s...' % os.path.basename(cache))
-            if not repo.fetch():
-                raise Exception('Could not fetch in repository %s' % (cache))
-
-        return True
+            start = time.time()
+            logging.info('Fetching cached repository %s...' % name)
+            result = repo.fetch()
+            if result[0] != 0:
+                logging.error('Could not fetch in repository %s' % cache)
+                logging.debug(result[2])
+                return False
+            logging.info('  %s: fetched (%.1fs)' % (name, time.time() - start))
+            return True
+
+        failed = self._fetchInParallel(fetch, caches, jobs)
+        return len(failed) == 0
+
+    def _updateSingleCachedClone(self, integration=True, stable=True):
+        """Update the remotes of the single cached repository"""
+        mirror = self.getCachedRemote()
+        if not os.path.isdir(mirror):
+            return True
+
+        remotes = []
+        if integration:
+            remotes.append('integration')
+        if stable:
+            remotes.append('stable')
+
+        # The fetches would compete for FETCH_HEAD, the packed references and the automatic gc.
+        def fetch(remote):
+            repo = git.Git(mirror, C.get('git'))
+            start = time.time()
+            logging.info('Fetching %s remote of the cached repository...' % remote)
+            result = repo.fetch(remote)
+            if result[0] != 0:
+                logging.error('Could not fetch %s in repository %s' % (remote, mirror))
+                logging.debug(result[2])
+                return False
+            logging.info('  %s: fetched (%.1fs)' % (remote, time.time() - start))
+            return True
+
+        failed = self._fetchInParallel(fetch, remotes, 1)
+        return len(failed) == 0
@@ -30,7 +30,7 @@ import logging
 from lib.command import CommandRunner
 from lib.commands import getCommand, commandsList
 from lib.config import Conf
-from lib.tools import process
+from lib.tools import process, setProcessLimit
 from version import __version__
 
 C = Conf()
@@ -44,6 +44,9 @@ except AttributeError:
 logging.basicConfig(format='%(message)s', level=debuglevel)
 logging.getLogger('requests').setLevel(logging.WARNING)  # Reset logging level of 'requests' module.
 
+# Limit the number of processes running at the same time.
+setProcessLimit(C.get('maxProcesses'))
+
 availaliases = [str(x) for x in C.get('aliases').keys()]
 choices = sorted(commandsList + availaliases)
 
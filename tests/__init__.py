@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+
+The tests are run from the root of MDK with:
+
+    python -m unittest discover -s tests -t .
+"""
+
+import os
+import subprocess
+import tempfile
+
+# The settings, and what MDK stores in its directories, are kept away from the ones of the user.
+os.environ['HOME'] = tempfile.mkdtemp(prefix='mdk-tests-')
+
+versionFile = """<?php
+// MOODLE VERSION INFORMATION
+$version  = 2014051200.00;
+$release  = '2.7 (Build: 20140512)';
+$branch   = '27';
+$maturity = MATURITY_STABLE;
+"""
+
+configFile = """<?php  // Moodle configuration file
+
+unset($CFG);
+global $CFG;
+$CFG = new stdClass();
+
+$CFG->dbtype    = 'mysqli';
+$CFG->dbname    = '%(dbname)s';
+$CFG->prefix    = 'mdl_';
+$CFG->wwwroot   = 'http://localhost/%(dbname)s';
+$CFG->dataroot  = '%(dataroot)s';
+
+require_once(dirname(__FILE__) . '/lib/setup.php');
+"""
+
+
+def makeInstance(path, config=None):
+    """Create the files of a Moodle instance in path, in a git repository
+
+    The config file is written when config is a dict with the dbname and the dataroot."""
+    os.makedirs(path)
+    with open(os.path.join(path, 'version.php'), 'w') as f:
+        f.write(versionFile)
+    if config != None:
+        with open(os.path.join(path, 'config.php'), 'w') as f:
+            f.write(configFile % config)
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['git', 'init', '-q', path], stdout=devnull)
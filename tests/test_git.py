@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from lib.git import Git, GitReader, GitReaderException
+
+
+class GitReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        self.env = os.environ.get('PATH')
+
+        # A repository with loose and packed references, a symbolic one, and remotes.
+        self.path = os.path.join(self.dir, 'repo')
+        self.git('init', '-q', self.path)
+        self.git('commit', '-q', '--allow-empty', '-m', 'First')
+        self.git('branch', 'MOODLE_27_STABLE')
+        self.git('branch', 'wip/MDL-12345-master')
+        self.git('tag', 'v2.7.0')
+        self.git('pack-refs', '--all')
+        self.git('commit', '-q', '--allow-empty', '-m', 'Second')
+        self.git('branch', 'MDL-23456-master')
+        self.git('branch', '-f', 'MOODLE_27_STABLE')
+        self.git('symbolic-ref', 'refs/heads/alias', 'refs/heads/MDL-23456-master')
+        self.git('remote', 'add', 'origin', 'git://git.moodle.org/moodle.git')
+        self.git('remote', 'add', 'mine', 'https://github.com/me/moodle.git')
+        self.git('config', 'remote.mine.pushurl', 'git@github.com:me/moodle.git')
+        self.git('config', 'url.git@github.com:.pushInsteadOf', 'git://github.com/')
+        self.git('remote', 'add', 'other', 'git://github.com/other/moodle.git')
+        self.git('config', 'Core.Editor', 'vim')
+        self.git('config', 'branch.MDL-23456-master.remote', 'mine')
+        self.reader = GitReader.find(self.path, 'git')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ['PATH'] = self.env
+        shutil.rmtree(self.dir)
+
+    def git(self, *args):
+        """Run git in the repository, returns its output"""
+        cmd = ['git', '-c', 'user.name=Test', '-c', 'user.email=test@example.com'] + list(args)
+        cwd = self.path if os.path.isdir(self.path) else self.dir
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+        if proc.returncode not in [0, 1]:
+            raise Exception('%s failed: %s' % (' '.join(cmd), err))
+        return out
+
+    def testConfig(self):
+        for name in ['core.editor', 'CORE.EDITOR', 'remote.origin.url', 'remote.mine.pushurl',
+                'branch.MDL-23456-master.remote', 'core.bare', 'core.missing', 'remote.missing.url']:
+            self.assertEqual(self.reader.getConfig(name), self.git('config', '--get', name).rstrip('\n') or None)
+
+    def testCurrentBranch(self):
+        self.assertEqual(self.reader.currentBranch(), self.git('symbolic-ref', '-q', 'HEAD').strip())
+        self.git('checkout', '-q', 'MOODLE_27_STABLE')
+        self.assertEqual(self.reader.currentBranch(), 'refs/heads/MOODLE_27_STABLE')
+        self.git('checkout', '-q', '--detach')
+        self.assertEqual(self.reader.currentBranch(), None)
+
+    def testFind(self):
+        self.assertEqual(self.reader.gitdir, os.path.join(self.path, '.git'))
+        self.assertEqual(GitReader.find(self.dir, 'git'), None)
+        self.git('worktree', 'add', '-q', '--detach', os.path.join(self.dir, 'worktree'))
+        self.assertEqual(GitReader.find(os.path.join(self.dir, 'worktree'), 'git'), None)
+
+    def testRefs(self):
+        for prefix in ['refs/heads', 'refs/tags', 'refs/heads/wip', 'refs/remotes']:
+            expected = [tuple(line.split(' ', 1)) for line in
+                self.git('for-each-ref', '--format=%(objectname) %(refname)', prefix).splitlines()]
+            self.assertEqual(self.reader.refs(prefix), expected)
+
+    def testRemotes(self):
+        expected = {}
+        for line in self.git('remote', '-v').splitlines():
+            (name, url, kind) = line.split()
+            if kind == '(push)':
+                expected[name] = url
+        self.assertEqual(self.reader.getRemotes(), expected)
+        self.assertEqual(expected['other'], 'git@github.com:other/moodle.git')
+
+    def testResolve(self):
+        for ref in ['HEAD', 'refs/heads/MOODLE_27_STABLE', 'refs/heads/wip/MDL-12345-master', 'refs/tags/v2.7.0',
+                'refs/heads/alias']:
+            self.assertEqual(self.reader.resolve(ref), self.git('rev-parse', '--verify', '-q', ref).strip())
+        self.assertEqual(self.reader.resolve('refs/heads/missing'), None)
+
+        # The loose reference takes over the packed one.
+        self.assertNotEqual(self.reader.resolve('refs/heads/MOODLE_27_STABLE'), self.reader.resolve('refs/tags/v2.7.0'))
+
+    def testWorker(self):
+        worker = Git(self.path, 'git').worker()
+        self.assertTrue(worker.isAlive())
+        for ref in ['HEAD', 'refs/heads/MOODLE_27_STABLE', 'refs/tags/v2.7.0']:
+            self.assertEqual(worker.resolve(ref), self.git('rev-parse', '--verify', '-q', ref).strip())
+        self.assertEqual(worker.resolve('refs/heads/missing'), None)
+        worker.stop()
+        self.assertFalse(worker.isAlive())
+
+    def testSystemConfigFile(self):
+        # The binary found in PATH is used, not the file of the same name in the current directory.
+        prefix = os.path.join(self.dir, 'prefix')
+        os.makedirs(os.path.join(prefix, 'bin'))
+        with open(os.path.join(prefix, 'bin', 'git'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(os.path.join(prefix, 'bin', 'git'), 0755)
+        os.makedirs(os.path.join(self.dir, 'cwd'))
+        with open(os.path.join(self.dir, 'cwd', 'git'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chdir(os.path.join(self.dir, 'cwd'))
+
+        os.environ['PATH'] = os.path.join(prefix, 'bin')
+        reader = GitReader(self.dir, 'git')
+        self.assertEqual(reader._systemConfigFile(), os.path.join(prefix, 'etc', 'gitconfig'))
+        self.assertEqual(GitReader(self.dir, os.path.join(prefix, 'bin', 'git'))._systemConfigFile(),
+            os.path.join(prefix, 'etc', 'gitconfig'))
+
+        os.environ['PATH'] = os.path.join(self.dir, 'nowhere')
+        self.assertRaises(GitReaderException, reader._systemConfigFile)
+
+
+if __name__ == '__main__':
+    unittest.main()
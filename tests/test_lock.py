@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from lib.exceptions import LockTimeout
+from lib.lock import Lock
+
+
+class LockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'locks', 'test.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def holdInThread(self, exclusive=True):
+        """Acquire the lock in another thread, which holds it until the returned event is set"""
+        acquired = threading.Event()
+        done = threading.Event()
+
+        def hold():
+            with Lock(self.path, exclusive=exclusive):
+                acquired.set()
+                done.wait()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        acquired.wait()
+        self.addCleanup(thread.join)
+        self.addCleanup(done.set)
+        return done
+
+    def testReentrant(self):
+        with Lock(self.path):
+            with Lock(self.path, wait=False):
+                with Lock(self.path, exclusive=False, wait=False):
+                    pass
+            # Still held after the inner locks are released.
+            done = threading.Event()
+            results = []
+
+            def tryLock():
+                try:
+                    with Lock(self.path, wait=False):
+                        results.append(True)
+                except LockTimeout:
+                    results.append(False)
+                done.set()
+
+            threading.Thread(target=tryLock).start()
+            done.wait()
+            self.assertEqual(results, [False])
+
+        with Lock(self.path, wait=False):
+            pass
+
+    def testSharedLocks(self):
+        self.holdInThread(exclusive=False)
+        with Lock(self.path, exclusive=False, wait=False):
+            pass
+        self.assertRaises(LockTimeout, Lock(self.path, wait=False).acquire)
+
+    def testTimeout(self):
+        self.holdInThread()
+        self.assertRaises(LockTimeout, Lock(self.path, timeout=0.2).acquire)
+        self.assertRaises(LockTimeout, Lock(self.path, exclusive=False, wait=False).acquire)
+
+    def testTimeoutReleasesNothing(self):
+        done = self.holdInThread()
+        self.assertRaises(LockTimeout, Lock(self.path, timeout=0.1).acquire)
+        done.set()
+        with Lock(self.path, timeout=5):
+            pass
+
+    def testUpgradeRefused(self):
+        with Lock(self.path, exclusive=False):
+            self.assertRaises(Exception, Lock(self.path).acquire)
+            # The shared lock is still held, and can be acquired again.
+            with Lock(self.path, exclusive=False):
+                pass
+        with Lock(self.path, wait=False):
+            pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from lib.metadata import Metadata
+
+
+class MetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.file = os.path.join(self.dir, 'version.php')
+        self.write('$version = 2014051200.00;')
+
+        # The cache is written to, and read from, the temporary directory.
+        self.meta = Metadata()
+        self.meta.save()
+        self.state = (self.meta._data, self.meta._path)
+        self.meta._data = None
+        self.meta._path = os.path.join(self.dir, 'metadata.json')
+
+    def tearDown(self):
+        (self.meta._data, self.meta._path) = self.state
+        self.meta._dirty = False
+        shutil.rmtree(self.dir)
+
+    def write(self, content):
+        with open(self.file, 'w') as f:
+            f.write(content)
+
+    def testChangedFile(self):
+        self.meta.set('version', self.dir, [self.file], {'version': '2014051200.00'})
+        self.assertEqual(self.meta.get('version', self.dir, [self.file]), {'version': '2014051200.00'})
+        self.write('$version = 2014051201.00; // Changed.')
+        self.assertEqual(self.meta.get('version', self.dir, [self.file]), None)
+
+        # The entry was removed, it does not come back when the file is restored.
+        self.write('$version = 2014051200.00;')
+        self.assertEqual(self.meta.get('version', self.dir, [self.file]), None)
+
+    def testMissingFile(self):
+        missing = os.path.join(self.dir, 'config.php')
+        self.meta.set('config', self.dir, [missing], None)
+        self.assertEqual(self.meta.get('config', self.dir, [missing]), None)
+        self.meta.set('config', self.dir, [missing], {'installed': False})
+        self.assertEqual(self.meta.get('config', self.dir, [missing]), {'installed': False})
+        with open(missing, 'w') as f:
+            f.write('<?php')
+        self.assertEqual(self.meta.get('config', self.dir, [missing]), None)
+
+    def testCopies(self):
+        value = {'versions': ['2.7']}
+        self.meta.set('version', self.dir, [self.file], value)
+        value['versions'].append('2.8')
+        self.meta.get('version', self.dir, [self.file])['versions'].append('2.9')
+        self.assertEqual(self.meta.get('version', self.dir, [self.file]), {'versions': ['2.7']})
+
+    def testInvalidate(self):
+        other = os.path.join(self.dir, 'other')
+        self.meta.set('version', self.dir, [self.file], 1)
+        self.meta.set('config', self.dir, [self.file], 2)
+        self.meta.set('version', other, [self.file], 3)
+
+        self.meta.invalidate(self.dir)
+        self.assertEqual(self.meta.get('version', self.dir, [self.file]), None)
+        self.assertEqual(self.meta.get('config', self.dir, [self.file]), None)
+        self.assertEqual(self.meta.get('version', other, [self.file]), 3)
+
+        self.meta.invalidate()
+        self.assertEqual(self.meta.get('version', other, [self.file]), None)
+
+    def testSave(self):
+        self.meta.set('version', self.dir, [self.file], {'version': '2014051200.00'})
+        self.meta.save()
+        self.assertEqual(sorted(os.listdir(self.dir)), ['metadata.json', 'version.php'])
+
+        # Read again from the file.
+        self.meta._data = None
+        self.assertEqual(self.meta.get('version', self.dir, [self.file]), {'version': '2014051200.00'})
+
+        # A corrupted file is ignored.
+        with open(self.meta.getPath(), 'w') as f:
+            f.write('{')
+        self.meta._data = None
+        self.assertEqual(self.meta.get('version', self.dir, [self.file]), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from tests import makeInstance
+from lib.config import Conf
+from lib.metadata import Metadata
+from lib.moodle import Moodle
+
+C = Conf()
+
+
+class Instance(Moodle):
+    """Instance whose database records the versions of installed"""
+
+    installed = None
+    purged = 0
+    queries = 0
+
+    def getInstalledCoreVersion(self):
+        return self.installed['core']
+
+    def getInstalledVersions(self):
+        self.queries += 1
+        return dict(self.installed)
+
+    def purge(self, manual=False):
+        self.purged += 1
+
+
+class UpgradeNeededTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        makeInstance(os.path.join(self.dir, 'www'), {'dbname': 'stable27', 'dataroot': self.dir})
+        self.M = Instance(os.path.join(self.dir, 'www'), 'stable_27')
+        self.M.installed = {'core': '2014051200.00', 'mod_forum': '2014051200'}
+        self.versions = {'core': '2014051200.00', 'mod_forum': '2014051200'}
+        # The upgrade script always succeeds.
+        self.php = C.get('php')
+        C.data.set('php', 'true')
+
+    def tearDown(self):
+        Metadata().invalidate(self.M.path)
+        C.data.set('php', self.php)
+        shutil.rmtree(self.dir)
+
+    def testRecordedVersions(self):
+        self.assertEqual(self.M.upgradeNeeded(self.versions), [])
+        self.assertEqual(self.M.upgradeNeeded(self.versions), [])
+        self.assertEqual(self.M.queries, 1)
+
+    def testChangedFiles(self):
+        self.assertEqual(self.M.upgradeNeeded(self.versions), [])
+        self.versions['mod_forum'] = '2014051201'
+        self.versions['mod_new'] = '2014051200'
+        self.assertEqual(self.M.upgradeNeeded(self.versions), [
+            ('mod_forum', '2014051200', '2014051201'),
+            ('mod_new', None, '2014051200')
+        ])
+        self.assertEqual(self.M.queries, 2)
+
+    def testChangedDatabase(self):
+        self.assertEqual(self.M.upgradeNeeded(self.versions), [])
+        self.M.installed = {'core': '2013111800.00', 'mod_forum': '2013110500'}
+        self.assertEqual(self.M.upgradeNeeded(self.versions), [
+            ('core', '2013111800.00', '2014051200.00'),
+            ('mod_forum', '2013110500', '2014051200')
+        ])
+
+    def testInvalidated(self):
+        self.assertEqual(self.M.upgradeNeeded(self.versions), [])
+        Metadata().invalidate(self.M.path)
+        self.assertEqual(self.M.upgradeNeeded(self.versions), [])
+        self.assertEqual(self.M.queries, 2)
+
+    def testUpgradeFromWorkingTreePurges(self):
+        self.assertTrue(self.M._upgrade(self.M.path, force=True))
+        self.assertEqual(self.M.purged, 0)
+        self.assertTrue(self.M._upgrade(self.dir, force=True))
+        self.assertEqual(self.M.purged, 1)
+
+
+class ConfigEditorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        makeInstance(os.path.join(self.dir, 'www'), {'dbname': 'stable27', 'dataroot': self.dir})
+        self.M = Moodle(os.path.join(self.dir, 'www'), 'stable_27')
+        self.path = os.path.join(self.M.path, 'config.php')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read(self):
+        with open(self.path, 'r') as f:
+            return f.read()
+
+    def testEdit(self):
+        with self.M.editConfig() as config:
+            config.set('debug', 32767)
+            config.set('debugdisplay', True)
+            config.add('theme', 'clean')
+            config.set('dbname', 'stable27b')
+        content = self.read()
+        self.assertIn("$CFG->debug = 32767;\n", content)
+        self.assertIn("$CFG->debugdisplay = true;\n", content)
+        self.assertIn("$CFG->theme = 'clean';\n", content)
+        self.assertNotIn("'stable27'", content)
+        self.assertTrue(content.index('// MDK Edit.') < content.index('$CFG->debug') < content.index('lib/setup.php'))
+        self.assertEqual(self.M.get('debug'), 32767)
+        self.assertEqual(self.M.get('dbname'), 'stable27b')
+
+        with self.M.editConfig() as config:
+            config.remove('theme')
+            config.remove('missing')
+        self.assertNotIn('$CFG->theme', self.read())
+        self.assertEqual(self.read().count('// MDK Edit.'), 1)
+
+    def testBlock(self):
+        with self.M.editConfig() as config:
+            config.setBlock('Test', 'if ($a) {\n    $b = 1;\n}')
+        content = self.read()
+        self.assertIn('// MDK Test start.\nif ($a) {\n    $b = 1;\n}\n// MDK Test end.\n', content)
+        self.assertTrue(content.index('// MDK Test end.') < content.index('lib/setup.php'))
+
+        with self.M.editConfig() as config:
+            config.setBlock('Test', '$c = 2;')
+        self.assertEqual(self.read().count('// MDK Test start.'), 1)
+        self.assertIn('// MDK Test start.\n$c = 2;\n// MDK Test end.\n', self.read())
+
+        with self.M.editConfig() as config:
+            config.setBlock('Test')
+        self.assertNotIn('MDK Test', self.read())
+
+    def testNestedSessionsWriteOnce(self):
+        with self.M.editConfig() as config:
+            config.set('debug', 1)
+            with self.M.editConfig() as inner:
+                inner.set('theme', 'clean')
+            self.assertNotIn('$CFG->theme', self.read())
+        self.assertIn("$CFG->theme = 'clean';", self.read())
+        self.assertIn('$CFG->debug = 1;', self.read())
+
+    def testFailedSessionWritesNothing(self):
+        before = self.read()
+        try:
+            with self.M.editConfig() as config:
+                config.set('debug', 1)
+                raise ValueError('Failed')
+        except ValueError:
+            pass
+        self.assertEqual(self.read(), before)
+
+        with self.M.editConfig() as config:
+            self.assertRaises(Exception, config.add, 'identifier', 'x')
+        self.assertEqual(self.read(), before)
+
+    def testNoConfigFile(self):
+        os.remove(self.path)
+        with self.M.editConfig() as config:
+            config.set('debug', 1)
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from tests import makeInstance
+from lib.moodle import Moodle
+from lib.phpunit import PHPUnit
+
+config = """<?xml version="1.0" encoding="UTF-8"?>
+<phpunit bootstrap="lib/phpunit/bootstrap.php">
+    <testsuites>
+        <testsuite name="core_testsuite">
+            <directory suffix="_test.php">lib/tests</directory>
+            <exclude>lib/tests/fixtures</exclude>
+            <exclude>lib/tests/excluded_test.php</exclude>
+        </testsuite>
+        <testsuite name="mod_forum_testsuite">
+            <directory suffix="_test.php">mod/forum/tests</directory>
+            <file>mod/forum/other.php</file>
+        </testsuite>
+        <testsuite name="tool_phpunit_testsuite">
+            <directory>admin/tool/phpunit/tests</directory>
+        </testsuite>
+    </testsuites>
+</phpunit>
+"""
+
+
+class PHPUnitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        makeInstance(os.path.join(self.dir, 'www'))
+        self.M = Moodle(os.path.join(self.dir, 'www'), 'stable_27')
+        for f in ['lib/tests/a_test.php', 'lib/tests/sub/b_test.php', 'lib/tests/fixtures/c_test.php',
+                'lib/tests/excluded_test.php', 'lib/tests/helper.php', 'mod/forum/tests/lib_test.php',
+                'mod/forum/other.php', 'mod/unlisted/tests/lib_test.php', 'admin/tool/phpunit/tests/UtilTest.php',
+                'admin/tool/phpunit/tests/util_test.php']:
+            self.write(f, '<?php')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, content):
+        path = os.path.join(self.M.get('path'), name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def testGetTestFiles(self):
+        self.write('phpunit.xml', config)
+        self.assertEqual(PHPUnit(self.M).getTestFiles(), [
+            'admin/tool/phpunit/tests/UtilTest.php',
+            'lib/tests/a_test.php',
+            'lib/tests/sub/b_test.php',
+            'mod/forum/other.php',
+            'mod/forum/tests/lib_test.php'
+        ])
+
+    def testGetTestFilesFromDistributedConfig(self):
+        self.assertRaises(Exception, PHPUnit(self.M).getTestFiles)
+        self.write('phpunit.xml.dist', config)
+        self.assertIn('lib/tests/a_test.php', PHPUnit(self.M).getTestFiles())
+
+
+if __name__ == '__main__':
+    unittest.main()
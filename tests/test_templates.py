@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from tests import configFile, makeInstance
+from lib import moodle, templates
+from lib.config import Conf
+from lib.moodle import Moodle
+from lib.templates import InstallTemplate
+
+C = Conf()
+
+
+class FakeDB(object):
+    """Database server keeping the names of its databases, the queries can be made to fail"""
+
+    databases = set()
+    failOn = None
+    queries = []
+
+    def __init__(self, engine, options):
+        pass
+
+    def close(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def copydb(self, source, target):
+        if source not in FakeDB.databases:
+            raise Exception('Unknown database %s' % source)
+        FakeDB.databases.add(target)
+
+    def createdb(self, db):
+        FakeDB.databases.add(db)
+
+    def dbexists(self, db):
+        return db in FakeDB.databases
+
+    def dropdb(self, db):
+        FakeDB.databases.remove(db)
+
+    def execute(self, query, params=None):
+        if FakeDB.failOn and FakeDB.failOn in query:
+            raise Exception('Query failed')
+        FakeDB.queries.append(query)
+
+    def selectdb(self, db):
+        pass
+
+
+class Instance(Moodle):
+    """Instance on which the installer writes the config file and succeeds"""
+
+    installs = None
+
+    def cli(self, cli, args='', **kwargs):
+        self.installs.append(cli)
+        with open(os.path.join(self.path, 'config.php'), 'w') as f:
+            f.write(configFile % {'dbname': 'installed', 'dataroot': '/tmp'})
+        return (0, '', '')
+
+
+class InstallTemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.dataDir = os.path.join(self.dir, 'data')
+        os.makedirs(self.dataDir)
+        with open(os.path.join(self.dataDir, 'unrelated.txt'), 'w') as f:
+            f.write('Not from the template')
+
+        makeInstance(os.path.join(self.dir, 'www'))
+        self.M = Instance(os.path.join(self.dir, 'www'), 'stable_27')
+        self.M.installs = []
+
+        # The template, its database is known to the server.
+        self.patched = [(templates, 'DB', templates.DB), (moodle, 'DB', moodle.DB)]
+        templates.DB = FakeDB
+        moodle.DB = FakeDB
+        FakeDB.databases = set()
+        FakeDB.failOn = None
+        FakeDB.queries = []
+
+        self.template = InstallTemplate('mysqli', 'abc')
+        self.template.path = os.path.join(self.dir, 'template')
+        os.makedirs(os.path.join(self.template.path, 'dataroot', 'filedir'))
+        with open(os.path.join(self.template.path, 'dataroot', 'filedir', 'file.txt'), 'w') as f:
+            f.write('From the template')
+        with open(os.path.join(self.template.path, 'config.php'), 'w') as f:
+            f.write(configFile % {'dbname': self.template.dbname, 'dataroot': '/tmp/template'})
+        with open(os.path.join(self.template.path, 'info.json'), 'w') as f:
+            f.write('{}')
+        FakeDB.databases.add(self.template.dbname)
+
+    def tearDown(self):
+        for (module, name, value) in self.patched:
+            setattr(module, name, value)
+        C.data.set('installTemplates', False)
+        shutil.rmtree(self.dir)
+
+    def apply(self):
+        self.template.apply(self.M, 'stable27', self.dataDir, 'http://localhost/stable_27', 'Stable 2.7')
+
+    def testApply(self):
+        self.apply()
+        self.M.reload()
+        self.assertTrue(self.M.isInstalled())
+        self.assertEqual(self.M.get('dbname'), 'stable27')
+        self.assertEqual(self.M.get('dataroot'), self.dataDir)
+        self.assertEqual(self.M.get('wwwroot'), 'http://localhost/stable_27')
+        self.assertIn('stable27', FakeDB.databases)
+        self.assertEqual(sorted(os.listdir(self.dataDir)), ['filedir', 'unrelated.txt'])
+        self.assertTrue(os.path.isfile(os.path.join(self.dataDir, 'filedir', 'file.txt')))
+        self.assertEqual(len(FakeDB.queries), 2)
+
+    def testApplyFailureRemovesWhatWasCreated(self):
+        FakeDB.failOn = 'mdl_config'
+        self.assertRaises(Exception, self.apply)
+        self.assertEqual(os.listdir(self.dataDir), ['unrelated.txt'])
+        self.assertFalse(os.path.exists(os.path.join(self.M.get('path'), 'config.php')))
+        self.assertNotIn('stable27', FakeDB.databases)
+        self.assertFalse(self.M.isInstalled())
+
+    def testApplyRefusesToOverwrite(self):
+        os.makedirs(os.path.join(self.dataDir, 'filedir'))
+        with open(os.path.join(self.dataDir, 'filedir', 'mine.txt'), 'w') as f:
+            f.write('Not from the template')
+        self.assertRaises(Exception, self.apply)
+        self.assertEqual(os.listdir(os.path.join(self.dataDir, 'filedir')), ['mine.txt'])
+        self.assertNotIn('stable27', FakeDB.databases)
+
+    def testInstallFallsBackToTheInstaller(self):
+        C.data.set('installTemplates', True)
+        template = self.template
+        self.patched.append((moodle, 'InstallTemplate', moodle.InstallTemplate))
+        moodle.InstallTemplate = type('FixedTemplate', (InstallTemplate,), {
+            'getForInstance': staticmethod(lambda M, engine, options: template)
+        })
+
+        FakeDB.failOn = 'mdl_config'
+        self.M.install(dbname='stable27', engine='mysqli', dataDir=self.dataDir)
+        self.assertEqual(self.M.installs, ['admin/cli/install.php'])
+        self.assertEqual(os.listdir(self.dataDir), ['unrelated.txt'])
+        self.assertIn('stable27', FakeDB.databases)
+        self.assertEqual(self.M.get('dbname'), 'installed')
+
+    def testKeyDependsOnTheInstallerOptions(self):
+        options = {'adminuser': 'admin', 'adminpass': 'test', 'lang': 'en', 'prefix': 'mdl_'}
+        template = InstallTemplate.getForInstance(self.M, 'mysqli', options)
+        self.assertEqual(template.key, InstallTemplate.getForInstance(self.M, 'mysqli', dict(options)).key)
+        options['adminuser'] = 'root'
+        self.assertNotEqual(template.key, InstallTemplate.getForInstance(self.M, 'mysqli', options).key)
+        self.assertNotEqual(template.key, InstallTemplate.getForInstance(self.M, 'pgsql', options).key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from lib import timings
+from lib.timings import schedule, Timings
+
+
+class Instance(object):
+    """Instance providing what is recorded with the timings"""
+
+    def __init__(self, identifier, branch):
+        self.info = {'identifier': identifier, 'branch': branch, 'version': '2014051200.00'}
+
+    def get(self, name):
+        return self.info[name]
+
+
+class ScheduleTest(unittest.TestCase):
+
+    def testLongestFirst(self):
+        durations = {'a': 10, 'b': 9, 'c': 8, 'd': 7, 'e': 6, 'f': 5, 'g': 4}
+        groups = schedule(sorted(durations.keys()), durations, 3)
+        self.assertEqual(groups, [['a', 'f', 'g'], ['b', 'e'], ['c', 'd']])
+        # Within 4/3 of the optimum, which cannot be less than a third of the total.
+        self.assertTrue(max([sum([durations[item] for item in group]) for group in groups]) <= 49 / 3.0 * 4 / 3)
+
+    def testBalance(self):
+        durations = dict([('item%d' % i, float(i % 7 + 1)) for i in range(100)])
+        groups = schedule(durations.keys(), durations, 4)
+        self.assertEqual(sorted(sum(groups, [])), sorted(durations.keys()))
+        totals = [sum([durations[item] for item in group]) for group in groups]
+        self.assertTrue(max(totals) - min(totals) <= max(durations.values()))
+
+    def testUnknownDurations(self):
+        # The unknown items last as long as the median one, 2.
+        groups = schedule(['a', 'b', 'c', 'x', 'y'], {'a': 10, 'b': 1, 'c': 2}, 2)
+        self.assertEqual(groups, [['a'], ['c', 'x', 'y', 'b']])
+        self.assertEqual(schedule(['x', 'y', 'z'], {}, 3), [['x'], ['y'], ['z']])
+
+    def testEmptyGroups(self):
+        self.assertEqual(schedule(['a', 'b'], {'a': 1, 'b': 2}, 5), [['b'], ['a']])
+        self.assertEqual(schedule(['a', 'b'], {'a': 1, 'b': 2}, 0), [['b', 'a']])
+        self.assertEqual(schedule([], {}, 3), [])
+
+
+class TimingsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.timings = Timings(os.path.join(self.dir, 'timings.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testDurations(self):
+        M = Instance('stable_27', 27)
+        for i in range(timings._sampleSize + 2):
+            self.timings.record('phpunit', M, [('a_test.php', '', 100.0 if i == 0 else 10.0, False),
+                ('a_test.php', 'a_test', 5.0, False), ('b_test.php', '', float(i), False)])
+        self.timings.record('behat', M, [('a.feature', '', 50.0, True)])
+        self.timings.record('phpunit', Instance('stable_26', 26), [('c_test.php', '', 1.0, False)])
+
+        # The oldest measures, and the ones of the classes, are left out.
+        durations = self.timings.getDurations('phpunit', 27)
+        self.assertEqual(durations, {'a_test.php': 10.0, 'b_test.php': 4.0})
+        self.assertEqual(self.timings.getDurations('behat', 27), {'a.feature': 50.0})
+
+        # The file measured on another branch is expected to last as long as the median one, 10.
+        self.assertEqual(self.timings.schedule('phpunit', 27, ['a_test.php', 'b_test.php', 'c_test.php'], 2),
+            [['a_test.php', 'b_test.php'], ['c_test.php']])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+"""
+Moodle Development Kit
+
+Copyright (c) 2014 Frédéric Massart - FMCorz.net
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+http://github.com/FMCorz/mdk
+"""
+
+import threading
+import unittest
+from lib import tools
+
+
+class ProcessLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limit = tools._processLimit
+        tools.setProcessLimit(1)
+
+    def tearDown(self):
+        tools._processLimit = self.limit
+
+    def testNestedProcessDoesNotWait(self):
+        with tools._processTurn():
+            self.assertEqual(tools.process('echo nested')[1].strip(), 'nested')
+
+    def testUnlimitedProcessDoesNotWait(self):
+        done = threading.Event()
+        self.addCleanup(done.set)
+        turn = threading.Event()
+
+        def hold():
+            with tools._processTurn():
+                turn.set()
+                done.wait()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        self.addCleanup(thread.join)
+        turn.wait()
+        self.assertEqual(tools.process('echo unlimited', limited=False, timeout=5)[1].strip(), 'unlimited')
+        future = tools.processAsync('echo limited')
+        self.assertFalse(future.done())
+        done.set()
+        self.assertEqual(future.result()[1].strip(), 'limited')
+
+
+if __name__ == '__main__':
+    unittest.main()